@@ -1,10 +1,172 @@
-from sqlmodel import SQLModel
+import logging
+import os
+from argparse import ArgumentParser
+from typing import Dict, List
 
-from .db import engine
+from sqlalchemy import inspect, text
+from sqlmodel import Session, SQLModel, select
+
+from . import env  # noqa: F401
+from .db import get_engine
+from .indexes import (
+    HNSW,
+    INDEX_METHODS,
+    IVFFLAT,
+    QUANTIZATIONS,
+    VECTOR_TABLES,
+    create_vector_index,
+    drop_vector_index,
+    rebuild_vector_index,
+    vector_index_recall,
+)
+from .models import Recipe
+from .utils import canonicalize_url
+
+
+def add_missing_columns(engine, table) -> List[str]:
+    """Add the nullable columns declared since `table` was created
+
+    Returns
+    -------
+    List[str]
+        The names of the columns added
+
+    """
+    existing = {column["name"] for column in inspect(engine).get_columns(table.name)}
+    added = []
+    with engine.begin() as conn:
+        for column in table.columns:
+            if column.name in existing or not column.nullable:
+                continue
+            column_type = column.type.compile(dialect=engine.dialect)
+            conn.execute(
+                text(
+                    f'ALTER TABLE {table.name} ADD COLUMN "{column.name}" {column_type}'
+                )
+            )
+            added.append(column.name)
+    return added
+
+
+def adopt_existing_embeddings(engine, model):
+    """Attribute the embeddings of `model` to the current embedding model
+
+    Run when the embedding provenance columns are added to an existing table,
+    so that the embeddings it already has are not all recomputed by the next
+    backfill. They must have been produced by the model currently configured
+    (see `chao_fan.integrations.sentence_transformer.embedding_model_id`).
+
+    """
+    from .embedding_backfill import adopt_unversioned_embeddings
+    from .integrations.sentence_transformer import embedding_model_id
+
+    model_id = embedding_model_id()
+    n = adopt_unversioned_embeddings(engine, model, model_id)
+    if n > 0:
+        print(
+            f"Recorded {model_id} as the model of {n} {model.__tablename__} embeddings"
+        )
+
+
+def backfill_canonical_urls(engine):
+    """Set the canonical url of the recipes created before it was recorded
+
+    Of the recipes of the same page, the first enriched one (or else the oldest)
+    gets the canonical url. The others are left without one, see
+    `dedupe_recipes` to delete the ones that are not enriched.
+
+    """
+    with Session(engine) as session:
+        taken = set(
+            session.exec(
+                select(Recipe.canonical_url).where(Recipe.canonical_url != None)  # noqa
+            ).all()
+        )
+        recipes = session.exec(
+            select(Recipe)
+            .where(Recipe.canonical_url == None)  # noqa
+            .where(Recipe.source_url != None)  # noqa
+            .order_by(Recipe.enriched_at.is_(None), Recipe.id)
+        ).all()
+        n_duplicates = 0
+        for recipe in recipes:
+            canonical_url = canonicalize_url(recipe.source_url)
+            if canonical_url not in taken:
+                recipe.canonical_url = canonical_url
+                taken.add(canonical_url)
+            else:
+                n_duplicates += 1
+        session.commit()
+    if n_duplicates > 0:
+        print(
+            f"{n_duplicates} recipes duplicate the page of another recipe and were "
+            "left without a canonical url. Run `dedupe_recipes` to delete the ones "
+            "that are not enriched."
+        )
+
+
+def duplicate_recipes(session: Session) -> List[Recipe]:
+    """Unenriched recipes of a page that another recipe already has
+
+    They were left without a canonical url by `backfill_canonical_urls`, and
+    would only scrape the page again.
+
+    """
+    canonical_urls = set(
+        session.exec(
+            select(Recipe.canonical_url).where(Recipe.canonical_url != None)  # noqa
+        ).all()
+    )
+    recipes = session.exec(
+        select(Recipe)
+        .where(Recipe.canonical_url == None)  # noqa
+        .where(Recipe.source_url != None)  # noqa
+        .where(Recipe.enriched_at == None)  # noqa
+        .order_by(Recipe.id)
+    ).all()
+    return [
+        recipe
+        for recipe in recipes
+        if canonicalize_url(recipe.source_url) in canonical_urls
+    ]
+
+
+def dedupe_recipes():
+    """Delete the unenriched recipes of pages that another recipe already has"""
+    engine = get_engine()
+    backfill_canonical_urls(engine)
+    with Session(engine) as session:
+        duplicates = duplicate_recipes(session)
+        if len(duplicates) == 0:
+            print("No duplicate recipes to delete")
+            return
+        for recipe in duplicates:
+            print(f"{recipe.id}\t{recipe.source_url}")
+        check = input(
+            f"This will delete the {len(duplicates)} recipes above. Are you sure you want to continue? (yes/no)"
+        )
+        if check != "yes":
+            print("Aborting")
+            return
+        for recipe in duplicates:
+            session.delete(recipe)
+        session.commit()
+    print(f"Deleted {len(duplicates)} duplicate recipes")
 
 
 def setup_db():
+    engine = get_engine()
     SQLModel.metadata.create_all(engine)
+    # create_all skips existing tables, so add columns and indexes declared since
+    # they were made
+    for table in SQLModel.metadata.sorted_tables:
+        added = add_missing_columns(engine, table)
+        if "embedding_model" in added and table.name in VECTOR_TABLES:
+            adopt_existing_embeddings(engine, VECTOR_TABLES[table.name])
+    backfill_canonical_urls(engine)
+    for table in SQLModel.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(engine, checkfirst=True)
 
 
 def reset_db():
@@ -14,5 +176,171 @@ def reset_db():
     if check != "yes":
         print("Aborting")
         return
+    engine = get_engine()
     SQLModel.metadata.drop_all(engine)
     SQLModel.metadata.create_all(engine)
+
+
+def match_cosine_distance_cutoffs() -> Dict[str, float]:
+    """The cosine distance cutoff of the ingredient matching, by table name"""
+    from .integrations.recipe_scrapers import (
+        INGREDIENT_NUTRITION_COSINE_DISTANCE_CUTOFF,
+        INGREDIENT_PRICE_COSINE_DISTANCE_CUTOFF,
+    )
+
+    return {
+        "ingredientprice": INGREDIENT_PRICE_COSINE_DISTANCE_CUTOFF,
+        "ingredientnutrition": INGREDIENT_NUTRITION_COSINE_DISTANCE_CUTOFF,
+    }
+
+
+def vector_index():
+    """Create, rebuild or drop ANN indices on the embedding columns, or report
+    their recall against exact search"""
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+    )
+    parser = ArgumentParser(description=vector_index.__doc__)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    for command in ["create", "rebuild", "drop", "report"]:
+        subparser = subparsers.add_parser(command)
+        subparser.add_argument(
+            "--tables",
+            nargs="+",
+            choices=list(VECTOR_TABLES),
+            default=list(VECTOR_TABLES),
+            help="Tables to index, by default all tables with an embedding column",
+        )
+        subparser.add_argument("--method", choices=INDEX_METHODS, default=HNSW)
+        subparser.add_argument(
+            "--quantization",
+            choices=QUANTIZATIONS,
+            default=None,
+            help="Index halfvec or binary quantized embeddings instead of float32",
+        )
+        if command in ["create", "rebuild"]:
+            subparser.add_argument("--m", type=int, default=16)
+            subparser.add_argument("--ef_construction", type=int, default=64)
+            subparser.add_argument("--lists", type=int, default=100)
+            subparser.add_argument(
+                "--maintenance_work_mem",
+                type=str,
+                default=None,
+                help="e.g. 2GB, speeds up building large HNSW indices",
+            )
+        if command == "report":
+            subparser.add_argument("--n_queries", type=int, default=50)
+            subparser.add_argument("--k", type=int, default=10)
+            subparser.add_argument(
+                "--ef_search", type=int, nargs="*", default=[20, 40, 80, 160]
+            )
+            subparser.add_argument("--probes", type=int, nargs="*", default=[1, 5, 10])
+            subparser.add_argument(
+                "--candidates",
+                type=int,
+                nargs="*",
+                default=None,
+                help="Numbers of quantized candidates reranked exactly, by default 4k",
+            )
+            subparser.add_argument(
+                "--cosine_distance_cutoff",
+                type=float,
+                default=None,
+                help="Only search rows further than this from the query, by default "
+                "the cutoff of the ingredient matching on its tables",
+            )
+    args = parser.parse_args()
+
+    engine = get_engine()
+    for table_name in args.tables:
+        if args.command in ["create", "rebuild"]:
+            build = (
+                create_vector_index
+                if args.command == "create"
+                else rebuild_vector_index
+            )
+            build(
+                engine,
+                table_name,
+                method=args.method,
+                m=args.m,
+                ef_construction=args.ef_construction,
+                lists=args.lists,
+                maintenance_work_mem=args.maintenance_work_mem,
+                quantization=args.quantization,
+            )
+        elif args.command == "drop":
+            drop_vector_index(
+                engine, table_name, method=args.method, quantization=args.quantization
+            )
+        elif args.command == "report":
+            cutoff = args.cosine_distance_cutoff
+            if cutoff is None:
+                cutoff = match_cosine_distance_cutoffs().get(table_name)
+            report = vector_index_recall(
+                engine,
+                table_name,
+                n_queries=args.n_queries,
+                k=args.k,
+                ef_search_values=args.ef_search if args.method == HNSW else None,
+                probes_values=args.probes if args.method == IVFFLAT else None,
+                quantization=args.quantization,
+                candidates_values=args.candidates,
+                cosine_distance_cutoff=cutoff,
+            )
+            method = args.method
+            if args.quantization is not None:
+                method = f"{args.quantization} {method}"
+            if cutoff is not None:
+                method = f"{method}, distance > {cutoff}"
+            print(f"{table_name} ({method}, recall@{args.k})")
+            for row in report:
+                print(
+                    f"  {row['setting']:>26}  recall={row['recall']:.3f}  "
+                    f"latency={row['latency_ms']:.2f}ms"
+                )
+
+
+def embedding_service():
+    """Serve embeddings to the other processes of this machine, keeping the
+    model loaded and batching concurrent requests together"""
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+    )
+    parser = ArgumentParser(description=embedding_service.__doc__)
+    parser.add_argument(
+        "--address",
+        default=os.environ.get("EMBEDDING_SERVICE_ADDRESS"),
+        help="Unix socket path or host:port, by default EMBEDDING_SERVICE_ADDRESS",
+    )
+    parser.add_argument("--device", default=None)
+    parser.add_argument("--max_batch_size", type=int, default=256)
+    parser.add_argument(
+        "--max_wait_ms",
+        type=float,
+        default=10,
+        help="How long a request waits for others to join its batch",
+    )
+    args = parser.parse_args()
+    if args.address is None:
+        parser.error("--address or EMBEDDING_SERVICE_ADDRESS is required")
+    # Imported here so that the other commands do not load torch
+    from .embedding_service import EmbeddingServer
+    from .integrations.sentence_transformer import get_model
+
+    authkey = os.environ.get("EMBEDDING_SERVICE_AUTHKEY")
+    server = EmbeddingServer(
+        get_model(device=args.device, local=True),
+        args.address,
+        authkey=authkey.encode() if authkey else None,
+        max_batch_size=args.max_batch_size,
+        max_wait=args.max_wait_ms / 1000,
+    )
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
@@ -1,9 +1,50 @@
 import os
+from functools import lru_cache
 
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
 from sqlmodel import create_engine
 
 # Needed to make sure the tables are created
 from . import models  # noqa: F401
 
-postgres_url = os.environ.get("POSTGRES_URL")
-engine = create_engine(postgres_url)
+# ANN search parameters applied to every connection (see chao_fan.indexes).
+# The ingredient matching keeps the nearest rows *beyond* a cosine distance
+# cutoff, which an HNSW scan only finds if it keeps going past ef_search rows
+# (pgvector 0.8 iterative scans, ignored with a warning by older versions).
+VECTOR_SEARCH_PARAMETERS = {
+    "hnsw.ef_search": os.environ.get("HNSW_EF_SEARCH"),
+    "hnsw.iterative_scan": os.environ.get("HNSW_ITERATIVE_SCAN", "strict_order")
+    or None,
+    "hnsw.max_scan_tuples": os.environ.get("HNSW_MAX_SCAN_TUPLES"),
+    "ivfflat.probes": os.environ.get("IVFFLAT_PROBES"),
+}
+
+
+def set_vector_search_parameters(dbapi_connection, connection_record):
+    settings = {k: v for k, v in VECTOR_SEARCH_PARAMETERS.items() if v is not None}
+    if len(settings) == 0:
+        return
+    with dbapi_connection.cursor() as cursor:
+        for name, value in settings.items():
+            cursor.execute("SELECT set_config(%s, %s, false)", (name, value))
+    # Otherwise the settings are rolled back with the connection's first transaction
+    dbapi_connection.commit()
+
+
+@lru_cache(maxsize=None)
+def get_engine() -> Engine:
+    """The engine of POSTGRES_URL, created on first use"""
+    postgres_url = os.environ.get("POSTGRES_URL")
+    if postgres_url is None:
+        raise ValueError("POSTGRES_URL environment variable not set")
+    engine = create_engine(postgres_url)
+    event.listen(engine, "connect", set_vector_search_parameters)
+    return engine
+
+
+def __getattr__(name: str):
+    # `from chao_fan.db import engine` still works, creating the engine then
+    if name == "engine":
+        return get_engine()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,316 @@
+"""
+Batched reads and writes for filling the embedding columns of large tables
+"""
+
+import hashlib
+import logging
+import time
+from datetime import datetime, timezone
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+from sqlalchemy import ARRAY, Integer, String, bindparam, func, or_, update
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.engine import Engine
+from sqlmodel import Session, select
+
+from chao_fan.embedding_cache import normalize_text
+from chao_fan.models import EmbeddingCheckpoint, Ingredient
+
+logger = logging.getLogger(__name__)
+
+
+def content_hash(text: str) -> str:
+    """Hash of an embedded text, equal to Postgres' `md5(text)`"""
+    return hashlib.md5(text.encode("utf-8")).hexdigest()
+
+
+def needs_embedding(ingredient_model: Ingredient, model_id: Optional[str] = None):
+    """Condition on the rows to (re-)embed
+
+    Without `model_id`, only rows without an embedding. Otherwise, also the rows
+    embedded by another model or whose description changed since.
+
+    """
+    condition = ingredient_model.embedding == None  # noqa
+    if model_id is None:
+        return condition
+    return or_(
+        condition,
+        ingredient_model.embedding_model.is_distinct_from(model_id),
+        ingredient_model.embedding_hash.is_distinct_from(
+            func.md5(ingredient_model.description)
+        ),
+    )
+
+
+def pending_batches(
+    engine: Engine,
+    ingredient_model: Ingredient,
+    batch_size: int,
+    after_id: int = 0,
+    deadline: Optional[float] = None,
+    shard: Optional[Tuple[int, int]] = None,
+    model_id: Optional[str] = None,
+) -> Iterator[List[Tuple[int, str]]]:
+    """Yield (id, description) batches of rows to embed
+
+    The table is walked by increasing id (keyset pagination) rather than by
+    re-running `WHERE embedding IS NULL LIMIT n`, so each batch resumes from the
+    primary key index where the previous one stopped instead of rescanning the
+    rows that were just embedded.
+
+    Parameters
+    ----------
+    engine : Engine
+        The sqlalchemy engine
+    ingredient_model : Ingredient
+        The ingredient table to read
+    batch_size : int
+        Maximum number of rows per batch
+    after_id : int, optional
+        Only rows with a larger id are read, by default 0
+    deadline : float, optional
+        `time.monotonic()` value after which no new batch is read
+    shard : Tuple[int, int], optional
+        (index, count): only rows with `id % count == index` are read, so that
+        several workers can fill the same table without overlapping
+    model_id : str, optional
+        Also yield rows whose embedding is out of date for this model, see
+        `needs_embedding`
+
+    """
+    last_id = after_id
+    while True:
+        if deadline is not None and time.monotonic() >= deadline:
+            return
+        statement = (
+            select(ingredient_model.id, ingredient_model.description)
+            .where(ingredient_model.id > last_id)
+            .where(needs_embedding(ingredient_model, model_id))
+            # e.g. recipe ingredients that could not be parsed
+            .where(ingredient_model.description != None)  # noqa
+            .order_by(ingredient_model.id)
+            .limit(batch_size)
+        )
+        if shard is not None:
+            index, count = shard
+            statement = statement.where(ingredient_model.id % count == index)
+        with Session(engine) as session:
+            rows = session.exec(statement).all()
+        if len(rows) == 0:
+            return
+        yield [(row[0], row[1]) for row in rows]
+        last_id = rows[-1][0]
+
+
+def update_embeddings_statement(ingredient_model: Ingredient):
+    """UPDATE setting the embedding of many rows at once
+
+    The ids, embeddings and content hashes are bound as arrays (`ids`,
+    `embeddings` and `hashes`) and unnested into a derived table joined on id,
+    so a whole batch is written by a single statement instead of one UPDATE per
+    row. The model is bound as `model_id`.
+
+    """
+    table = ingredient_model.__table__
+    vector_type = table.c.embedding.type
+    values = select(
+        func.unnest(bindparam("ids", type_=ARRAY(Integer))).label("id"),
+        func.unnest(
+            bindparam("embeddings", type_=ARRAY(vector_type, dimensions=1))
+        ).label("embedding"),
+        func.unnest(bindparam("hashes", type_=ARRAY(String))).label("embedding_hash"),
+    ).subquery("new_embeddings")
+    return (
+        update(table)
+        .where(table.c.id == values.c.id)
+        .values(
+            embedding=values.c.embedding,
+            embedding_hash=values.c.embedding_hash,
+            embedding_model=bindparam("model_id", type_=String),
+        )
+    )
+
+
+def write_embeddings(
+    engine: Engine,
+    ingredient_model: Ingredient,
+    ids: Sequence[int],
+    embeddings: Sequence[Sequence[float]],
+    hashes: Sequence[str],
+    model_id: str,
+) -> None:
+    """Set the embeddings of the rows with `ids` in one statement
+
+    `hashes` are the `content_hash` of the texts that were embedded.
+
+    """
+    if len(ids) == 0:
+        return
+    with Session(engine) as session:
+        session.exec(
+            update_embeddings_statement(ingredient_model),
+            params=dict(
+                ids=list(ids),
+                embeddings=list(embeddings),
+                hashes=list(hashes),
+                model_id=model_id,
+            ),
+        )
+        session.commit()
+
+
+def group_descriptions(rows: Sequence[Tuple[int, str]]) -> Dict[str, List[str]]:
+    """Distinct descriptions of `rows`, grouped by their normalized text
+
+    Descriptions that only differ in case or whitespace get the same embedding,
+    so each group only needs to be encoded once.
+
+    """
+    groups: Dict[str, Dict[str, None]] = {}
+    for _, description in rows:
+        groups.setdefault(normalize_text(description), {})[description] = None
+    return {normalized: list(variants) for normalized, variants in groups.items()}
+
+
+def update_embeddings_by_description_statement(
+    ingredient_model: Ingredient, shard: Optional[Tuple[int, int]] = None
+):
+    """UPDATE setting the embedding of every row with one of the descriptions
+
+    The descriptions and embeddings are bound as two arrays (`descriptions` and
+    `embeddings`), and the model as `model_id`. Only rows without an up-to-date
+    embedding of that model are updated, and with `shard` only the rows of that
+    shard, so that shards never lock each other's rows.
+
+    """
+    table = ingredient_model.__table__
+    vector_type = table.c.embedding.type
+    values = select(
+        func.unnest(bindparam("descriptions", type_=ARRAY(String))).label(
+            "description"
+        ),
+        func.unnest(
+            bindparam("embeddings", type_=ARRAY(vector_type, dimensions=1))
+        ).label("embedding"),
+    ).subquery("new_embeddings")
+    model_id = bindparam("model_id", type_=String)
+    embedding_hash = func.md5(values.c.description)
+    statement = (
+        update(table)
+        .where(table.c.description == values.c.description)
+        .where(
+            or_(
+                table.c.embedding == None,  # noqa
+                table.c.embedding_model.is_distinct_from(model_id),
+                table.c.embedding_hash.is_distinct_from(embedding_hash),
+            )
+        )
+        .values(
+            embedding=values.c.embedding,
+            embedding_hash=embedding_hash,
+            embedding_model=model_id,
+        )
+    )
+    if shard is not None:
+        index, count = shard
+        statement = statement.where(table.c.id % count == index)
+    return statement
+
+
+def write_embeddings_by_description(
+    engine: Engine,
+    ingredient_model: Ingredient,
+    descriptions: Sequence[str],
+    embeddings: Sequence[Sequence[float]],
+    model_id: str,
+    shard: Optional[Tuple[int, int]] = None,
+) -> int:
+    """Fan embeddings out to every row with the same description
+
+    Returns
+    -------
+    int
+        The number of rows updated, including rows outside the current batch
+
+    """
+    if len(descriptions) == 0:
+        return 0
+    with Session(engine) as session:
+        result = session.exec(
+            update_embeddings_by_description_statement(ingredient_model, shard),
+            params=dict(
+                descriptions=list(descriptions),
+                embeddings=list(embeddings),
+                model_id=model_id,
+            ),
+        )
+        session.commit()
+    return result.rowcount
+
+
+def adopt_unversioned_embeddings(
+    engine: Engine, ingredient_model: Ingredient, model_id: str
+) -> int:
+    """Record `model_id` as the model of embeddings written before it was tracked
+
+    Otherwise those rows are all re-embedded by the next incremental pass.
+    Also accepts the Recipe table, whose embeddings have no content hash.
+
+    Returns
+    -------
+    int
+        The number of rows adopted
+
+    """
+    table = ingredient_model.__table__
+    values = dict(embedding_model=model_id)
+    if "description" in table.c:
+        values["embedding_hash"] = func.md5(table.c.description)
+    statement = (
+        update(table)
+        .where(table.c.embedding != None)  # noqa
+        .where(table.c.embedding_model == None)  # noqa
+        .values(**values)
+    )
+    with Session(engine) as session:
+        result = session.exec(statement)
+        session.commit()
+    return result.rowcount
+
+
+def load_checkpoint(engine: Engine, name: str) -> int:
+    """Last id processed by the backfill `name`, or 0 to start from the beginning"""
+    with Session(engine) as session:
+        checkpoint = session.get(EmbeddingCheckpoint, name)
+    return checkpoint.last_id if checkpoint is not None else 0
+
+
+def save_checkpoint(
+    engine: Engine,
+    name: str,
+    last_id: int,
+    rows: int = 0,
+    rows_per_second: Optional[float] = None,
+) -> None:
+    """Durably record the progress of the backfill `name`
+
+    Saving a `last_id` of 0 marks the pass as complete, so the next run starts
+    from the beginning of the table and picks up rows whose embedding was
+    cleared since.
+
+    """
+    values = dict(
+        last_id=last_id,
+        rows=rows,
+        rows_per_second=rows_per_second,
+        updated_at=datetime.now(timezone.utc),
+    )
+    statement = (
+        insert(EmbeddingCheckpoint)
+        .values(name=name, **values)
+        .on_conflict_do_update(index_elements=["name"], set_=values)
+    )
+    with Session(engine) as session:
+        session.exec(statement)
+        session.commit()
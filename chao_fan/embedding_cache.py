@@ -0,0 +1,150 @@
+"""
+Content-addressed cache of sentence embeddings
+"""
+
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_text(text: str) -> str:
+    """Normalize text before it is used as a cache key
+
+    The default model is uncased and ignores repeated whitespace, so these
+    variants all produce the same embedding.
+
+    """
+    return " ".join(text.lower().split())
+
+
+def embedding_key(model_name: str, text: str) -> str:
+    """Cache key of the embedding of `text` by `model_name`"""
+    content = f"{model_name}\0{normalize_text(text)}".encode("utf-8")
+    return hashlib.sha256(content).hexdigest()
+
+
+class EmbeddingCache:
+    """Embeddings keyed by (model name, normalized text)
+
+    Embeddings are kept in an in-memory LRU in front of an optional SQLite file
+    on disk. Since the model name is part of the key, switching models simply
+    misses the cache instead of returning stale vectors.
+
+    Parameters
+    ----------
+    model_name : str
+        The name of the model producing the embeddings
+    path : str, optional
+        Path of the SQLite file. If None, only the in-memory LRU is used.
+    memory_size : int, optional
+        Maximum number of embeddings kept in memory
+
+    """
+
+    def __init__(
+        self,
+        model_name: str,
+        path: Optional[str] = None,
+        memory_size: int = 100000,
+    ) -> None:
+        self.model_name = model_name
+        self.path = path
+        self.memory_size = memory_size
+        self.hits = 0
+        self.misses = 0
+        self._memory: OrderedDict[str, np.ndarray] = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+        if path is not None:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings "
+                "(key TEXT PRIMARY KEY, embedding BLOB NOT NULL)"
+            )
+            self._db.commit()
+
+    def _remember(self, key: str, embedding: np.ndarray) -> None:
+        self._memory[key] = embedding
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_size:
+            self._memory.popitem(last=False)
+
+    def get_many(self, texts: List[str]) -> List[Optional[np.ndarray]]:
+        """Look up the embeddings of several texts, None where missing"""
+        keys = [embedding_key(self.model_name, text) for text in texts]
+        found: Dict[str, np.ndarray] = {}
+        with self._lock:
+            for key in keys:
+                if key in self._memory:
+                    self._memory.move_to_end(key)
+                    found[key] = self._memory[key]
+            missing = list({key for key in keys if key not in found})
+            if self._db is not None:
+                # Stay below SQLite's limit on the number of query parameters
+                for start in range(0, len(missing), 500):
+                    chunk = missing[start : start + 500]
+                    rows = self._db.execute(
+                        "SELECT key, embedding FROM embeddings "
+                        f"WHERE key IN ({','.join('?' * len(chunk))})",
+                        chunk,
+                    )
+                    for key, blob in rows:
+                        embedding = np.frombuffer(blob, dtype=np.float32)
+                        found[key] = embedding
+                        self._remember(key, embedding)
+        results = [found.get(key) for key in keys]
+        n_hits = sum(result is not None for result in results)
+        self.hits += n_hits
+        self.misses += len(results) - n_hits
+        return results
+
+    def put_many(self, texts: List[str], embeddings) -> None:
+        """Store the embeddings of several texts"""
+        rows = []
+        with self._lock:
+            for text, embedding in zip(texts, embeddings):
+                key = embedding_key(self.model_name, text)
+                embedding = np.asarray(embedding, dtype=np.float32)
+                self._remember(key, embedding)
+                rows.append((key, embedding.tobytes()))
+            if self._db is not None and len(rows) > 0:
+                self._db.executemany(
+                    "INSERT OR REPLACE INTO embeddings (key, embedding) VALUES (?, ?)",
+                    rows,
+                )
+                self._db.commit()
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total > 0 else 0.0
+
+
+_default_caches: Dict[str, EmbeddingCache] = {}
+
+
+def get_embedding_cache(model_name: str) -> Optional[EmbeddingCache]:
+    """The cache configured by EMBEDDING_CACHE_PATH, or None if unset
+
+    Set EMBEDDING_CACHE_PATH=:memory: for an in-memory only cache.
+
+    """
+    path = os.environ.get("EMBEDDING_CACHE_PATH")
+    if path is None:
+        return None
+    if model_name not in _default_caches:
+        _default_caches[model_name] = EmbeddingCache(
+            model_name,
+            path=None if path == ":memory:" else path,
+            memory_size=int(os.environ.get("EMBEDDING_CACHE_MEMORY_SIZE", 100000)),
+        )
+    return _default_caches[model_name]
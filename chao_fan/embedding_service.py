@@ -0,0 +1,255 @@
+"""
+Long-lived local process serving embeddings to other processes
+"""
+
+import logging
+import os
+import queue
+import threading
+import time
+from multiprocessing.connection import Client, Connection, Listener
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+def parse_address(address: str) -> str | Tuple[str, int]:
+    """A Unix socket path, or a (host, port) tuple for "host:port" addresses"""
+    host, _, port = address.rpartition(":")
+    if host and port.isdigit():
+        return host, int(port)
+    return address
+
+
+def check_private_directory(socket_path: str) -> None:
+    """Raise unless only this user can create or reach sockets next to this path
+
+    Requests and responses are pickled, so whoever can connect to the server,
+    or replace its socket, can run code in the other process. A Unix socket is
+    therefore only used in a directory that belongs to the current user and is
+    closed to group and others (chmod 700).
+
+    """
+    directory = os.path.dirname(os.path.abspath(socket_path))
+    status = os.stat(directory)
+    if status.st_uid != os.getuid() or status.st_mode & 0o077:
+        raise PermissionError(
+            f"{directory} must belong to this user and be private (chmod 700) "
+            "to hold the embedding service socket"
+        )
+
+
+class _Request:
+    def __init__(self, sentences: List[str]) -> None:
+        self.sentences = sentences
+        self.embeddings: Optional[np.ndarray] = None
+        self.error: Optional[str] = None
+        self.done = threading.Event()
+
+
+class EmbeddingServer:
+    """Serve a model's embeddings over a Unix socket or a local TCP port
+
+    Every client connection is handled by its own thread, and requests waiting
+    at the same time are coalesced into one call to `model.encode`, so that
+    small requests from many workers still fill large batches.
+
+    Parameters
+    ----------
+    model : SentenceTransformer
+        The loaded model, kept in memory while the server runs
+    address : str
+        Path of the Unix socket, or "host:port"
+    authkey : bytes, optional
+        Shared secret that clients must present. Required for TCP addresses,
+        since requests are pickled.
+    max_batch_size : int, optional
+        Maximum number of sentences encoded at once, by default 256
+    max_wait : float, optional
+        Seconds a request waits for others to join its batch, by default 0.01
+
+    Notes
+    -----
+    Requests are unpickled, so only trusted processes may connect. A Unix
+    socket is created with mode 0600, in a directory that is created with mode
+    0700 if missing and must otherwise be private to this user (see
+    `check_private_directory`): only processes of the same user can connect,
+    with or without an authkey. Processes of other users or hosts go through
+    TCP, where the authkey is required.
+
+    """
+
+    def __init__(
+        self,
+        model,
+        address: str,
+        authkey: Optional[bytes] = None,
+        max_batch_size: int = 256,
+        max_wait: float = 0.01,
+    ) -> None:
+        self.model = model
+        self.address = parse_address(address)
+        if isinstance(self.address, tuple) and authkey is None:
+            raise ValueError("An authkey is required to serve embeddings over TCP")
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        if isinstance(self.address, tuple):
+            self.listener = Listener(self.address, authkey=authkey)
+        else:
+            directory = os.path.dirname(os.path.abspath(self.address))
+            os.makedirs(directory, mode=0o700, exist_ok=True)
+            check_private_directory(self.address)
+            # Bound with mode 0600 rather than chmod-ed after, leaving no window
+            umask = os.umask(0o177)
+            try:
+                self.listener = Listener(self.address, authkey=authkey)
+            finally:
+                os.umask(umask)
+        self._requests: queue.Queue[_Request] = queue.Queue()
+        self._stop = threading.Event()
+
+    def _next_batch(self) -> List[_Request]:
+        """Wait for a request, then for others until the batch is full or max_wait"""
+        while True:
+            if self._stop.is_set():
+                return []
+            try:
+                batch = [self._requests.get(timeout=0.1)]
+                break
+            except queue.Empty:
+                continue
+        n_sentences = len(batch[0].sentences)
+        deadline = time.monotonic() + self.max_wait
+        while n_sentences < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                request = self._requests.get(timeout=remaining)
+            except queue.Empty:
+                break
+            batch.append(request)
+            n_sentences += len(request.sentences)
+        return batch
+
+    def _encode_batches(self) -> None:
+        while not self._stop.is_set():
+            batch = self._next_batch()
+            if len(batch) == 0:
+                continue
+            sentences = [
+                sentence for request in batch for sentence in request.sentences
+            ]
+            try:
+                embeddings = np.asarray(
+                    self.model.encode(
+                        sentences,
+                        batch_size=self.max_batch_size,
+                        show_progress_bar=False,
+                    ),
+                    dtype=np.float32,
+                )
+                start = 0
+                for request in batch:
+                    end = start + len(request.sentences)
+                    request.embeddings = embeddings[start:end]
+                    start = end
+            except Exception as e:
+                logger.error(f"Failed to encode a batch: {e}")
+                for request in batch:
+                    request.error = str(e)
+            for request in batch:
+                request.done.set()
+
+    def _serve_connection(self, connection: Connection) -> None:
+        with connection:
+            while not self._stop.is_set():
+                try:
+                    sentences = connection.recv()
+                except (EOFError, OSError):
+                    return
+                request = _Request(list(sentences))
+                self._requests.put(request)
+                request.done.wait()
+                if request.error is not None:
+                    connection.send(("error", request.error))
+                else:
+                    connection.send(("ok", request.embeddings))
+
+    def serve_forever(self) -> None:
+        """Accept clients until `close` is called"""
+        threading.Thread(
+            target=self._encode_batches, name="encode", daemon=True
+        ).start()
+        logger.info(f"Serving embeddings on {self.address}")
+        while not self._stop.is_set():
+            try:
+                connection = self.listener.accept()
+            except OSError:
+                # The listener was closed
+                break
+            except Exception as e:
+                # e.g. a client with the wrong authkey
+                logger.warning(f"Rejected a connection: {e}")
+                continue
+            threading.Thread(
+                target=self._serve_connection, args=(connection,), daemon=True
+            ).start()
+
+    def close(self) -> None:
+        self._stop.set()
+        self.listener.close()
+
+
+class EmbeddingClient:
+    """Client of an `EmbeddingServer`, usable in place of a SentenceTransformer
+
+    Each thread gets its own connection, so the client can be shared by the
+    threads of a pipeline.
+
+    Parameters
+    ----------
+    address : str
+        Path of the Unix socket, or "host:port"
+    authkey : bytes, optional
+        The shared secret of the server. Without it, a Unix socket is only
+        used in a directory private to this user, so that no other user can
+        impersonate the server (see `check_private_directory`).
+
+    """
+
+    def __init__(self, address: str, authkey: Optional[bytes] = None) -> None:
+        self.address = parse_address(address)
+        self.authkey = authkey
+        self._local = threading.local()
+
+    def _connection(self) -> Connection:
+        if getattr(self._local, "connection", None) is None:
+            if isinstance(self.address, str) and self.authkey is None:
+                check_private_directory(self.address)
+            self._local.connection = Client(self.address, authkey=self.authkey)
+        return self._local.connection
+
+    def encode(self, sentences, **kwargs) -> np.ndarray:
+        """Embed sentences with the server's model
+
+        Keyword arguments of `SentenceTransformer.encode` (e.g. `batch_size`) are
+        accepted and ignored: the server decides how sentences are batched.
+
+        """
+        single = isinstance(sentences, str)
+        if single:
+            sentences = [sentences]
+        connection = self._connection()
+        try:
+            connection.send(list(sentences))
+            status, payload = connection.recv()
+        except (EOFError, OSError):
+            # Reconnect on the next call, e.g. after the server restarted
+            self._local.connection = None
+            raise
+        if status == "error":
+            raise RuntimeError(f"The embedding service failed: {payload}")
+        return payload[0] if single else payload
@@ -0,0 +1,15 @@
+"""
+Load the .env file into the environment
+
+Imported first by the entry points (CLI, pipelines and scripts), before the
+modules that read their configuration from the environment when imported.
+Importing the package itself leaves the environment untouched.
+"""
+
+import os
+
+from dotenv import load_dotenv
+
+# Set CHAO_FAN_LOAD_DOTENV=false to only use the environment (e.g. in tests)
+if os.environ.get("CHAO_FAN_LOAD_DOTENV", "true").lower() == "true":
+    load_dotenv()
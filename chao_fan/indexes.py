@@ -0,0 +1,426 @@
+"""
+Approximate nearest neighbour (ANN) indices on the pgvector embedding columns
+"""
+
+import logging
+import time
+from typing import Dict, List, Optional, Tuple
+
+from pgvector.sqlalchemy import BIT, Vector
+from pgvector.sqlalchemy import HALFVEC as HalfVector
+from sqlalchemy import cast, func, text
+from sqlalchemy.engine import Connection, Engine
+from sqlmodel import SQLModel
+
+from chao_fan.models import (
+    IngredientNutrition,
+    IngredientPrice,
+    Recipe,
+    RecipeIngredient,
+)
+
+logger = logging.getLogger(__name__)
+
+HNSW = "hnsw"
+IVFFLAT = "ivfflat"
+INDEX_METHODS = [HNSW, IVFFLAT]
+
+# Compact representations of the embeddings that can be indexed instead of the
+# float32 vectors, see `quantized_expression`
+HALFVEC = "halfvec"
+BINARY = "binary"
+QUANTIZATIONS = [HALFVEC, BINARY]
+
+# Tables with an embedding column, by table name
+VECTOR_TABLES: Dict[str, SQLModel] = {
+    model.__tablename__: model
+    for model in [Recipe, RecipeIngredient, IngredientPrice, IngredientNutrition]
+}
+
+
+def vector_index_name(
+    table_name: str, method: str, quantization: Optional[str] = None
+) -> str:
+    """Name of the ANN index of a table's embedding column"""
+    if quantization is not None:
+        return f"{table_name}_embedding_{quantization}_{method}_idx"
+    return f"{table_name}_embedding_{method}_idx"
+
+
+def embedding_dimension(table_name: str) -> int:
+    return int(VECTOR_TABLES[table_name].__table__.c.embedding.type.dim)
+
+
+def _check_quantization(quantization: Optional[str]):
+    if quantization is not None and quantization not in QUANTIZATIONS:
+        raise ValueError(
+            f"Unknown quantization {quantization}, must be one of {QUANTIZATIONS}"
+        )
+
+
+def quantized_expression(quantization: str, dimension: int) -> Tuple[str, str]:
+    """SQL expression of the compact embeddings, and its operator class
+
+    halfvec stores each dimension in 16 bits, halving the size of the index.
+    binary keeps the sign of each dimension (`binary_quantize`), 32 times smaller
+    than float32, compared with the Hamming distance. Both are indexed as
+    expressions of the embedding column, so the table keeps the full vectors
+    that candidates are reranked with. Requires pgvector 0.7 or later.
+
+    """
+    _check_quantization(quantization)
+    if quantization == HALFVEC:
+        return f"(embedding::halfvec({dimension}))", "halfvec_cosine_ops"
+    return f"(binary_quantize(embedding)::bit({dimension}))", "bit_hamming_ops"
+
+
+def quantized_distance(embedding, query, quantization: str, dimension: int):
+    """The distance between compact embeddings, matching `quantized_expression`
+
+    Used in ORDER BY, so that the planner can use the quantized index.
+
+    """
+    _check_quantization(quantization)
+    if quantization == HALFVEC:
+        return cast(embedding, HalfVector(dimension)).cosine_distance(
+            cast(query, HalfVector(dimension))
+        )
+    return cast(func.binary_quantize(embedding), BIT(dimension)).hamming_distance(
+        cast(func.binary_quantize(cast(query, Vector(dimension))), BIT(dimension))
+    )
+
+
+def create_vector_index_sql(
+    table_name: str,
+    method: str = HNSW,
+    m: int = 16,
+    ef_construction: int = 64,
+    lists: int = 100,
+    quantization: Optional[str] = None,
+) -> str:
+    """SQL creating an ANN index on a table's embedding column
+
+    Parameters
+    ----------
+    table_name : str
+        The table to index
+    method : str, optional
+        Either "hnsw" or "ivfflat", by default "hnsw"
+    m : int, optional
+        HNSW: maximum number of connections per layer, by default 16
+    ef_construction : int, optional
+        HNSW: size of the candidate list while building, by default 64
+    lists : int, optional
+        IVFFlat: number of inverted lists, by default 100
+    quantization : str, optional
+        Index a compact representation of the embeddings ("halfvec" or
+        "binary") instead of the float32 vectors, see `quantized_expression`
+
+    Notes
+    -----
+    The index uses the cosine operator class since all lookups order by
+    cosine distance.
+
+    """
+    if method == HNSW:
+        options = f"m = {int(m)}, ef_construction = {int(ef_construction)}"
+    elif method == IVFFLAT:
+        options = f"lists = {int(lists)}"
+    else:
+        raise ValueError(
+            f"Unknown index method {method}, must be one of {INDEX_METHODS}"
+        )
+    expression, operator_class = "embedding", "vector_cosine_ops"
+    if quantization is not None:
+        expression, operator_class = quantized_expression(
+            quantization, embedding_dimension(table_name)
+        )
+    return (
+        f"CREATE INDEX IF NOT EXISTS "
+        f"{vector_index_name(table_name, method, quantization)} "
+        f"ON {table_name} USING {method} ({expression} {operator_class}) "
+        f"WITH ({options})"
+    )
+
+
+def create_vector_index(
+    engine: Engine,
+    table_name: str,
+    method: str = HNSW,
+    m: int = 16,
+    ef_construction: int = 64,
+    lists: int = 100,
+    maintenance_work_mem: Optional[str] = None,
+    quantization: Optional[str] = None,
+):
+    """Create an ANN index on a table's embedding column
+
+    `maintenance_work_mem` (e.g. "2GB") speeds up building large HNSW indices
+    if the graph fits in it.
+
+    """
+    sql = create_vector_index_sql(
+        table_name,
+        method=method,
+        m=m,
+        ef_construction=ef_construction,
+        lists=lists,
+        quantization=quantization,
+    )
+    index_name = vector_index_name(table_name, method, quantization)
+    logger.info(sql)
+    start = time.perf_counter()
+    with engine.begin() as conn:
+        if maintenance_work_mem is not None:
+            conn.execute(
+                text("SELECT set_config('maintenance_work_mem', :value, true)"),
+                dict(value=maintenance_work_mem),
+            )
+        conn.execute(text(sql))
+    logger.info(f"Created {index_name} in {time.perf_counter() - start:.1f}s")
+
+
+def drop_vector_index(
+    engine: Engine,
+    table_name: str,
+    method: str = HNSW,
+    quantization: Optional[str] = None,
+):
+    """Drop the ANN index of a table's embedding column"""
+    index_name = vector_index_name(table_name, method, quantization)
+    with engine.begin() as conn:
+        conn.execute(text(f"DROP INDEX IF EXISTS {index_name}"))
+    logger.info(f"Dropped {index_name}")
+
+
+def rebuild_vector_index(
+    engine: Engine,
+    table_name: str,
+    method: str = HNSW,
+    quantization: Optional[str] = None,
+    **kwargs,
+):
+    """Drop and recreate an ANN index, e.g. with new parameters or after a bulk load"""
+    drop_vector_index(engine, table_name, method=method, quantization=quantization)
+    create_vector_index(
+        engine, table_name, method=method, quantization=quantization, **kwargs
+    )
+
+
+def set_search_parameters(
+    conn: Connection,
+    ef_search: Optional[int] = None,
+    probes: Optional[int] = None,
+    local: bool = False,
+):
+    """Set the ANN search parameters of a connection
+
+    Parameters
+    ----------
+    conn : Connection
+        The connection
+    ef_search : int, optional
+        HNSW: size of the candidate list while searching (pgvector default 40)
+    probes : int, optional
+        IVFFlat: number of lists probed (pgvector default 1)
+    local : bool, optional
+        Only apply the parameters to the current transaction
+
+    """
+    settings = {"hnsw.ef_search": ef_search, "ivfflat.probes": probes}
+    for name, value in settings.items():
+        if value is None:
+            continue
+        conn.execute(
+            text("SELECT set_config(:name, :value, :local)"),
+            dict(name=name, value=str(int(value)), local=local),
+        )
+
+
+def nearest_ids_sql(
+    table_name: str,
+    quantization: Optional[str] = None,
+    cosine_distance_cutoff: Optional[float] = None,
+) -> str:
+    """SQL of the ids of the `:k` rows closest to `:embedding`
+
+    With a quantization, the `:candidates` rows closest in the compact
+    representation are read from its index, then reranked by their exact
+    cosine distance. With a cutoff, only rows further than `:cutoff` are
+    searched, like the ingredient matching does (see
+    `chao_fan.integrations.recipe_scrapers.estimate_ingredient_prices`).
+
+    """
+    where = ""
+    if cosine_distance_cutoff is not None:
+        where = "WHERE embedding <=> CAST(:embedding AS vector) > :cutoff"
+    if quantization is None:
+        return f"""
+            SELECT id FROM {table_name}
+            {where}
+            ORDER BY embedding <=> CAST(:embedding AS vector)
+            LIMIT :k
+            """
+    dimension = embedding_dimension(table_name)
+    expression, _ = quantized_expression(quantization, dimension)
+    if quantization == HALFVEC:
+        query = f"CAST(:embedding AS halfvec({dimension}))"
+        operator = "<=>"
+    else:
+        query = f"binary_quantize(CAST(:embedding AS vector({dimension})))::bit({dimension})"
+        operator = "<~>"
+    return f"""
+        SELECT id FROM (
+            SELECT id, embedding FROM {table_name}
+            {where}
+            ORDER BY {expression} {operator} {query}
+            LIMIT :candidates
+        ) AS candidates
+        ORDER BY embedding <=> CAST(:embedding AS vector)
+        LIMIT :k
+        """
+
+
+def _nearest_ids(
+    conn: Connection,
+    table_name: str,
+    embedding: str,
+    k: int,
+    quantization: Optional[str] = None,
+    candidates: Optional[int] = None,
+    cosine_distance_cutoff: Optional[float] = None,
+) -> List[int]:
+    result = conn.execute(
+        text(nearest_ids_sql(table_name, quantization, cosine_distance_cutoff)),
+        dict(
+            embedding=embedding,
+            k=k,
+            candidates=candidates or k,
+            cutoff=cosine_distance_cutoff,
+        ),
+    )
+    return [row[0] for row in result]
+
+
+def vector_index_recall(
+    engine: Engine,
+    table_name: str,
+    n_queries: int = 50,
+    k: int = 10,
+    ef_search_values: Optional[List[int]] = None,
+    probes_values: Optional[List[int]] = None,
+    quantization: Optional[str] = None,
+    candidates_values: Optional[List[int]] = None,
+    cosine_distance_cutoff: Optional[float] = None,
+) -> List[Dict[str, float]]:
+    """Measure recall and latency of the ANN index against exact search
+
+    Parameters
+    ----------
+    engine : Engine
+        The sqlalchemy engine
+    table_name : str
+        The table whose index is evaluated
+    n_queries : int, optional
+        Number of embeddings sampled from the table and used as queries
+    k : int, optional
+        Number of neighbours retrieved per query
+    ef_search_values : List[int], optional
+        HNSW ef_search values to evaluate
+    probes_values : List[int], optional
+        IVFFlat probes values to evaluate
+    quantization : str, optional
+        Evaluate the index of this compact representation, with exact reranking
+        of its candidates, see `nearest_ids_sql`
+    candidates_values : List[int], optional
+        Numbers of candidates reranked to evaluate, by default 4k. HNSW returns
+        at most ef_search candidates, unless iterative scans are enabled
+        (`HNSW_ITERATIVE_SCAN`, see `chao_fan.db`).
+    cosine_distance_cutoff : float, optional
+        Only search rows further than this from the query, as the ingredient
+        matching does. The index is then measured on the query it serves,
+        where most of the nearest rows are filtered out.
+
+    Returns
+    -------
+    List[Dict[str, float]]
+        One row per setting with the mean recall@k and the mean latency in ms.
+        The first row is the exact search.
+
+    """
+    settings = [dict(ef_search=ef_search) for ef_search in ef_search_values or []]
+    settings += [dict(probes=probes) for probes in probes_values or []]
+    if quantization is not None:
+        settings = [
+            dict(setting, candidates=candidates)
+            for setting in settings or [{}]
+            for candidates in candidates_values or [4 * k]
+        ]
+    with engine.connect() as conn:
+        queries = [
+            row[0]
+            for row in conn.execute(
+                text(
+                    f"""
+                    SELECT CAST(embedding AS text) FROM {table_name}
+                    WHERE embedding IS NOT NULL
+                    ORDER BY random() LIMIT :n_queries
+                    """
+                ),
+                dict(n_queries=n_queries),
+            )
+        ]
+        conn.rollback()
+        if len(queries) == 0:
+            return []
+
+        # Exact search: disable index scans so the planner does a sequential scan
+        with conn.begin():
+            conn.execute(text("SET LOCAL enable_indexscan = off"))
+            start = time.perf_counter()
+            exact = [
+                _nearest_ids(
+                    conn,
+                    table_name,
+                    q,
+                    k,
+                    cosine_distance_cutoff=cosine_distance_cutoff,
+                )
+                for q in queries
+            ]
+            exact_latency = (time.perf_counter() - start) / len(queries)
+        report = [dict(setting="exact", recall=1.0, latency_ms=1000 * exact_latency)]
+
+        for setting in settings:
+            parameters = {
+                name: value for name, value in setting.items() if name != "candidates"
+            }
+            with conn.begin():
+                set_search_parameters(conn, local=True, **parameters)
+                start = time.perf_counter()
+                approximate = [
+                    _nearest_ids(
+                        conn,
+                        table_name,
+                        q,
+                        k,
+                        quantization=quantization,
+                        candidates=setting.get("candidates"),
+                        cosine_distance_cutoff=cosine_distance_cutoff,
+                    )
+                    for q in queries
+                ]
+                latency = (time.perf_counter() - start) / len(queries)
+            recalls = [
+                len(set(a) & set(e)) / len(e) for a, e in zip(approximate, exact) if e
+            ]
+            report.append(
+                dict(
+                    setting=" ".join(
+                        f"{name}={value}" for name, value in setting.items()
+                    ),
+                    recall=sum(recalls) / len(recalls),
+                    latency_ms=1000 * latency,
+                )
+            )
+    return report
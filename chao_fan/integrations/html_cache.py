@@ -0,0 +1,140 @@
+"""
+On-disk cache of downloaded recipe pages
+"""
+
+import logging
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from dataclasses import dataclass
+from typing import Optional
+
+from chao_fan.utils import canonicalize_url
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class CachedPage:
+    content: bytes
+    etag: Optional[str] = None
+    last_modified: Optional[str] = None
+
+
+class HtmlCache:
+    """Compressed pages keyed by canonical URL, with their validators
+
+    Pages are stored zlib-compressed in a SQLite file in `directory`, together
+    with their ETag and Last-Modified headers so that they can be revalidated
+    with conditional requests. Once the compressed pages exceed `max_bytes`,
+    the least recently used ones are evicted.
+
+    Parameters
+    ----------
+    directory : str
+        Directory of the cache, created if needed
+    max_bytes : int, optional
+        Maximum size of the compressed pages, by default 1GB
+    cache_only : bool, optional
+        Never hit the network: pages missing from the cache are failures
+
+    """
+
+    def __init__(
+        self, directory: str, max_bytes: int = 1024**3, cache_only: bool = False
+    ) -> None:
+        os.makedirs(directory, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.cache_only = cache_only
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(
+            os.path.join(directory, "pages.sqlite"), check_same_thread=False
+        )
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS pages (
+                url TEXT PRIMARY KEY,
+                content BLOB NOT NULL,
+                size INTEGER NOT NULL,
+                etag TEXT,
+                last_modified TEXT,
+                last_used REAL NOT NULL
+            )
+            """
+        )
+        self._db.execute(
+            "CREATE INDEX IF NOT EXISTS pages_last_used ON pages (last_used)"
+        )
+        self._db.commit()
+
+    def get(self, url: str) -> Optional[CachedPage]:
+        """The cached page of `url`, if any"""
+        key = canonicalize_url(url)
+        with self._lock:
+            row = self._db.execute(
+                "SELECT content, etag, last_modified FROM pages WHERE url = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            self._db.execute(
+                "UPDATE pages SET last_used = ? WHERE url = ?", (time.time(), key)
+            )
+            self._db.commit()
+        content, etag, last_modified = row
+        return CachedPage(zlib.decompress(content), etag, last_modified)
+
+    def put(
+        self,
+        url: str,
+        content: bytes,
+        etag: Optional[str] = None,
+        last_modified: Optional[str] = None,
+    ) -> None:
+        """Store the page of `url`, evicting old pages if the cache is full"""
+        compressed = zlib.compress(content)
+        with self._lock:
+            self._db.execute(
+                """
+                INSERT OR REPLACE INTO pages
+                (url, content, size, etag, last_modified, last_used)
+                VALUES (?, ?, ?, ?, ?, ?)
+                """,
+                (
+                    canonicalize_url(url),
+                    compressed,
+                    len(compressed),
+                    etag,
+                    last_modified,
+                    time.time(),
+                ),
+            )
+            self._evict()
+            self._db.commit()
+
+    @property
+    def size(self) -> int:
+        """Total size of the compressed pages in bytes"""
+        with self._lock:
+            return self._total_size()
+
+    def _total_size(self) -> int:
+        (total,) = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM pages")
+        return total[0]
+
+    def _evict(self) -> None:
+        total = self._total_size()
+        if total <= self.max_bytes:
+            return
+        evicted = []
+        for url, size in self._db.execute(
+            "SELECT url, size FROM pages ORDER BY last_used"
+        ).fetchall():
+            if total <= self.max_bytes:
+                break
+            evicted.append((url,))
+            total -= size
+        self._db.executemany("DELETE FROM pages WHERE url = ?", evicted)
+        logger.debug(f"Evicted {len(evicted)} pages from the HTML cache")
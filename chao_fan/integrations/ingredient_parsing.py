@@ -0,0 +1,259 @@
+"""
+Memoized parsing of ingredient lines with ingredient_parser
+"""
+
+import logging
+import math
+import multiprocessing
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from importlib.metadata import PackageNotFoundError, version
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.engine import Engine
+from sqlmodel import Session, select
+
+from chao_fan.models import IngredientParse
+
+logger = logging.getLogger(__name__)
+
+try:
+    PARSER_VERSION = version("ingredient-parser-nlp")
+except PackageNotFoundError:
+    PARSER_VERSION = "unknown"
+
+
+class ParsedLine(NamedTuple):
+    """Parser output for an ingredient line
+
+    `description` is None if the parser could not parse the line.
+    """
+
+    description: Optional[str]
+    amount: Optional[float] = None
+    unit: Optional[str] = None
+
+
+def normalize_line(line: str) -> str:
+    """Normalize an ingredient line before it is used as a memoization key"""
+    return " ".join(line.split())
+
+
+def parse_line(line: str) -> ParsedLine:
+    """Parse an ingredient line without memoization"""
+    # Imported on first use, as it loads nltk
+    from ingredient_parser import parse_ingredient
+
+    parsed_ingredient = parse_ingredient(line)
+    if parsed_ingredient is None:
+        logger.debug(f"Could not parse: {line}")
+        return ParsedLine(None)
+    description = (
+        parsed_ingredient.name.text if parsed_ingredient.name is not None else None
+    )
+    if description is None:
+        description = line
+    if len(parsed_ingredient.amount) > 0:
+        try:
+            return ParsedLine(
+                description,
+                float(parsed_ingredient.amount[0].quantity),
+                str(parsed_ingredient.amount[0].unit),
+            )
+        except ValueError:
+            pass
+    return ParsedLine(description)
+
+
+def _init_parser_worker() -> None:
+    # Load the tagger and CRF model once per worker, not on its first chunk
+    try:
+        parse_line("1 cup water")
+    except Exception as e:
+        logger.warning(f"Could not load the ingredient parser models: {e}")
+
+
+def _parse_chunk(lines: List[str]) -> List[Tuple]:
+    # Plain tuples are cheaper to pickle back to the parent than ParsedLines
+    return [tuple(parse_line(line)) for line in lines]
+
+
+class IngredientParserPool:
+    """Parse ingredient lines in worker processes
+
+    Parsing is CPU bound and holds the GIL, so threads do not speed it up.
+    Lines are split into chunks parsed by a pool of processes, each loading
+    the parser models once.
+
+    Parameters
+    ----------
+    processes : int, optional
+        Number of worker processes, by default the number of CPUs
+    chunk_size : int, optional
+        Maximum number of lines sent to a worker at once, by default 256
+
+    """
+
+    def __init__(self, processes: Optional[int] = None, chunk_size: int = 256) -> None:
+        self.processes = processes or os.cpu_count() or 1
+        self.chunk_size = chunk_size
+        # Spawn rather than fork: the parent usually runs fetch and stage threads
+        self._executor = ProcessPoolExecutor(
+            max_workers=self.processes,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_parser_worker,
+        )
+
+    def parse(self, lines: List[str]) -> List[ParsedLine]:
+        """Parse lines without memoization, in the same order as `lines`"""
+        if len(lines) == 0:
+            return []
+        # Small inputs are still spread over all the workers
+        chunk_size = min(self.chunk_size, math.ceil(len(lines) / self.processes))
+        chunks = [lines[i : i + chunk_size] for i in range(0, len(lines), chunk_size)]
+        return [
+            ParsedLine(*result)
+            for results in self._executor.map(_parse_chunk, chunks)
+            for result in results
+        ]
+
+    def close(self) -> None:
+        self._executor.shutdown()
+
+    def __enter__(self) -> "IngredientParserPool":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+
+class IngredientParseStore:
+    """Parsed lines persisted in the IngredientParse table
+
+    Rows are keyed by the normalized line and the parser version, so upgrading
+    ingredient_parser starts from an empty store.
+    """
+
+    def __init__(self, engine: Engine, parser_version: str = PARSER_VERSION) -> None:
+        self.engine = engine
+        self.parser_version = parser_version
+
+    def get_many(self, lines: List[str]) -> Dict[str, ParsedLine]:
+        with Session(self.engine) as session:
+            rows = session.exec(
+                select(IngredientParse).where(
+                    IngredientParse.line.in_(lines),
+                    IngredientParse.parser_version == self.parser_version,
+                )
+            ).all()
+        return {
+            row.line: ParsedLine(row.description, row.amount, row.unit) for row in rows
+        }
+
+    def put_many(self, parsed: Dict[str, ParsedLine]) -> None:
+        if len(parsed) == 0:
+            return
+        statement = (
+            insert(IngredientParse)
+            .values(
+                [
+                    dict(
+                        line=line,
+                        parser_version=self.parser_version,
+                        description=result.description,
+                        amount=result.amount,
+                        unit=result.unit,
+                    )
+                    for line, result in parsed.items()
+                ]
+            )
+            # Another worker may have parsed the same line in the meantime
+            .on_conflict_do_nothing(index_elements=["line", "parser_version"])
+        )
+        with Session(self.engine) as session:
+            session.exec(statement)
+            session.commit()
+
+
+class _ParseMemo:
+    """Thread-safe LRU of parsed lines"""
+
+    def __init__(self, maxsize: int) -> None:
+        self.maxsize = maxsize
+        self._lines: OrderedDict[str, ParsedLine] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, line: str) -> Optional[ParsedLine]:
+        with self._lock:
+            result = self._lines.get(line)
+            if result is not None:
+                self._lines.move_to_end(line)
+            return result
+
+    def put(self, line: str, result: ParsedLine) -> None:
+        with self._lock:
+            self._lines[line] = result
+            self._lines.move_to_end(line)
+            while len(self._lines) > self.maxsize:
+                self._lines.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._lines.clear()
+
+
+_memo = _ParseMemo(int(os.environ.get("INGREDIENT_PARSE_CACHE_SIZE", 100000)))
+
+
+def parse_lines(
+    lines: List[str],
+    store: Optional[IngredientParseStore] = None,
+    pool: Optional[IngredientParserPool] = None,
+) -> List[ParsedLine]:
+    """Parse ingredient lines, reusing earlier results
+
+    Parameters
+    ----------
+    lines : List[str]
+        The ingredient lines
+    store : IngredientParseStore, optional
+        Persistent store consulted for lines missing from the in-process LRU,
+        and updated with newly parsed lines
+    pool : IngredientParserPool, optional
+        Process pool parsing the lines missing from the LRU and the store.
+        If None, they are parsed in the calling thread.
+
+    Returns
+    -------
+    List[ParsedLine]
+        The parsed lines, in the same order as `lines`
+
+    """
+    normalized = [normalize_line(line) for line in lines]
+    results: Dict[str, ParsedLine] = {}
+    for line in normalized:
+        result = _memo.get(line)
+        if result is not None:
+            results[line] = result
+    missing = [line for line in dict.fromkeys(normalized) if line not in results]
+
+    if store is not None and len(missing) > 0:
+        stored = store.get_many(missing)
+        for line, result in stored.items():
+            _memo.put(line, result)
+        results.update(stored)
+        missing = [line for line in missing if line not in stored]
+
+    if pool is not None:
+        parsed = dict(zip(missing, pool.parse(missing)))
+    else:
+        parsed = {line: parse_line(line) for line in missing}
+    for line, result in parsed.items():
+        _memo.put(line, result)
+    results.update(parsed)
+    if store is not None:
+        store.put_many(parsed)
+    return [results[line] for line in normalized]
@@ -1,23 +1,40 @@
+import logging
 from dataclasses import dataclass
-from typing import List, Optional
+from typing import (
+    TYPE_CHECKING,
+    Callable,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Set,
+    Tuple,
+)
 
-from py3pin.Pinterest import Pinterest
+if TYPE_CHECKING:
+    from py3pin.Pinterest import Pinterest
+
+logger = logging.getLogger(__name__)
 
 
 @dataclass
 class Pin:
     url: str
     site_name: str
+    id: Optional[str] = None
 
 
-def setup_pinterest(email: str, password: str, username: str) -> Pinterest:
+def setup_pinterest(email: str, password: str, username: str) -> "Pinterest":
     """Setup pinterest"""
+    # Imported here as it loads selenium
+    from py3pin.Pinterest import Pinterest
+
     pinterest = Pinterest(email=email, password=password, username=username)
     pinterest.login()
     return pinterest
 
 
-def get_pinterest_board_id(pinterest: Pinterest, name: str) -> Optional[str]:
+def get_pinterest_board_id(pinterest: "Pinterest", name: str) -> Optional[str]:
     """Get pinterest board id
 
     Parameters
@@ -41,7 +58,7 @@ def get_pinterest_board_id(pinterest: Pinterest, name: str) -> Optional[str]:
 
 
 def get_pin_links(
-    pinterest: Pinterest, board_id: str, return_unique: bool = True
+    pinterest: "Pinterest", board_id: str, return_unique: bool = True
 ) -> List[Pin]:
     """Get links pinterest board
 
@@ -59,14 +76,89 @@ def get_pin_links(
 
     """
     pins = pinterest.board_feed(board_id=board_id)
-    recipes = []
-    for pin_dict in pins:
-        if "rich_summary" in pin_dict and pin_dict["rich_summary"] is not None:
-            recipe_pin = Pin(
-                url=pin_dict["rich_summary"].get("url"),
-                site_name=pin_dict["rich_summary"].get("site_name"),
-            )
-            recipes.append(recipe_pin)
+    recipes = [pin for pin in map(pin_from_dict, pins) if pin is not None]
     if return_unique:
         recipes = list({recipe.url: recipe for recipe in recipes}.values())
     return recipes
+
+
+def pin_from_dict(pin_dict: dict) -> Optional[Pin]:
+    """The recipe link of a pin of the board feed, None for pins without one"""
+    if pin_dict.get("rich_summary") is None:
+        return None
+    return Pin(
+        url=pin_dict["rich_summary"].get("url"),
+        site_name=pin_dict["rich_summary"].get("site_name"),
+        id=pin_dict.get("id"),
+    )
+
+
+def board_pages(
+    pinterest: "Pinterest", board_id: str, page_size: int = 50
+) -> Iterator[List[dict]]:
+    """Yield the pages of a board feed, newest pins first
+
+    Pages are only requested as they are consumed, so a caller that stops
+    early does not download the rest of the board.
+
+    """
+    # Start from the top even if this Pinterest object already read the board
+    reset_bookmark = True
+    while True:
+        page = pinterest.board_feed(
+            board_id=board_id, page_size=page_size, reset_bookmark=reset_bookmark
+        )
+        reset_bookmark = False
+        if len(page) == 0:
+            return
+        yield page
+
+
+def get_new_pins(
+    pages: Iterable[List[dict]],
+    known_urls: Callable[[List[str]], Set[str]],
+    last_pin_id: Optional[str] = None,
+) -> Tuple[List[Pin], Optional[str]]:
+    """Pins added to a board since the last sync
+
+    Reads the pages newest-first and stops at the newest pin of the last sync
+    (`last_pin_id`), or after a page whose links are all known already, e.g.
+    when that pin was removed from the board. The work therefore depends on the
+    number of new pins, not on the size of the board.
+
+    Parameters
+    ----------
+    pages : Iterable[List[dict]]
+        Pages of the board feed, see `board_pages`
+    known_urls : Callable[[List[str]], Set[str]]
+        Returns which of the urls are already known (e.g. in the recipe table)
+    last_pin_id : str, optional
+        The watermark of the last sync. If None, stop at the first known page.
+
+    Returns
+    -------
+    Tuple[List[Pin], Optional[str]]
+        The new pins with unknown links, newest first and unique by url, and the
+        new watermark (the id of the newest pin of the board)
+
+    """
+    new_pins = {}
+    newest_pin_id = None
+    n_pages = 0
+    for page in pages:
+        n_pages += 1
+        if newest_pin_id is None:
+            newest_pin_id = page[0].get("id")
+        ids = [pin_dict.get("id") for pin_dict in page]
+        reached_watermark = last_pin_id is not None and last_pin_id in ids
+        if reached_watermark:
+            page = page[: ids.index(last_pin_id)]
+        pins = [pin for pin in map(pin_from_dict, page) if pin is not None]
+        known = known_urls([pin.url for pin in pins]) if pins else set()
+        for pin in pins:
+            if pin.url not in known:
+                new_pins.setdefault(pin.url, pin)
+        if reached_watermark or (pins and all(pin.url in known for pin in pins)):
+            break
+    logger.info(f"Read {n_pages} pages of the board, {len(new_pins)} new pins")
+    return list(new_pins.values()), newest_pin_id or last_pin_id
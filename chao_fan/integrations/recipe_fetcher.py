@@ -0,0 +1,123 @@
+"""
+Concurrent, per-host rate limited download of recipe pages
+"""
+
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterator, List, Optional, Tuple
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from chao_fan.integrations.html_cache import HtmlCache
+
+logger = logging.getLogger(__name__)
+
+
+class CacheMiss(requests.RequestException):
+    """A page is missing from a cache-only HTML cache"""
+
+
+class RecipeFetcher:
+    """Download recipe pages with pooled connections and per-host limits
+
+    Parameters
+    ----------
+    max_per_host : int, optional
+        Maximum number of concurrent requests to the same host, by default 2
+    timeout : float, optional
+        Timeout of each request in seconds, by default 30
+    cache : HtmlCache, optional
+        Cache of previously downloaded pages. Cached pages are revalidated with
+        conditional requests, or returned as is if the cache is cache-only.
+
+    Notes
+    -----
+    Each host gets its own `requests.Session`, so connections are kept alive
+    between recipes of the same site.
+
+    """
+
+    def __init__(
+        self,
+        max_per_host: int = 2,
+        timeout: float = 30,
+        cache: Optional[HtmlCache] = None,
+    ) -> None:
+        self.max_per_host = max_per_host
+        self.timeout = timeout
+        self.cache = cache
+        self._sessions: Dict[str, requests.Session] = {}
+        self._semaphores: Dict[str, threading.Semaphore] = {}
+        self._lock = threading.Lock()
+
+    def _host(self, host: str) -> Tuple[requests.Session, threading.Semaphore]:
+        with self._lock:
+            if host not in self._sessions:
+                # Imported here as recipe_scrapers loads every site's scraper
+                from recipe_scrapers._abstract import HEADERS
+
+                session = requests.Session()
+                session.headers.update(HEADERS)
+                adapter = HTTPAdapter(pool_maxsize=self.max_per_host)
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                self._sessions[host] = session
+                self._semaphores[host] = threading.Semaphore(self.max_per_host)
+            return self._sessions[host], self._semaphores[host]
+
+    def fetch(self, url: str) -> bytes:
+        """Download a page, raising `requests.RequestException` on failure"""
+        cached = self.cache.get(url) if self.cache is not None else None
+        if self.cache is not None and self.cache.cache_only:
+            if cached is None:
+                raise CacheMiss(f"{url} is not in the HTML cache")
+            return cached.content
+
+        headers = {}
+        if cached is not None and cached.etag is not None:
+            headers["If-None-Match"] = cached.etag
+        if cached is not None and cached.last_modified is not None:
+            headers["If-Modified-Since"] = cached.last_modified
+        session, semaphore = self._host(urlsplit(url).netloc)
+        with semaphore:
+            response = session.get(url, headers=headers, timeout=self.timeout)
+        if cached is not None and response.status_code == 304:
+            return cached.content
+        response.raise_for_status()
+        if self.cache is not None:
+            self.cache.put(
+                url,
+                response.content,
+                etag=response.headers.get("ETag"),
+                last_modified=response.headers.get("Last-Modified"),
+            )
+        return response.content
+
+    def fetch_many(
+        self, urls: List[str], max_workers: int = 8
+    ) -> Iterator[Tuple[str, bytes | Exception]]:
+        """Download pages concurrently
+
+        Yields
+        ------
+        Tuple[str, bytes | Exception]
+            Each url with its page, or the exception raised while downloading it,
+            in the same order as `urls`
+
+        """
+
+        def fetch(url: str) -> bytes | Exception:
+            try:
+                return self.fetch(url)
+            except requests.RequestException as e:
+                return e
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            yield from zip(urls, executor.map(fetch, urls))
+
+    def close(self) -> None:
+        for session in self._sessions.values():
+            session.close()
@@ -1,17 +1,28 @@
 import logging
 import os
+from collections import defaultdict
+from dataclasses import dataclass, field
 from datetime import datetime
-from typing import List, Optional
+from typing import Dict, List, Optional
 
-import nltk
-from ingredient_parser import parse_ingredient
-from recipe_scrapers import WebsiteNotImplementedError, scrape_me
-from recipe_scrapers._exceptions import NoSchemaFoundInWildMode, SchemaOrgException
 from requests.exceptions import ConnectionError
+from sqlalchemy import ARRAY, Integer, bindparam, func, true
+from sqlalchemy.orm import aliased
 from sqlmodel import Session, select
 from urllib3.exceptions import HTTPError
 
-from chao_fan.integrations.sentence_transformer import generate_embeddings
+from chao_fan.embedding_backfill import content_hash
+from chao_fan.embedding_cache import get_embedding_cache
+from chao_fan.indexes import quantized_distance
+from chao_fan.integrations.ingredient_parsing import (
+    IngredientParserPool,
+    IngredientParseStore,
+    parse_lines,
+)
+from chao_fan.integrations.sentence_transformer import (
+    embedding_model_id,
+    generate_embeddings,
+)
 from chao_fan.models import (
     IngredientNutrition,
     IngredientPrice,
@@ -19,6 +30,7 @@ from chao_fan.models import (
     Recipe,
     RecipeIngredient,
 )
+from chao_fan.vector_index import IngredientVectorIndex
 
 logger = logging.getLogger(__name__)
 
@@ -28,6 +40,13 @@ INGREDIENT_PRICE_COSINE_DISTANCE_CUTOFF = float(
 INGREDIENT_NUTRITION_COSINE_DISTANCE_CUTOFF = float(
     os.environ.get("INGREDIENT_NUTRITION_COSINE_DISTANCE_CUTOFF", 0.8)
 )
+INGREDIENT_EMBEDDING_BATCH_SIZE = int(
+    os.environ.get("INGREDIENT_EMBEDDING_BATCH_SIZE", 64)
+)
+# "halfvec" or "binary" to match ingredients with a quantized index, see
+# chao_fan.indexes.quantized_expression
+VECTOR_QUANTIZATION = os.environ.get("VECTOR_QUANTIZATION")
+VECTOR_RERANK_CANDIDATES = int(os.environ.get("VECTOR_RERANK_CANDIDATES", 40))
 
 
 def create_instructions(
@@ -44,6 +63,8 @@ def create_instructions(
 
 
 def download_nltk_model():
+    import nltk
+
     nltk.download("averaged_perceptron_tagger")
 
 
@@ -118,150 +139,583 @@ def estimate_ingredient_nutrition(
     return results[0]
 
 
-def create_ingredients(
-    ingredients_txt: List[str], embedding_model=None, session: Session | None = None
-) -> List[RecipeIngredient]:
-    """Create ingredients from a list of strings"""
-    parsed_ingredients = []
-    for ingredient_txt in ingredients_txt:
-        if ingredient_txt is None:
-            continue
-        # Create ingredient
-        ingredient = RecipeIngredient(full_description=ingredient_txt)
-
-        # Try to parse using ingredient parser
-        parsed_ingredient = parse_ingredient(ingredient_txt)
-        if parsed_ingredient is None:
-            ingredient.name = ingredient_txt
-            parsed_ingredients.append(ingredient)
-            logger.debug("Could not parse: {}")
-            continue
+def _embedding_queries(ingredients: List[RecipeIngredient], vector_type):
+    """Subquery with one (idx, embedding) row per embedded ingredient"""
+    idxs, embeddings = [], []
+    for idx, ingredient in enumerate(ingredients):
+        if ingredient.embedding is not None:
+            idxs.append(idx)
+            embeddings.append(ingredient.embedding)
+    if len(idxs) == 0:
+        return None
+    return select(
+        func.unnest(bindparam("idxs", idxs, type_=ARRAY(Integer))).label("idx"),
+        # dimensions=1 binds each embedding as one vector, not as a nested array
+        func.unnest(
+            bindparam("embeddings", embeddings, type_=ARRAY(vector_type, dimensions=1))
+        ).label("embedding"),
+    ).subquery("queries")
+
+
+def _search_source(
+    ingredient_model,
+    queries,
+    quantization: str | None = None,
+    candidates: int = VECTOR_RERANK_CANDIDATES,
+    cosine_distance_cutoff: float | None = None,
+):
+    """Rows searched for the nearest neighbours of each query embedding
+
+    With a quantization, only the `candidates` rows closest in the compact
+    representation are searched (and thus reranked by their exact distance),
+    otherwise the whole table. The candidates are taken among the rows passing
+    the `cosine_distance_cutoff` of the match, as the exact search does, rather
+    than filtered afterwards: the rows closest to the query are mostly within
+    the cutoff, so filtering the candidates would leave few or no matches.
 
-        # Parse name
-        ingredient.description = (
-            parsed_ingredient.name.text if parsed_ingredient.name is not None else None
+    """
+    if quantization is None:
+        return ingredient_model
+    embedding = ingredient_model.embedding
+    distance = quantized_distance(
+        embedding, queries.c.embedding, quantization, int(embedding.type.dim)
+    )
+    nearest = select(ingredient_model).correlate(queries)
+    if cosine_distance_cutoff is not None:
+        nearest = nearest.where(
+            embedding.cosine_distance(queries.c.embedding) > cosine_distance_cutoff
         )
-        if ingredient.description is None:
-            ingredient.description = ingredient_txt
-        if len(parsed_ingredient.amount) > 0:
-            try:
-                ingredient.amount = float(parsed_ingredient.amount[0].quantity)
-                ingredient.unit = str(parsed_ingredient.amount[0].unit)
-            except ValueError:
-                pass
-
-        # Embedding
-        if embedding_model is not None:
-            ingredient.embedding = generate_embeddings(
-                ingredient.description,
-                model=embedding_model,
-                show_progress_bar=False,
-            )
+    nearest = nearest.order_by(distance).limit(candidates).lateral("candidates")
+    return aliased(ingredient_model, nearest)
+
+
+def _search_index(
+    ingredients: List[RecipeIngredient],
+    index: IngredientVectorIndex,
+    k: int,
+    cosine_distance_cutoff: float,
+):
+    """Yield (idx, row positions) for ingredients with at least one match"""
+    idxs = [
+        idx
+        for idx, ingredient in enumerate(ingredients)
+        if ingredient.embedding is not None
+    ]
+    if len(idxs) == 0:
+        return
+    positions, _ = index.search(
+        [ingredients[idx].embedding for idx in idxs],
+        k=k,
+        cosine_distance_cutoff=cosine_distance_cutoff,
+    )
+    for idx, row_positions in zip(idxs, positions):
+        row_positions = row_positions[row_positions >= 0]
+        if len(row_positions) > 0:
+            yield idx, row_positions
+
+
+def estimate_ingredient_prices(
+    ingredients: List[RecipeIngredient],
+    session: Session,
+    cosine_distance_cutoff: float = 0.6,
+    number_to_average: int = 5,
+    index: IngredientVectorIndex | None = None,
+    quantization: str | None = None,
+    candidates: int = VECTOR_RERANK_CANDIDATES,
+) -> List[float | None]:
+    """Estimate the price of many ingredients with a single query
+
+    Parameters
+    ----------
+    ingredients : List[RecipeIngredient]
+        The ingredients to estimate the price of
+    session : Session
+        The database session
+    cosine_distance_cutoff : float, optional
+        The cosine distance cutoff below which we return None, by default 0.6
+    number_to_average : int, optional
+        The number of ingredients to average, by default 5
+    index : IngredientVectorIndex, optional
+        An in-memory index of IngredientPrice with the price as payload. If passed,
+        the matching is done in process instead of in the database.
+    quantization : str, optional
+        "halfvec" or "binary": take the `candidates` nearest rows in that
+        representation (from its index), then rerank them by exact distance
+    candidates : int, optional
+        Number of candidates reranked per ingredient
+
+    Returns
+    -------
+    List[float | None]
+        The estimated price of each ingredient, in the same order as `ingredients`
+
+    Notes
+    -----
+    Same semantics as `estimate_ingredient_price`, but all embeddings are sent as
+    one array and matched with a LATERAL join instead of one query per ingredient.
+
+    """
+    prices: List[float | None] = [None] * len(ingredients)
+    if index is not None:
+        for idx, positions in _search_index(
+            ingredients, index, number_to_average, cosine_distance_cutoff
+        ):
+            prices[idx] = float(index.payload[positions].sum()) / number_to_average
+        return prices
+    queries = _embedding_queries(ingredients, IngredientPrice.embedding.type)
+    if queries is None:
+        return prices
+    source = _search_source(
+        IngredientPrice, queries, quantization, candidates, cosine_distance_cutoff
+    )
+    distance = source.embedding.cosine_distance(queries.c.embedding)
+    matches = (
+        select(source.price_100grams)
+        .where(distance > cosine_distance_cutoff)
+        .order_by(distance)
+        .limit(number_to_average)
+        .lateral("matches")
+    )
+    statement = select(queries.c.idx, matches.c.price_100grams).join(matches, true())
+    matched_prices: Dict[int, List[float]] = defaultdict(list)
+    for idx, price in session.exec(statement).all():
+        matched_prices[idx].append(price)
+    for idx, ingredient_prices in matched_prices.items():
+        prices[idx] = sum(ingredient_prices) / number_to_average
+    return prices
+
+
+def estimate_ingredient_nutritions(
+    ingredients: List[RecipeIngredient],
+    session: Session,
+    cosine_distance_cutoff: float = 0.6,
+    index: IngredientVectorIndex | None = None,
+    quantization: str | None = None,
+    candidates: int = VECTOR_RERANK_CANDIDATES,
+) -> List[IngredientNutrition | None]:
+    """Find the closest nutrition entry of many ingredients with a single query
+
+    Same semantics as `estimate_ingredient_nutrition`, returned in the same order
+    as `ingredients`. If an in-memory `index` of IngredientNutrition is passed,
+    the matches are found in process and loaded with one query by id. The
+    `quantization` and `candidates` are as in `estimate_ingredient_prices`.
 
-        if session is not None and ingredient.embedding is not None:
-            # Estimate ingredient price
-            ingredient.estimated_price_100grams = estimate_ingredient_price(
-                ingredient,
-                session,
-                cosine_distance_cutoff=INGREDIENT_PRICE_COSINE_DISTANCE_CUTOFF,
+    """
+    nutritions: List[IngredientNutrition | None] = [None] * len(ingredients)
+    if index is not None:
+        matched_ids = {
+            idx: int(index.ids[positions[0]])
+            for idx, positions in _search_index(
+                ingredients, index, 1, cosine_distance_cutoff
+            )
+        }
+        if len(matched_ids) == 0:
+            return nutritions
+        rows = session.exec(
+            select(IngredientNutrition).where(
+                IngredientNutrition.id.in_(set(matched_ids.values()))
             )
+        ).all()
+        rows_by_id = {row.id: row for row in rows}
+        for idx, nutrition_id in matched_ids.items():
+            nutritions[idx] = rows_by_id.get(nutrition_id)
+        return nutritions
+    queries = _embedding_queries(ingredients, IngredientNutrition.embedding.type)
+    if queries is None:
+        return nutritions
+    source = _search_source(
+        IngredientNutrition, queries, quantization, candidates, cosine_distance_cutoff
+    )
+    distance = source.embedding.cosine_distance(queries.c.embedding)
+    matches = (
+        select(source)
+        .where(distance > cosine_distance_cutoff)
+        .order_by(distance)
+        .limit(1)
+        .lateral("matches")
+    )
+    nutrition = aliased(IngredientNutrition, matches)
+    statement = select(queries.c.idx, nutrition).join(nutrition, true())
+    for idx, ingredient_nutrition in session.exec(statement).all():
+        nutritions[idx] = ingredient_nutrition
+    return nutritions
+
+
+def parse_ingredients(
+    ingredients_txt: List[str],
+    parse_store: IngredientParseStore | None = None,
+    parser_pool: IngredientParserPool | None = None,
+) -> List[RecipeIngredient]:
+    """Parse ingredient strings into (unembedded) recipe ingredients
+
+    Parsing is memoized, see `chao_fan.integrations.ingredient_parsing.parse_lines`.
+    Lines the parser cannot handle keep their full text as description.
 
-            # Estimate ingredient nutrition
-            ingredient_nutrition = estimate_ingredient_nutrition(
-                ingredient,
-                session,
-                cosine_distance_cutoff=INGREDIENT_NUTRITION_COSINE_DISTANCE_CUTOFF,
+    """
+    ingredients_txt = [txt for txt in ingredients_txt if txt is not None]
+    parsed_lines = parse_lines(ingredients_txt, store=parse_store, pool=parser_pool)
+    parsed_ingredients = []
+    for ingredient_txt, parsed_line in zip(ingredients_txt, parsed_lines):
+        parsed_ingredients.append(
+            RecipeIngredient(
+                full_description=ingredient_txt,
+                description=parsed_line.description or ingredient_txt,
+                amount=parsed_line.amount,
+                unit=parsed_line.unit,
             )
-            if ingredient_nutrition:
-                ingredient.ingredient_nutrition = ingredient_nutrition
+        )
+    return parsed_ingredients
+
+
+def embed_ingredients(
+    ingredients: List[RecipeIngredient],
+    embedding_model,
+    batch_size: int = INGREDIENT_EMBEDDING_BATCH_SIZE,
+) -> List[RecipeIngredient]:
+    """Embed ingredient descriptions in fixed-size batches
+
+    Parameters
+    ----------
+    ingredients : List[RecipeIngredient]
+        The ingredients to embed. Ingredients without a description are skipped.
+    embedding_model : SentenceTransformer
+        The model used to generate the embeddings
+    batch_size : int, optional
+        The number of descriptions encoded per call to the model
+
+    Returns
+    -------
+    List[RecipeIngredient]
+        The same ingredients, with their embedding set
 
-        parsed_ingredients.append(ingredient)
+    Notes
+    -----
+    Encoding every description of a batch of recipes together avoids paying the
+    tokenizer and forward pass overhead once per ingredient.
+
+    """
+    to_embed = [
+        ingredient for ingredient in ingredients if ingredient.description is not None
+    ]
+    model_id = embedding_model_id()
+    cache = get_embedding_cache(model_id)
+    for start in range(0, len(to_embed), batch_size):
+        batch = to_embed[start : start + batch_size]
+        embeddings = generate_embeddings(
+            [ingredient.description for ingredient in batch],
+            model=embedding_model,
+            cache=cache,
+            batch_size=batch_size,
+            show_progress_bar=False,
+        )
+        for ingredient, embedding in zip(batch, embeddings):
+            ingredient.embedding = embedding
+            ingredient.embedding_model = model_id
+            ingredient.embedding_hash = content_hash(ingredient.description)
+    return ingredients
+
+
+def match_ingredients(
+    ingredients: List[RecipeIngredient],
+    session: Session,
+    price_index: IngredientVectorIndex | None = None,
+    nutrition_index: IngredientVectorIndex | None = None,
+    link_by_id: bool = False,
+) -> List[RecipeIngredient]:
+    """Estimate the price and nutrition of embedded ingredients in bulk
+
+    If in-memory indices are passed, they are used instead of the database
+    for the nearest neighbour search. With `link_by_id`, only the nutrition id
+    is set on the ingredients, for ingredients that will be persisted through
+    another session than `session`.
+
+    """
+    prices = estimate_ingredient_prices(
+        ingredients,
+        session,
+        cosine_distance_cutoff=INGREDIENT_PRICE_COSINE_DISTANCE_CUTOFF,
+        index=price_index,
+        quantization=VECTOR_QUANTIZATION,
+    )
+    nutritions = estimate_ingredient_nutritions(
+        ingredients,
+        session,
+        cosine_distance_cutoff=INGREDIENT_NUTRITION_COSINE_DISTANCE_CUTOFF,
+        index=nutrition_index,
+        quantization=VECTOR_QUANTIZATION,
+    )
+    for ingredient, price, nutrition in zip(ingredients, prices, nutritions):
+        if ingredient.embedding is None:
+            continue
+        ingredient.estimated_price_100grams = price
+        if nutrition and link_by_id:
+            ingredient.ingredient_nutrition_id = nutrition.id
+        elif nutrition:
+            ingredient.ingredient_nutrition = nutrition
+    return ingredients
+
+
+def create_ingredients(
+    ingredients_txt: List[str],
+    embedding_model=None,
+    session: Session | None = None,
+    parser_pool: IngredientParserPool | None = None,
+) -> List[RecipeIngredient]:
+    """Create ingredients from a list of strings"""
+    parsed_ingredients = parse_ingredients(ingredients_txt, parser_pool=parser_pool)
+    if embedding_model is not None:
+        embed_ingredients(parsed_ingredients, embedding_model)
+    if session is not None:
+        match_ingredients(parsed_ingredients, session)
     return parsed_ingredients
 
 
-def scrape_recipe(
-    recipe: Recipe,
+def enrich_ingredients(
+    recipes: List[Recipe],
+    embedding_model,
     session: Session | None = None,
-    embedding_model=None,
-) -> Recipe:
+    batch_size: int = INGREDIENT_EMBEDDING_BATCH_SIZE,
+    price_index: IngredientVectorIndex | None = None,
+    nutrition_index: IngredientVectorIndex | None = None,
+) -> List[Recipe]:
+    """Embed and match the ingredients of several scraped recipes at once
+
+    Parameters
+    ----------
+    recipes : List[Recipe]
+        Recipes that have been scraped without an embedding model
+    embedding_model : SentenceTransformer
+        The model used to generate the embeddings
+    session : Session, optional
+        The database session used to estimate price and nutrition
+    batch_size : int, optional
+        The number of descriptions encoded per call to the model
+    price_index : IngredientVectorIndex, optional
+        In-memory index of IngredientPrice used instead of the database
+    nutrition_index : IngredientVectorIndex, optional
+        In-memory index of IngredientNutrition used instead of the database
+
+    Returns
+    -------
+    List[Recipe]
+        The same recipes, with their ingredients enriched
+
     """
-    Scrape a recipe from a URL
+    ingredients = [
+        ingredient for recipe in recipes for ingredient in recipe.recipe_ingredients
+    ]
+    embed_ingredients(ingredients, embedding_model, batch_size=batch_size)
+    if session is not None:
+        match_ingredients(
+            ingredients,
+            session,
+            price_index=price_index,
+            nutrition_index=nutrition_index,
+        )
+    return recipes
+
+
+@dataclass
+class ScrapedRecipe:
+    """Fields extracted from a recipe page, not yet attached to a Recipe"""
+
+    title: Optional[str] = None
+    instructions: List[Instruction] = field(default_factory=list)
+    ingredient_lines: List[str] = field(default_factory=list)
+    ingredients: List[RecipeIngredient] = field(default_factory=list)
+    ready_in_minutes: Optional[int] = None
+    image: Optional[str] = None
+
+
+def extract_recipe(
+    url: str,
+    html: bytes | str | None = None,
+    parse_store: IngredientParseStore | None = None,
+    parser_pool: IngredientParserPool | None = None,
+    parse_ingredient_lines: bool = True,
+) -> Optional[ScrapedRecipe]:
+    """
+    Extract a recipe from its page
 
     Parameters
     ----------
     url : str
         The URL of the recipe
-
+    html : bytes | str, optional
+        The already downloaded page of the recipe. If None, the page is
+        downloaded from `url`.
+    parse_store : IngredientParseStore, optional
+        Persistent store of parsed ingredient lines
+    parser_pool : IngredientParserPool, optional
+        Process pool parsing the ingredient lines
+    parse_ingredient_lines : bool, optional
+        If False, only the ingredient lines are extracted, to be parsed
+        together with those of other recipes by `parse_scraped_ingredients`
 
     Returns
     -------
-    Recipe
-        The scraped recipe
+    Optional[ScrapedRecipe]
+        The extracted recipe, or None if it could not be scraped
+
+    Notes
+    -----
+    This does not touch the database, so it can run outside the thread that
+    owns the session.
 
     """
+    # Imported here as recipe_scrapers loads every site's scraper
+    from recipe_scrapers import WebsiteNotImplementedError, scrape_html, scrape_me
+    from recipe_scrapers._exceptions import NoSchemaFoundInWildMode, SchemaOrgException
+
     scraper = None
     wild_mode = False
     tries = 0
-    recipe.enrichment_failed_at = datetime.now()
     while not scraper and tries < 3:
         try:
-            scraper = scrape_me(recipe.source_url, wild_mode=wild_mode)
+            if html is None:
+                scraper = scrape_me(url, wild_mode=wild_mode)
+            else:
+                scraper = scrape_html(html, org_url=url, wild_mode=wild_mode)
             tries += 1
         except WebsiteNotImplementedError:
             wild_mode = True
         except NoSchemaFoundInWildMode as e:
             logger.error(e)
-            return recipe
+            return None
         except HTTPError as e:
             logger.error(e)
-            return recipe
+            return None
         except ConnectionError as e:
             logger.error(e)
-            return recipe
+            return None
     if scraper is None:
-        return recipe
+        return None
 
+    scraped = ScrapedRecipe()
     try:
-        recipe.title = scraper.title()
+        scraped.title = scraper.title()
         instructions_text = scraper.instructions()
         instructions_list = scraper.instructions_list()
     except SchemaOrgException as e:
         logger.error(e)
-        return recipe
+        return None
     except TypeError as e:
         logger.error(e)
-        return recipe
+        return None
 
     # Instructions
     if instructions_text:
-        instructions = create_instructions(instructions_text, instructions_list)
-        if len(instructions) > 0:
-            recipe.instructions = instructions
+        scraped.instructions = create_instructions(instructions_text, instructions_list)
 
     # Ingredients
-    ingredients = create_ingredients(
-        scraper.ingredients(), embedding_model=embedding_model, session=session
-    )
-    if len(ingredients) > 0:
-        recipe.recipe_ingredients = ingredients
+    scraped.ingredient_lines = [
+        line for line in scraper.ingredients() if line is not None
+    ]
+    if parse_ingredient_lines:
+        parse_scraped_ingredients(
+            [scraped], parse_store=parse_store, parser_pool=parser_pool
+        )
 
     # Total time
     try:
         total_time = scraper.total_time()
         if total_time:
-            recipe.ready_in_minutes = total_time
+            scraped.ready_in_minutes = total_time
     except SchemaOrgException as e:
         logger.error(e)
 
     # Image
     try:
-        image = scraper.image()
+        scraped.image = scraper.image()
     except SchemaOrgException as e:
         logger.error(e)
-        image = None
-    if image:
-        recipe.image = image
+    return scraped
+
+
+def parse_scraped_ingredients(
+    scraped_recipes: List[Optional[ScrapedRecipe]],
+    parse_store: IngredientParseStore | None = None,
+    parser_pool: IngredientParserPool | None = None,
+) -> List[Optional[ScrapedRecipe]]:
+    """Parse the ingredient lines of several extracted recipes at once
 
+    All the lines are parsed by one `parse_ingredients` call, so a `parser_pool`
+    receives a batch of recipes' worth of lines instead of a dozen per call.
+    Recipes that could not be extracted (None) are skipped.
+
+    """
+    to_parse = [scraped for scraped in scraped_recipes if scraped is not None]
+    ingredients = parse_ingredients(
+        [line for scraped in to_parse for line in scraped.ingredient_lines],
+        parse_store=parse_store,
+        parser_pool=parser_pool,
+    )
+    start = 0
+    for scraped in to_parse:
+        end = start + len(scraped.ingredient_lines)
+        scraped.ingredients = ingredients[start:end]
+        start = end
+    return scraped_recipes
+
+
+def apply_scraped_recipe(recipe: Recipe, scraped: Optional[ScrapedRecipe]) -> Recipe:
+    """Copy an extracted recipe onto a Recipe and record the enrichment outcome"""
+    if scraped is None:
+        recipe.enrichment_failed_at = datetime.now()
+        return recipe
+    recipe.title = scraped.title
+    if len(scraped.instructions) > 0:
+        recipe.instructions = scraped.instructions
+    if len(scraped.ingredients) > 0:
+        recipe.recipe_ingredients = scraped.ingredients
+    if scraped.ready_in_minutes:
+        recipe.ready_in_minutes = scraped.ready_in_minutes
+    if scraped.image:
+        recipe.image = scraped.image
     recipe.enriched_at = datetime.now()
     recipe.enrichment_failed_at = None
     return recipe
+
+
+def scrape_recipe(
+    recipe: Recipe,
+    session: Session | None = None,
+    embedding_model=None,
+    html: bytes | str | None = None,
+    parse_store: IngredientParseStore | None = None,
+    parser_pool: IngredientParserPool | None = None,
+) -> Recipe:
+    """
+    Scrape a recipe from a URL
+
+    Parameters
+    ----------
+    recipe : Recipe
+        The recipe to scrape, using its source url
+    session : Session, optional
+        The database session used to estimate ingredient price and nutrition
+    embedding_model : SentenceTransformer, optional
+        The model used to embed the ingredients
+    html : bytes | str, optional
+        The already downloaded page of the recipe. If None, the page is
+        downloaded from the recipe's source url.
+    parse_store : IngredientParseStore, optional
+        Persistent store of parsed ingredient lines
+    parser_pool : IngredientParserPool, optional
+        Process pool parsing the ingredient lines
+
+    Returns
+    -------
+    Recipe
+        The scraped recipe
+
+    """
+    scraped = extract_recipe(
+        recipe.source_url, html=html, parse_store=parse_store, parser_pool=parser_pool
+    )
+    if scraped is not None:
+        if embedding_model is not None:
+            embed_ingredients(scraped.ingredients, embedding_model)
+        if session is not None:
+            match_ingredients(scraped.ingredients, session)
+    return apply_scraped_recipe(recipe, scraped)
@@ -2,27 +2,275 @@
 Integration with SQLite vector search
 """
 
+import inspect
 import logging
+import os
 from typing import List
 
 import numpy as np
-import torch
-from sentence_transformers import SentenceTransformer
+
+from chao_fan.embedding_cache import EmbeddingCache
+from chao_fan.embedding_service import EmbeddingClient
 
 logger = logging.getLogger(__name__)
 
+MODEL_NAME = "sentence-transformers/all-MiniLM-L6-v2"
+TORCH_BACKEND = "torch"
+ONNX_BACKEND = "onnx"
+ONNX_MODEL_FILE = "model.onnx"
+ONNX_QUANTIZED_MODEL_FILE = "model_int8.onnx"
+
+
+class OnnxSentenceEncoder:
+    """all-MiniLM-L6-v2 run with ONNX Runtime on CPU
+
+    Reproduces the SentenceTransformer pipeline (tokenization, mean pooling over
+    the attention mask and L2 normalization), so the embeddings can be stored
+    in the same columns as the ones of the PyTorch model.
+
+    Parameters
+    ----------
+    model_dir : str
+        Directory with the exported model and its tokenizer, see
+        `export_onnx_model`
+    file_name : str, optional
+        The ONNX file in `model_dir`, by default the int8 quantized model
+    max_seq_length : int, optional
+        Inputs are truncated to this many tokens, like the PyTorch model
+    threads : int, optional
+        Number of ONNX Runtime intra-op threads, by default all cores
+
+    Notes
+    -----
+    Requires the optional onnxruntime dependency (`pip install chao_fan[onnx]`).
+
+    """
+
+    def __init__(
+        self,
+        model_dir: str,
+        file_name: str = ONNX_QUANTIZED_MODEL_FILE,
+        max_seq_length: int = 256,
+        threads: int | None = None,
+    ) -> None:
+        try:
+            import onnxruntime
+        except ImportError as e:
+            raise ImportError(
+                "The onnx embedding backend requires onnxruntime, install it with `pip install onnxruntime`"
+            ) from e
+        from transformers import AutoTokenizer
+
+        self.max_seq_length = max_seq_length
+        self.tokenizer = AutoTokenizer.from_pretrained(model_dir)
+        options = onnxruntime.SessionOptions()
+        if threads is not None:
+            options.intra_op_num_threads = threads
+        self.session = onnxruntime.InferenceSession(
+            os.path.join(model_dir, file_name),
+            options,
+            providers=["CPUExecutionProvider"],
+        )
+        self.input_names = {
+            model_input.name for model_input in self.session.get_inputs()
+        }
+
+    def _encode_batch(self, sentences: List[str]) -> np.ndarray:
+        tokens = self.tokenizer(
+            sentences,
+            padding=True,
+            truncation=True,
+            max_length=self.max_seq_length,
+            return_tensors="np",
+        )
+        inputs = {
+            name: values.astype(np.int64)
+            for name, values in tokens.items()
+            if name in self.input_names
+        }
+        token_embeddings = self.session.run(None, inputs)[0]
+        mask = tokens["attention_mask"][..., None].astype(np.float32)
+        embeddings = (token_embeddings * mask).sum(axis=1)
+        embeddings /= np.clip(mask.sum(axis=1), 1e-9, None)
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+        return embeddings / np.clip(norms, 1e-12, None)
+
+    def encode(self, sentences, batch_size: int = 32, **kwargs) -> np.ndarray:
+        """Embed sentences, with the same interface as `SentenceTransformer.encode`
+
+        Other keyword arguments (e.g. `show_progress_bar`) are accepted and ignored.
+
+        """
+        single = isinstance(sentences, str)
+        if single:
+            sentences = [sentences]
+        if len(sentences) == 0:
+            return np.zeros((0, 0), dtype=np.float32)
+        # Sort by length so that batches need less padding
+        order = np.argsort([-len(sentence) for sentence in sentences], kind="stable")
+        sorted_sentences = [sentences[i] for i in order]
+        batches = [
+            self._encode_batch(sorted_sentences[i : i + batch_size])
+            for i in range(0, len(sorted_sentences), batch_size)
+        ]
+        encoded = np.concatenate(batches).astype(np.float32)
+        embeddings = np.empty_like(encoded)
+        embeddings[order] = encoded
+        return embeddings[0] if single else embeddings
+
+
+def export_onnx_model(model_dir: str, quantize: bool = True) -> str:
+    """Export the PyTorch model and its tokenizer to ONNX in `model_dir`
+
+    Parameters
+    ----------
+    model_dir : str
+        Output directory, created if needed
+    quantize : bool, optional
+        Also write a dynamically int8 quantized copy of the model
+
+    Returns
+    -------
+    str
+        The path of the exported (quantized if requested) model
+
+    """
+    import torch
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+    from sentence_transformers import SentenceTransformer
+
+    class TokenEmbeddings(torch.nn.Module):
+        """Traceable wrapper returning the token embeddings of the transformer"""
+
+        def __init__(self, transformer: torch.nn.Module, input_names: List[str]):
+            super().__init__()
+            self.transformer = transformer
+            self.input_names = input_names
+
+        def forward(self, *inputs: torch.Tensor) -> torch.Tensor:
+            return self.transformer(**dict(zip(self.input_names, inputs)))[0]
+
+    os.makedirs(model_dir, exist_ok=True)
+    model = SentenceTransformer(MODEL_NAME, device="cpu")
+    tokenizer = model.tokenizer
+    tokenizer.save_pretrained(model_dir)
+    example = tokenizer(["a cup of flour"], return_tensors="pt")
+    input_names = list(example.keys())
+    wrapper = TokenEmbeddings(model[0].auto_model.eval(), input_names)
+    dynamic_axes = {name: {0: "batch", 1: "sequence"} for name in input_names}
+    dynamic_axes["token_embeddings"] = {0: "batch", 1: "sequence"}
+    path = os.path.join(model_dir, ONNX_MODEL_FILE)
+    # Newer torch versions default to the dynamo exporter, older ones lack the option
+    export_kwargs = {}
+    if "dynamo" in inspect.signature(torch.onnx.export).parameters:
+        export_kwargs["dynamo"] = False
+    with torch.no_grad():
+        torch.onnx.export(
+            wrapper,
+            tuple(example[name] for name in input_names),
+            path,
+            input_names=input_names,
+            output_names=["token_embeddings"],
+            dynamic_axes=dynamic_axes,
+            opset_version=17,
+            **export_kwargs,
+        )
+    if not quantize:
+        return path
+    quantized_path = os.path.join(model_dir, ONNX_QUANTIZED_MODEL_FILE)
+    quantize_dynamic(path, quantized_path, weight_type=QuantType.QInt8)
+    return quantized_path
+
+
+def embedding_model_id(backend: str | None = None) -> str:
+    """Identifier of the model recorded with the embeddings it produces
+
+    It also namespaces the embedding cache. It names the model and its
+    quantization, not the runtime: the float32 ONNX export produces the same
+    embeddings as the PyTorch model (up to rounding) and shares its id, while
+    the int8 quantized model gets its own (`MODEL_NAME:int8`). Switching to the
+    int8 model therefore marks every stored embedding as stale, and the next
+    backfill re-embeds every table; set EMBEDDING_MODEL_ID to the previous id
+    to keep them. EMBEDDING_MODEL_ID overrides the id, e.g. to re-embed every
+    row with a model whose embeddings are not interchangeable with the current
+    ones.
+
+    Parameters
+    ----------
+    backend : str, optional
+        "torch" or "onnx", by default the EMBEDDING_BACKEND environment variable,
+        or torch if unset. Clients of an embedding service should set the same
+        backend as the service.
+
+    """
+    model_id = os.environ.get("EMBEDDING_MODEL_ID")
+    if model_id is not None:
+        return model_id
+    backend = backend or os.environ.get("EMBEDDING_BACKEND", TORCH_BACKEND)
+    if backend != ONNX_BACKEND:
+        return MODEL_NAME
+    file_name = os.environ.get("ONNX_MODEL_FILE", ONNX_QUANTIZED_MODEL_FILE)
+    if file_name == ONNX_MODEL_FILE:
+        return MODEL_NAME
+    if file_name == ONNX_QUANTIZED_MODEL_FILE:
+        return f"{MODEL_NAME}:int8"
+    # A file exported some other way, whose quantization is unknown
+    return f"{MODEL_NAME}:{file_name}"
+
+
+def get_model(
+    device: str | None = None, backend: str | None = None, local: bool = False
+):
+    """The embedding model
+
+    If EMBEDDING_SERVICE_ADDRESS is set, this returns a client of the embedding
+    service running at that address (see `chao_fan.cli.embedding_service`)
+    instead of loading the model.
+
+    Parameters
+    ----------
+    device : str, optional
+        Device of the PyTorch model, by default cuda if available
+    backend : str, optional
+        "torch" or "onnx", by default the EMBEDDING_BACKEND environment variable,
+        or torch if unset. The onnx backend loads the model exported to
+        ONNX_MODEL_DIR, using ONNX_MODEL_FILE (the int8 model by default).
+    local : bool, optional
+        Load the model in this process even if an embedding service is configured
+
+    """
+    service_address = os.environ.get("EMBEDDING_SERVICE_ADDRESS")
+    if service_address is not None and not local:
+        logger.info(f"Using the embedding service at {service_address}")
+        authkey = os.environ.get("EMBEDDING_SERVICE_AUTHKEY")
+        return EmbeddingClient(
+            service_address, authkey=authkey.encode() if authkey else None
+        )
+    backend = backend or os.environ.get("EMBEDDING_BACKEND", TORCH_BACKEND)
+    if backend == ONNX_BACKEND:
+        model_dir = os.environ.get("ONNX_MODEL_DIR")
+        if model_dir is None:
+            raise ValueError("ONNX_MODEL_DIR environment variable not set")
+        logger.info(f"Using the ONNX model in {model_dir}")
+        return OnnxSentenceEncoder(
+            model_dir,
+            file_name=os.environ.get("ONNX_MODEL_FILE", ONNX_QUANTIZED_MODEL_FILE),
+        )
+    # Imported here as loading torch takes seconds
+    import torch
+    from sentence_transformers import SentenceTransformer
 
-def get_model(device: str | None = None):
     if device is None:
         device = "cuda" if torch.cuda.is_available() else "cpu"
     logger.info(f"Using device: {device}")
-    model = SentenceTransformer("sentence-transformers/all-MiniLM-L6-v2", device=device)
+    model = SentenceTransformer(MODEL_NAME, device=device)
     return model
 
 
 def generate_embeddings(
     sentences,
     model,
+    cache: EmbeddingCache | None = None,
     **kwargs,
 ) -> List[List[float]]:
     """Generate embeddings for a list of ingredients
@@ -31,9 +279,31 @@ def generate_embeddings(
     ----------
     sentences : List[str]
         The sentences to embed
-
+    model : SentenceTransformer
+        The model used to generate the embeddings
+    cache : EmbeddingCache, optional
+        Cache of previously generated embeddings. Only sentences missing from the
+        cache are encoded, and their embeddings are added to it.
 
     """
-    embeddings: np.ndarray = model.encode(sentences, **kwargs)
-    embeddings = embeddings.astype(np.float32).tolist()
-    return embeddings
+    if cache is None:
+        embeddings: np.ndarray = model.encode(sentences, **kwargs)
+        embeddings = embeddings.astype(np.float32).tolist()
+        return embeddings
+
+    single = isinstance(sentences, str)
+    if single:
+        sentences = [sentences]
+    embeddings = cache.get_many(sentences)
+    # Encode each missing sentence once, even if it is repeated
+    missing = list(dict.fromkeys(s for s, e in zip(sentences, embeddings) if e is None))
+    if len(missing) > 0:
+        encoded = model.encode(missing, **kwargs).astype(np.float32)
+        cache.put_many(missing, encoded)
+        encoded_by_sentence = dict(zip(missing, encoded))
+        embeddings = [
+            encoded_by_sentence[s] if e is None else e
+            for s, e in zip(sentences, embeddings)
+        ]
+    embeddings = np.asarray(embeddings, dtype=np.float32).tolist()
+    return embeddings[0] if single else embeddings
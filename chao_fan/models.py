@@ -4,7 +4,7 @@ from typing import List, Optional
 
 from pgvector.sqlalchemy import Vector
 from pydantic import AwareDatetime
-from sqlalchemy import Column, DateTime
+from sqlalchemy import Column, DateTime, Index, UniqueConstraint, text
 from sqlmodel import Field, Relationship, SQLModel
 
 ### Link Models ###
@@ -35,7 +35,28 @@ def vector_column():
     return Column(Vector(float(os.environ.get("EMBEDDING_DIMENSION", 384))))
 
 
-class Recipe(SQLModel, table=True):
+class EmbeddingProvenance(SQLModel):
+    """What produced the embedding of a row
+
+    Rows whose embedding was produced by another model, or from a text that has
+    changed since, are re-embedded by `chao_fan.pipelines.generate_embedings`.
+    """
+
+    # e.g. sentence-transformers/all-MiniLM-L6-v2
+    embedding_model: Optional[str] = None
+    # md5 of the embedded text, see chao_fan.embedding_backfill.content_hash
+    embedding_hash: Optional[str] = None
+
+
+class Recipe(EmbeddingProvenance, table=True):
+    # Small index of the recipes left to enrich, from which workers claim batches
+    __table_args__ = (
+        Index(
+            "ix_recipe_pending_enrichment",
+            "id",
+            postgresql_where=text("enriched_at IS NULL"),
+        ),
+    )
     id: Optional[int] = Field(default=None, primary_key=True)
     enriched_at: Optional[AwareDatetime] = Field(
         default=None, sa_type=DateTime(timezone=True)
@@ -43,12 +64,20 @@ class Recipe(SQLModel, table=True):
     enrichment_failed_at: Optional[AwareDatetime] = Field(
         default=None, sa_type=DateTime(timezone=True)
     )
+    # Set by the enrichment worker that claimed the recipe, which others skip
+    # until then
+    enrichment_lease_until: Optional[AwareDatetime] = Field(
+        default=None, sa_type=DateTime(timezone=True)
+    )
     title: Optional[str] = None
     source_name: Optional[str] = None
     price_per_serving: Optional[float] = None
     ready_in_minutes: Optional[int] = None
     servings: Optional[int] = None
     source_url: Optional[str] = None
+    # chao_fan.utils.canonicalize_url of source_url, so that variants of the
+    # same page (tracking parameters, trailing slash, ...) are one recipe
+    canonical_url: Optional[str] = Field(default=None, index=True, unique=True)
     image: Optional[str] = None
     image_type: Optional[str] = None
     summary: Optional[str] = None
@@ -71,7 +100,7 @@ class Instruction(SQLModel, table=True):
     recipe: Optional[Recipe] = Relationship(back_populates="instructions")
 
 
-class Ingredient(SQLModel):
+class Ingredient(EmbeddingProvenance):
     description: str
     embedding: List[float] = Field(sa_column=vector_column())
 
@@ -80,7 +109,8 @@ class IngredientNutrition(Ingredient, table=True):
     id: Optional[int] = Field(default=None, primary_key=True)
     fdc_id: Optional[int] = None
     usda_data_type: Optional[str] = None
-    description: Optional[str] = None
+    # Indexed so embeddings can be fanned out to rows with the same description
+    description: Optional[str] = Field(default=None, index=True)
     update_year: Optional[str] = None
     serving_amount: Optional[float] = None
     serving_text: Optional[str] = None
@@ -106,6 +136,7 @@ class IngredientNutrition(Ingredient, table=True):
 
 class IngredientPrice(Ingredient, table=True):
     id: Optional[int] = Field(default=None, primary_key=True)
+    description: str = Field(index=True, unique=True)
     price_100grams: float
     embedding: List[float] = Field(sa_column=vector_column())
 
@@ -127,6 +158,54 @@ class RecipeIngredient(Ingredient, table=True):
     embedding: List[float] = Field(sa_column=vector_column())
 
 
+class IngredientParse(SQLModel, table=True):
+    """Memoized output of the ingredient parser for an ingredient line"""
+
+    __table_args__ = (UniqueConstraint("line", "parser_version"),)
+    id: Optional[int] = Field(default=None, primary_key=True)
+    line: str
+    parser_version: str
+    description: Optional[str] = None
+    amount: Optional[float] = None
+    unit: Optional[str] = None
+
+
+class EmbeddingCheckpoint(SQLModel, table=True):
+    """Progress of an embedding backfill, so an interrupted run can resume"""
+
+    name: str = Field(primary_key=True)
+    last_id: int = 0
+    rows: int = 0
+    rows_per_second: Optional[float] = None
+    updated_at: Optional[AwareDatetime] = Field(
+        default=None, sa_type=DateTime(timezone=True)
+    )
+
+
+class BulkLoadChunk(SQLModel, table=True):
+    """A chunk of rows copied by a bulk load, so an interrupted load can resume"""
+
+    # e.g. the SQLite table the rows come from
+    source: str = Field(primary_key=True)
+    start_rowid: int = Field(primary_key=True)
+    end_rowid: int
+    rows: int = 0
+    loaded_at: Optional[AwareDatetime] = Field(
+        default=None, sa_type=DateTime(timezone=True)
+    )
+
+
+class PinterestBoardSync(SQLModel, table=True):
+    """Watermark of the incremental sync of a Pinterest board"""
+
+    board_id: str = Field(primary_key=True)
+    # The newest pin of the board at the last sync
+    last_pin_id: Optional[str] = None
+    synced_at: Optional[AwareDatetime] = Field(
+        default=None, sa_type=DateTime(timezone=True)
+    )
+
+
 class Cuisine(SQLModel, table=True):
     id: Optional[int] = Field(default=None, primary_key=True)
     name: str
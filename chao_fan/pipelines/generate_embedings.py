@@ -1,26 +1,77 @@
 import logging
+import multiprocessing
 import os
-from typing import List
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Optional, Tuple
 
 from sqlalchemy.engine import Engine
-from sqlmodel import Session, select, text
+from sqlmodel import Session, create_engine, func, select
 
-from chao_fan.db import engine
-from chao_fan.integrations.sentence_transformer import generate_embeddings, get_model
-from chao_fan.models import Ingredient, IngredientNutrition, IngredientPrice
-from chao_fan.utils import Timeout
+from chao_fan import env  # noqa: F401
+from chao_fan.db import get_engine
+from chao_fan.embedding_backfill import (
+    adopt_unversioned_embeddings,
+    content_hash,
+    group_descriptions,
+    load_checkpoint,
+    needs_embedding,
+    pending_batches,
+    save_checkpoint,
+    write_embeddings,
+    write_embeddings_by_description,
+)
+from chao_fan.embedding_cache import get_embedding_cache
+from chao_fan.integrations.sentence_transformer import (
+    embedding_model_id,
+    generate_embeddings,
+    get_model,
+)
+from chao_fan.models import (
+    Ingredient,
+    IngredientNutrition,
+    IngredientPrice,
+    Recipe,
+    RecipeIngredient,
+)
+from chao_fan.stages import Stage, run_stages
 
 logger = logging.getLogger(__name__)
 
 
+def rematch_recipe_ingredients(engine: Engine, ids: List[int]) -> None:
+    """Match re-embedded recipe ingredients to the price and nutrition tables again
+
+    Their previous matches were found with their previous embeddings, which may
+    not be comparable with the current embeddings of those tables.
+
+    """
+    # Imported here as the recipe scrapers are only needed for recipe ingredients
+    from chao_fan.integrations.recipe_scrapers import match_ingredients
+
+    with Session(engine) as session:
+        ingredients = session.exec(
+            select(RecipeIngredient).where(RecipeIngredient.id.in_(ids))
+        ).all()
+        for ingredient in ingredients:
+            ingredient.ingredient_nutrition_id = None
+        match_ingredients(ingredients, session, link_by_id=True)
+        session.commit()
+
+
 def generate_ingredient_embeddings(
     engine: Engine,
     ingredient_model: Ingredient,
     batch_size: int,
     device: str | None = None,
-):
+    queue_depth: int = 0,
+    deadline: Optional[float] = None,
+    shard: Optional[Tuple[int, int]] = None,
+    dedupe: bool = False,
+    model_id: str | None = None,
+) -> bool:
     """
-    Generate embeddings for ingredients tables that don't have them
+    Generate embeddings for ingredients tables that don't have up-to-date ones
 
     Parameters
     ----------
@@ -30,62 +81,372 @@ def generate_ingredient_embeddings(
         The ingredient table for which to generate embeddings
     batch_size : int
         The batch size for encoding embeddings
+    device : str, optional
+        The device of the model, by default cuda if available
+    queue_depth : int, optional
+        If positive, batches are read by a background thread and written back by
+        another one while the model encodes, with at most `queue_depth` batches
+        waiting between them. By default, batches are read, encoded and written
+        one after another.
+    deadline : float, optional
+        `time.monotonic()` value after which no new batch is started. Batches
+        already read are still encoded and written.
+    shard : Tuple[int, int], optional
+        (index, count): only process rows with `id % count == index`, see
+        `generate_ingredient_embeddings_sharded`
+    dedupe : bool, optional
+        Encode each normalized description of a batch once, and write its
+        embedding to every row of the table with the same description, including
+        rows of later batches. This needs an index on `description` (created
+        by `setup_db`). Ignored for recipe ingredients, which are re-matched
+        batch by batch.
+    model_id : str, optional
+        Recorded with each embedding, by default `embedding_model_id()`. Rows
+        embedded by another model, or whose description no longer matches the
+        recorded content hash, are re-embedded.
+
+    Returns
+    -------
+    bool
+        Whether every row was processed before the deadline
+
+    Notes
+    -----
+    Rows are read in id order with keyset pagination and each batch of embeddings
+    is written with a single set-based UPDATE, see `chao_fan.embedding_backfill`.
+    Because the reader only moves forward, prefetching never returns rows whose
+    embeddings are still waiting to be written.
+
+    Progress is checkpointed in the EmbeddingCheckpoint table after every
+    batch, and the next call resumes after the last written id instead of
+    starting over.
+
+    Recipe ingredients are matched to the price and nutrition tables again
+    after their embeddings are written, see `rematch_recipe_ingredients`.
     """
+    rematch = ingredient_model is RecipeIngredient
+    # Rows embedded by the fan-out would not be re-matched
+    dedupe = dedupe and not rematch
     transformer_model = get_model(device=device)
+    model_id = model_id or embedding_model_id()
+    cache = get_embedding_cache(model_id)
+    table_name = ingredient_model.__tablename__
+    checkpoint_name = table_name
+    count = (
+        select(func.count())
+        .where(needs_embedding(ingredient_model, model_id))
+        .where(ingredient_model.description != None)  # noqa
+    )
+    if shard is not None:
+        checkpoint_name = f"{table_name}:{shard[0]}/{shard[1]}"
+        count = count.where(ingredient_model.id % shard[1] == shard[0])
     with Session(engine) as session:
-        table_name = ingredient_model.__tablename__
-        n_rows = session.exec(
-            text(f"SELECT count(*) FROM {table_name} WHERE embedding IS NULL")
-        ).fetchone()[0]
-        logger.info(f"Number of rows in {table_name} without embeddings: {n_rows}")
+        n_rows = session.exec(count.select_from(ingredient_model)).one()
+        logger.info(
+            f"Number of rows in {checkpoint_name} without an up-to-date embedding: {n_rows}"
+        )
     n_batches = n_rows // batch_size + 1
-    batch = 1
-    while True:
-        with Session(engine) as session:
-            logger.info(f"Generating embeddings for batch {batch}/{n_batches}")
-            # Query for ingredients that don't have embeddings
-            ingredients = session.exec(
-                select(ingredient_model)
-                .where(ingredient_model.embedding == None)  # noqa
-                .limit(batch_size)
+    after_id = load_checkpoint(engine, checkpoint_name)
+    if after_id > 0:
+        logger.info(f"Resuming {checkpoint_name} after id {after_id}")
+
+    def encode(rows):
+        ids = [row_id for row_id, _ in rows]
+        hashes = [content_hash(description) for _, description in rows]
+        if dedupe:
+            groups = list(group_descriptions(rows).values())
+            ingredient_descriptions = [variants[0] for variants in groups]
+        else:
+            ingredient_descriptions = [description for _, description in rows]
+        ingredient_embeddings = generate_embeddings(
+            ingredient_descriptions,
+            model=transformer_model,
+            cache=cache,
+            show_progress_bar=False,
+        )
+        if dedupe:
+            # Every variant of a description gets the same embedding
+            ingredient_descriptions, ingredient_embeddings = zip(
+                *[
+                    (variant, embedding)
+                    for variants, embedding in zip(groups, ingredient_embeddings)
+                    for variant in variants
+                ]
             )
-            ingredients: List[Ingredient] = ingredients.fetchall()
-            if len(ingredients) == 0:
-                break
-            ingredient_descriptions = [
-                ingredient.description for ingredient in ingredients
-            ]
-
-            # Generate embeddings
-            ingredient_embeddings = generate_embeddings(
+        n_encoded = len(groups) if dedupe else len(ids)
+        return ids, hashes, ingredient_descriptions, ingredient_embeddings, n_encoded
+
+    def write(batch):
+        ids, hashes, ingredient_descriptions, ingredient_embeddings, n_encoded = batch
+        if dedupe:
+            n = write_embeddings_by_description(
+                engine,
+                ingredient_model,
                 ingredient_descriptions,
-                model=transformer_model,
-                show_progress_bar=False,
+                ingredient_embeddings,
+                model_id,
+                shard=shard,
+            )
+        else:
+            write_embeddings(
+                engine, ingredient_model, ids, ingredient_embeddings, hashes, model_id
+            )
+            n = len(ids)
+        if rematch:
+            rematch_recipe_ingredients(engine, ids)
+        return n, n_encoded, ids[-1]
+
+    batches = pending_batches(
+        engine,
+        ingredient_model,
+        batch_size,
+        after_id=after_id,
+        deadline=deadline,
+        shard=shard,
+        model_id=model_id,
+    )
+    if queue_depth > 0:
+        # The feeding thread prefetches batches while the model encodes
+        stages = [Stage("encode", encode), Stage("write", write)]
+        written = run_stages(batches, stages, queue_size=queue_depth)
+    else:
+        written = (write(encode(rows)) for rows in batches)
+
+    start = time.perf_counter()
+    n_written, n_encoded = 0, 0
+    rate = None
+    for batch, (n, n_batch_encoded, last_id) in enumerate(written, start=1):
+        n_written += n
+        n_encoded += n_batch_encoded
+        rate = n_written / (time.perf_counter() - start)
+        save_checkpoint(engine, checkpoint_name, last_id, n_written, rate)
+        logger.info(
+            f"Generated embeddings for batch {batch}/{n_batches} ({rate:.0f} rows/s)"
+        )
+    if dedupe and n_encoded > 0:
+        logger.info(
+            f"Encoded {n_encoded} descriptions for {n_written} rows "
+            f"(dedup ratio {n_written / n_encoded:.1f}x)"
+        )
+    if cache is not None:
+        logger.info(f"Embedding cache hit rate: {cache.hit_rate:.1%}")
+    completed = deadline is None or time.monotonic() < deadline
+    if completed:
+        # The next pass starts over to pick up rows that changed since
+        save_checkpoint(engine, checkpoint_name, 0, n_written, rate)
+    return completed
+
+
+def _embed_shard(
+    postgres_url: str,
+    ingredient_model: Ingredient,
+    shard: Tuple[int, int],
+    batch_size: int,
+    device: str | None,
+    torch_threads: int,
+    queue_depth: int,
+    time_budget: Optional[float],
+    dedupe: bool,
+) -> bool:
+    """Worker process of `generate_ingredient_embeddings_sharded`"""
+    logging.basicConfig(
+        level=logging.INFO,
+        format=f"%(asctime)s - shard {shard[0]} - %(name)s - %(levelname)s - %(message)s",
+    )
+    import torch
+
+    torch.set_num_threads(torch_threads)
+    deadline = None if time_budget is None else time.monotonic() + time_budget
+    shard_engine = create_engine(postgres_url)
+    try:
+        return generate_ingredient_embeddings(
+            shard_engine,
+            ingredient_model,
+            batch_size,
+            device=device,
+            queue_depth=queue_depth,
+            deadline=deadline,
+            shard=shard,
+            dedupe=dedupe,
+        )
+    finally:
+        shard_engine.dispose()
+
+
+def generate_ingredient_embeddings_sharded(
+    engine: Engine,
+    ingredient_model: Ingredient,
+    batch_size: int,
+    n_shards: int,
+    devices: List[str] | None = None,
+    torch_threads: int | None = None,
+    queue_depth: int = 0,
+    deadline: Optional[float] = None,
+    dedupe: bool = False,
+) -> bool:
+    """
+    Generate embeddings in `n_shards` worker processes
+
+    Each process loads its own model and embeds the rows whose id modulo
+    `n_shards` is its shard index, so the shards never write the same rows and
+    are checkpointed independently.
+
+    Parameters
+    ----------
+    engine : Engine
+        The sqlalchemy engine. Each process connects to its database with its
+        own engine.
+    ingredient_model : Ingredient
+        The ingredient table for which to generate embeddings
+    batch_size : int
+        The batch size for encoding embeddings
+    n_shards : int
+        Number of worker processes
+    devices : List[str], optional
+        Devices assigned to the shards in turn (e.g. ["cuda:0", "cuda:1"]),
+        by default cuda if available
+    torch_threads : int, optional
+        Number of torch threads per process, by default the CPUs split evenly
+        between the shards
+    queue_depth : int, optional
+        Prefetch queue depth of each shard, see `generate_ingredient_embeddings`
+    deadline : float, optional
+        `time.monotonic()` value after which no new batch is started
+    dedupe : bool, optional
+        Encode each description once, see `generate_ingredient_embeddings`.
+        Embeddings are only fanned out to rows of the same shard.
+
+    Returns
+    -------
+    bool
+        Whether every shard processed all its rows before the deadline
+
+    """
+    devices = devices or [None]
+    if torch_threads is None:
+        torch_threads = max(1, (os.cpu_count() or 1) // n_shards)
+    time_budget = None
+    if deadline is not None:
+        time_budget = max(0.0, deadline - time.monotonic())
+    postgres_url = engine.url.render_as_string(hide_password=False)
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=n_shards, mp_context=context) as executor:
+        futures = [
+            executor.submit(
+                _embed_shard,
+                postgres_url,
+                ingredient_model,
+                (shard, n_shards),
+                batch_size,
+                devices[shard % len(devices)],
+                torch_threads,
+                queue_depth,
+                time_budget,
+                dedupe,
             )
+            for shard in range(n_shards)
+        ]
+        return all([future.result() for future in futures])
+
+
+def warn_stale_recipe_embeddings(engine: Engine, model_id: str) -> None:
+    """Warn about recipe embeddings of another model
+
+    Recipe embeddings are not generated yet (see
+    `chao_fan.pipelines.update_recipe_db.update_recipe_db`), so they cannot be
+    re-embedded, but they should not be compared with the current embeddings.
 
-            # Update ingredients with embeddings
-            for ingredient, embedding in zip(ingredients, ingredient_embeddings):
-                ingredient.embedding = embedding
-            session.commit()
-        batch += 1
+    """
+    statement = (
+        select(func.count())
+        .select_from(Recipe)
+        .where(Recipe.embedding != None)  # noqa
+        .where(Recipe.embedding_model.is_distinct_from(model_id))
+    )
+    with Session(engine) as session:
+        n_stale = session.exec(statement).one()
+    if n_stale > 0:
+        logger.warning(
+            f"{n_stale} recipe embeddings were not produced by {model_id} "
+            "and are not re-embedded"
+        )
+
+
+def max_run_seconds(
+    time_budget: float, queue_depth: int, max_batch_seconds: float
+) -> float:
+    """Upper bound of the duration of `update_embeddings` with a time budget
+
+    The deadline is only checked before a batch is read, and the batches
+    already read are still encoded and written. With a `queue_depth`, up to
+    `queue_depth` batches wait before the encoder and as many before the
+    writer, on top of the one being encoded and the one being written.
+
+    Parameters
+    ----------
+    time_budget : float
+        INGREDIENT_EMBEDDING_GENERATION_TIMEOUT_SECONDS
+    queue_depth : int
+        INGREDIENT_EMBEDDING_QUEUE_DEPTH
+    max_batch_seconds : float
+        Worst-case seconds to encode and write one batch
+
+    """
+    in_flight = 1 if queue_depth <= 0 else 2 * queue_depth + 2
+    return time_budget + in_flight * max_batch_seconds
 
 
 def update_embeddings():
-    # Generate IngredientNutrition and IngredientPrice embeddings
+    # Generate IngredientNutrition and IngredientPrice embeddings, then the
+    # RecipeIngredient ones, which are matched against them
+    engine = get_engine()
     device = os.environ.get("INGREDIENT_EMBEDDING_DEVICE", None)
+    n_shards = int(os.environ.get("INGREDIENT_EMBEDDING_SHARDS", 1))
+    torch_threads = os.environ.get("INGREDIENT_EMBEDDING_TORCH_THREADS")
+    dedupe = os.environ.get("INGREDIENT_EMBEDDING_DEDUPE", "false").lower() == "true"
     batch_size = int(os.environ.get("INGREDIENT_EMBEDDING_GENERATION_BATCH_SIZE", 1000))
+    queue_depth = int(os.environ.get("INGREDIENT_EMBEDDING_QUEUE_DEPTH", 2))
     timeout = os.environ.get("INGREDIENT_EMBEDDING_GENERATION_TIMEOUT_SECONDS", 600)
-    try:
-        with Timeout(int(timeout)):
-            for ingredient in [IngredientNutrition, IngredientPrice]:
-                logger.info(f"Generating embeddings for {ingredient.__name__}")
-                generate_ingredient_embeddings(
-                    engine, ingredient, batch_size=batch_size, device=device
-                )
-    except TimeoutError:
-        logger.error(
-            f"Timed out after {timeout} seconds while generating embeddings for IngredientNutrition and IngredientPrice"
-        )
+    # Checked between batches, so no work is lost when time runs out. The run
+    # can last longer, see max_run_seconds
+    deadline = time.monotonic() + int(timeout)
+    adopt = os.environ.get("EMBEDDING_ADOPT_UNVERSIONED", "false").lower() == "true"
+    model_id = embedding_model_id()
+    warn_stale_recipe_embeddings(engine, model_id)
+    for ingredient in [IngredientNutrition, IngredientPrice, RecipeIngredient]:
+        if adopt:
+            n = adopt_unversioned_embeddings(engine, ingredient, model_id)
+            logger.info(
+                f"Recorded the model of {n} existing {ingredient.__name__} embeddings"
+            )
+        logger.info(f"Generating embeddings for {ingredient.__name__}")
+        if n_shards > 1:
+            completed = generate_ingredient_embeddings_sharded(
+                engine,
+                ingredient,
+                batch_size=batch_size,
+                n_shards=n_shards,
+                devices=device.split(",") if device else None,
+                torch_threads=int(torch_threads) if torch_threads else None,
+                queue_depth=queue_depth,
+                deadline=deadline,
+                dedupe=dedupe,
+            )
+        else:
+            completed = generate_ingredient_embeddings(
+                engine,
+                ingredient,
+                batch_size=batch_size,
+                device=device,
+                queue_depth=queue_depth,
+                deadline=deadline,
+                dedupe=dedupe,
+            )
+        if not completed:
+            logger.info(
+                f"Stopped after {timeout} seconds, the next run resumes from the last checkpoint"
+            )
+            break
 
 
 if __name__ == "__main__":
@@ -1,57 +1,77 @@
 import logging
 import os
-from datetime import datetime, timedelta
-from typing import List, Optional
+from datetime import datetime, timedelta, timezone
+from typing import Iterable, Iterator, List, Optional, Set, Tuple
 
 import requests
-from dotenv import load_dotenv
-from selenium.common.exceptions import InvalidSessionIdException
+from sqlalchemy import func, or_, update
+from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.engine import Engine
 from sqlmodel import Session, bindparam, select, text
 from tqdm import tqdm
 from urllib3.exceptions import HTTPError
 
+from chao_fan import env  # noqa: F401
 from chao_fan.constants import PROD
-from chao_fan.db import engine
+from chao_fan.db import get_engine
+from chao_fan.integrations.html_cache import HtmlCache
+from chao_fan.integrations.ingredient_parsing import (
+    IngredientParserPool,
+    IngredientParseStore,
+)
 from chao_fan.integrations.pinterest import (
     Pin,
-    get_pin_links,
+    board_pages,
+    get_new_pins,
     get_pinterest_board_id,
     setup_pinterest,
 )
-from chao_fan.integrations.recipe_scrapers import scrape_recipe
+from chao_fan.integrations.recipe_fetcher import RecipeFetcher
+from chao_fan.integrations.recipe_scrapers import (
+    apply_scraped_recipe,
+    embed_ingredients,
+    enrich_ingredients,
+    extract_recipe,
+    match_ingredients,
+    parse_scraped_ingredients,
+)
 from chao_fan.integrations.sentence_transformer import get_model
-from chao_fan.models import Recipe
+from chao_fan.models import (
+    IngredientNutrition,
+    IngredientPrice,
+    PinterestBoardSync,
+    Recipe,
+)
+from chao_fan.stages import Stage, run_stages
+from chao_fan.utils import canonicalize_url
+from chao_fan.vector_index import IngredientVectorIndex
 
 STAGE = os.environ.get("STAGE", PROD)
 logger = logging.getLogger(__name__)
 
 
-def get_pinterest_links(board_name: str) -> List[Pin]:
-    """Get pinterest links
+def find_existing_urls(urls: List[str], engine: Engine) -> Set[str]:
+    """The urls whose page is already the source of a recipe
 
-    Parameters
-    ----------
-    board_name : str
-        The name of the board to get links from
-
-    Returns
-    -------
-    List[Pin]
-        Pins from the board
+    Urls are compared by their canonical form, so e.g. a link with tracking
+    parameters matches the recipe of the same page without them.
 
     """
-    pinterest = setup_pinterest(
-        email=os.environ.get("PINTEREST_EMAIL"),
-        password=os.environ.get("PINTEREST_PASSWORD"),
-        username=os.environ.get("PINTEREST_USERNAME"),
-    )
-    try:
-        board_id = get_pinterest_board_id(pinterest, board_name)
-    except HTTPError as e:
-        logger.error(e)
-        return []
-    return get_pin_links(pinterest, board_id)
+    if len(urls) == 0:
+        return set()
+    with engine.connect() as conn:
+        t = text(
+            """
+            SELECT canonical_url FROM recipe
+            WHERE canonical_url in :canonical_urls
+            """
+        )
+        t = t.bindparams(bindparam("canonical_urls", expanding=True))
+        result = conn.execute(
+            t, dict(canonical_urls=list({canonicalize_url(url) for url in urls}))
+        )
+        existing = {row[0] for row in result}
+    return {url for url in urls if canonicalize_url(url) in existing}
 
 
 def find_pins_not_in_db(pins: List[Pin], engine: Engine) -> List[Pin]:
@@ -70,44 +90,138 @@ def find_pins_not_in_db(pins: List[Pin], engine: Engine) -> List[Pin]:
         Pins not in the database
 
     """
-    with engine.connect() as conn:
-        t = text(
-            """
-            SELECT DISTINCT source_url FROM recipe
-            WHERE source_url in :source_urls
-            """
-        )
-        t = t.bindparams(bindparam("source_urls", expanding=True))
-        result = conn.execute(
-            t,
-            dict(source_urls=[pin.url for pin in pins]),
-        )
-        existing_urls = [row[0] for row in result]
+    existing_urls = find_existing_urls([pin.url for pin in pins], engine)
     return [pin for pin in pins if pin.url not in existing_urls]
 
 
-def insert_pins_into_db(pins: List[Pin], engine: Engine):
+def load_board_watermark(engine: Engine, board_id: str) -> Optional[str]:
+    """The newest pin of the board at its last sync, None if never synced"""
+    with Session(engine) as session:
+        board_sync = session.get(PinterestBoardSync, board_id)
+    return board_sync.last_pin_id if board_sync is not None else None
+
+
+def save_board_watermark(engine: Engine, board_id: str, last_pin_id: Optional[str]):
+    with Session(engine) as session:
+        board_sync = session.get(PinterestBoardSync, board_id)
+        if board_sync is None:
+            board_sync = PinterestBoardSync(board_id=board_id)
+        board_sync.last_pin_id = last_pin_id
+        board_sync.synced_at = datetime.now(timezone.utc)
+        session.add(board_sync)
+        session.commit()
+
+
+def sync_pinterest_board(board_name: str, engine: Engine, page_size: int = 50) -> int:
+    """Insert the recipes pinned to a board since its last sync
+
+    The board is read newest-first, and only until the pin recorded as its
+    watermark by the previous sync (or a page of pins that are all in the
+    database), so a daily run costs the same however large the board is. The
+    watermark is moved once the new pins are inserted.
+
+    Parameters
+    ----------
+    board_name : str
+        The name of the board to get links from
+    engine : Engine
+        The sqlalchemy engine
+    page_size : int, optional
+        Number of pins requested per page of the board feed
+
+    Returns
+    -------
+    int
+        The number of pins inserted
+
+    """
+    pinterest = setup_pinterest(
+        email=os.environ.get("PINTEREST_EMAIL"),
+        password=os.environ.get("PINTEREST_PASSWORD"),
+        username=os.environ.get("PINTEREST_USERNAME"),
+    )
+    try:
+        board_id = get_pinterest_board_id(pinterest, board_name)
+    except HTTPError as e:
+        logger.error(e)
+        return 0
+    if board_id is None:
+        logger.error(f"Pinterest board {board_name} not found")
+        return 0
+    last_pin_id = load_board_watermark(engine, board_id)
+    new_pins, newest_pin_id = get_new_pins(
+        board_pages(pinterest, board_id, page_size=page_size),
+        known_urls=lambda urls: find_existing_urls(urls, engine),
+        last_pin_id=last_pin_id,
+    )
+    logger.info(f"Found {len(new_pins)} new pins. Inserting into recipe table.")
+    n_inserted = insert_pins_into_db(new_pins, engine)
+    if n_inserted < len(new_pins):
+        logger.info(f"Skipped {len(new_pins) - n_inserted} pins of known pages")
+    if newest_pin_id != last_pin_id:
+        save_board_watermark(engine, board_id, newest_pin_id)
+    return n_inserted
+
+
+def insert_pins_statement(pins: List[Pin]):
+    """INSERT of the pins' recipes, skipping pages that already have one"""
+    rows = {}
+    for pin in pins:
+        canonical_url = canonicalize_url(pin.url)
+        rows.setdefault(
+            canonical_url,
+            dict(
+                source_name=pin.site_name,
+                source_url=pin.url,
+                canonical_url=canonical_url,
+            ),
+        )
+    return (
+        insert(Recipe)
+        .values(list(rows.values()))
+        .on_conflict_do_nothing(index_elements=["canonical_url"])
+        .returning(Recipe.id)
+    )
+
+
+def insert_pins_into_db(pins: List[Pin], engine: Engine) -> int:
     """Insert pins into database
 
+    All pins are inserted by one statement. Pins whose canonical url is already
+    in the recipe table, or shared by an earlier pin, are skipped.
+
     Parameters
     ----------
     pins : List[Pin]
         The pins to insert
     engine : Engine
         The sqlalchemy engine
+
+    Returns
+    -------
+    int
+        The number of recipes inserted
     """
-    with Session(engine) as session:
-        for pin in pins:
-            recipe = Recipe(
-                source_name=pin.site_name,
-                source_url=pin.url,
-                enriched=False,
-            )
-            session.add(recipe)
-        session.commit()
+    pins = [pin for pin in pins if pin.url]
+    if len(pins) == 0:
+        return 0
+    with engine.begin() as conn:
+        inserted = conn.execute(insert_pins_statement(pins)).all()
+    return len(inserted)
 
 
-def _enrich_recipes_batch(session: Session, recipes: List[Recipe], n: int):
+def _enrich_recipes_batch(
+    session: Session,
+    recipes: List[Recipe],
+    n: int,
+    price_index: Optional[IngredientVectorIndex] = None,
+    nutrition_index: Optional[IngredientVectorIndex] = None,
+    fetcher: Optional[RecipeFetcher] = None,
+    fetch_workers: int = 1,
+    parse_store: Optional[IngredientParseStore] = None,
+    parser_pool: Optional[IngredientParserPool] = None,
+    embedding_model=None,
+):
     """
     1. Use recipe_scrapers to scrape recipe (title, instructions and ingredients)
     2. Extract ingredients using ingredient_parser
@@ -115,19 +229,272 @@ def _enrich_recipes_batch(session: Session, recipes: List[Recipe], n: int):
     4. Estimate each ingredient price via semantic search in prices table
     5. Generate recipe embedding
     6. Estimate recipe preference score using KNN on recipe embeddings
+
+    If a `fetcher` is passed, the recipe pages are downloaded concurrently by
+    `fetch_workers` threads before being parsed. The ingredient lines of the
+    whole batch are parsed together, see `parse_scraped_ingredients`.
     """
-    model = get_model()
+    model = embedding_model if embedding_model is not None else get_model()
+    recipes = list(recipes)
     bar = tqdm(recipes, desc="Enriching", total=n, disable=STAGE == PROD)
-    for recipe in bar:
-        enriched_recipe = scrape_recipe(recipe, session=session, embedding_model=model)
+    # Pages are downloaded by extract_recipe if there is no fetcher
+    pages = [None] * len(recipes)
+    if fetcher is not None:
+        pages = [
+            page
+            for _, page in fetcher.fetch_many(
+                [recipe.source_url for recipe in recipes], max_workers=fetch_workers
+            )
+        ]
+    # Scrape and parse every recipe first so ingredients are embedded in batches
+    scraped_recipes = []
+    for recipe, page in zip(bar, pages):
+        scraped = None
+        if isinstance(page, Exception):
+            logger.error(page)
+        else:
+            scraped = extract_recipe(
+                recipe.source_url, html=page, parse_ingredient_lines=False
+            )
+        scraped_recipes.append(scraped)
+    parse_scraped_ingredients(
+        scraped_recipes, parse_store=parse_store, parser_pool=parser_pool
+    )
+    enriched_recipes = [
+        apply_scraped_recipe(recipe, scraped)
+        for recipe, scraped in zip(recipes, scraped_recipes)
+    ]
+    enrich_ingredients(
+        [recipe for recipe in enriched_recipes if recipe.enrichment_failed_at is None],
+        embedding_model=model,
+        session=session,
+        price_index=price_index,
+        nutrition_index=nutrition_index,
+    )
+    for enriched_recipe in enriched_recipes:
         session.add(enriched_recipe)
 
 
+def _enrich_recipes_staged(
+    session: Session,
+    items: Iterable[Tuple[int, str]],
+    n: int,
+    price_index: Optional[IngredientVectorIndex] = None,
+    nutrition_index: Optional[IngredientVectorIndex] = None,
+    fetcher: Optional[RecipeFetcher] = None,
+    fetch_workers: int = 8,
+    parse_workers: int = 2,
+    match_workers: int = 2,
+    queue_size: int = 32,
+    parse_store: Optional[IngredientParseStore] = None,
+    parser_pool: Optional[IngredientParserPool] = None,
+    embedding_model=None,
+    embed_batch_recipes: int = 8,
+    commit_every: int = 10,
+) -> int:
+    """
+    Enrich recipes in overlapping stages: fetch, extract, parse, embed, match and
+    persist
+
+    `items` are the (id, source url) of the recipes to enrich. They are read as
+    the fetch stage has room for them, so a generator claiming recipes (see
+    `claimed_recipes`) keeps the stages busy from the first recipe to the last,
+    instead of draining the pipeline after every claimed batch.
+
+    Each stage runs in its own threads and stages are connected by queues holding
+    at most `queue_size` recipes. Only the persist stage, which runs in the calling
+    thread, touches `session`; the match stage uses its own sessions. The
+    persist stage releases the lease of each recipe it saves and commits every
+    `commit_every` recipes.
+
+    The parse stage takes every extracted recipe waiting for it, up to
+    `queue_size`, and parses their ingredient lines together (see
+    `parse_scraped_ingredients`), so a `parser_pool` gets large inputs.
+
+    The embed stage takes up to `embed_batch_recipes` recipes at once, and
+    encodes their ingredients in calls of at most INGREDIENT_EMBEDDING_BATCH_SIZE
+    descriptions (see `embed_ingredients`).
+    """
+    model = embedding_model if embedding_model is not None else get_model()
+    fetcher = fetcher or RecipeFetcher()
+    engine = session.get_bind()
+
+    def fetch(item):
+        recipe_id, url = item
+        try:
+            return recipe_id, url, fetcher.fetch(url)
+        except requests.exceptions.RequestException as e:
+            logger.error(e)
+            return recipe_id, url, None
+
+    def extract(item):
+        recipe_id, url, page = item
+        scraped = None
+        if page is not None:
+            scraped = extract_recipe(url, html=page, parse_ingredient_lines=False)
+        return recipe_id, scraped
+
+    def parse(items):
+        parse_scraped_ingredients(
+            [scraped for _, scraped in items],
+            parse_store=parse_store,
+            parser_pool=parser_pool,
+        )
+        return items
+
+    def ingredients_of(items):
+        return [
+            ingredient
+            for _, scraped in items
+            if scraped is not None
+            for ingredient in scraped.ingredients
+        ]
+
+    def embed(items):
+        embed_ingredients(ingredients_of(items), model)
+        return items
+
+    def match(items):
+        with Session(engine) as match_session:
+            match_ingredients(
+                ingredients_of(items),
+                match_session,
+                price_index=price_index,
+                nutrition_index=nutrition_index,
+                link_by_id=True,
+            )
+        return items
+
+    stages = [
+        Stage("fetch", fetch, workers=fetch_workers),
+        Stage("extract", extract, workers=parse_workers),
+        Stage("parse", parse, batch_size=queue_size),
+        Stage("embed", embed, batch_size=embed_batch_recipes),
+        Stage("match", match, workers=match_workers, batch_size=queue_size),
+    ]
+    outputs = run_stages(items, stages, queue_size=queue_size)
+    n_enriched = 0
+    for recipe_id, scraped in tqdm(
+        outputs, desc="Enriching", total=n, disable=STAGE == PROD
+    ):
+        recipe = apply_scraped_recipe(session.get(Recipe, recipe_id), scraped)
+        # Released when the recipe is committed
+        recipe.enrichment_lease_until = None
+        session.add(recipe)
+        n_enriched += 1
+        if n_enriched % commit_every == 0:
+            session.commit()
+    session.commit()
+    return n_enriched
+
+
+def claim_recipes_statement(batch_size: int, retry_before: datetime, lease: timedelta):
+    """UPDATE leasing up to `batch_size` recipes to enrich, returning their ids
+
+    Recipes are pending if they were never enriched and did not fail since
+    `retry_before`, and claimable if no other worker holds an unexpired lease
+    on them. The candidates are read from the partial index of unenriched
+    recipes and locked with FOR UPDATE SKIP LOCKED, so that concurrent workers
+    claim disjoint batches without waiting on each other. The lease, measured
+    with the database clock, lets another worker take over the recipes of a
+    worker that died.
+
+    """
+    pending = (
+        select(Recipe.id)
+        .where(Recipe.enriched_at == None)  # noqa
+        .where(
+            or_(
+                Recipe.enrichment_failed_at == None,  # noqa
+                Recipe.enrichment_failed_at < retry_before,
+            )
+        )
+        .where(
+            or_(
+                Recipe.enrichment_lease_until == None,  # noqa
+                Recipe.enrichment_lease_until < func.now(),
+            )
+        )
+        .order_by(Recipe.id)
+        .limit(batch_size)
+        .with_for_update(skip_locked=True)
+    )
+    return (
+        update(Recipe)
+        .where(Recipe.id.in_(pending.scalar_subquery()))
+        .values(enrichment_lease_until=func.now() + lease)
+        .returning(Recipe.id)
+    )
+
+
+def claim_recipes(
+    engine: Engine,
+    batch_size: int,
+    retry_enrichment_after: timedelta,
+    lease: timedelta,
+) -> List[int]:
+    """Lease a batch of recipes to enrich, see `claim_recipes_statement`"""
+    statement = claim_recipes_statement(
+        batch_size, datetime.now() - retry_enrichment_after, lease
+    )
+    with engine.begin() as conn:
+        return list(conn.execute(statement).scalars().all())
+
+
+def claimed_recipes(
+    engine: Engine,
+    max_enrichments: int,
+    batch_size: int,
+    retry_enrichment_after: timedelta,
+    lease: timedelta,
+) -> Iterator[Tuple[int, str]]:
+    """Claim recipes batch by batch as they are consumed, see `claim_recipes`
+
+    Yields the (id, source url) of up to `max_enrichments` recipes. The next
+    batch is only claimed once the previous one is consumed, so the leases
+    start about when the recipes are enriched.
+
+    """
+    n_claimed = 0
+    while n_claimed < max_enrichments:
+        recipe_ids = claim_recipes(
+            engine,
+            min(batch_size, max_enrichments - n_claimed),
+            retry_enrichment_after,
+            lease,
+        )
+        if len(recipe_ids) == 0:
+            logger.info("No recipes left to enrich")
+            return
+        with Session(engine) as session:
+            rows = session.exec(
+                select(Recipe.id, Recipe.source_url)
+                .where(Recipe.id.in_(recipe_ids))
+                .order_by(Recipe.id)
+            ).all()
+        for recipe_id, source_url in rows:
+            yield recipe_id, source_url
+        n_claimed += len(recipe_ids)
+
+
 def enrich_recipes(
     engine: Engine,
     max_enrichments: int = 150,
     batch_size: int = 10,
     retry_enrichment_after: Optional[timedelta] = None,
+    lease: Optional[timedelta] = None,
+    use_vector_index: bool = False,
+    vector_index_snapshot_dir: Optional[str] = None,
+    fetch_workers: int = 1,
+    max_requests_per_host: int = 2,
+    staged: bool = False,
+    parse_workers: int = 2,
+    match_workers: int = 2,
+    queue_size: int = 32,
+    embed_batch_recipes: int = 8,
+    html_cache: Optional[HtmlCache] = None,
+    parse_store: Optional[IngredientParseStore] = None,
+    parser_pool: Optional[IngredientParserPool] = None,
 ):
     """
     Retrieve recipes from the database and enrich them
@@ -139,33 +506,123 @@ def enrich_recipes(
     max_api_calls : int
         The maximum number of API calls to make
     batch_size : int
-        The number of recipes to enrich at a time
+        The number of recipes claimed, and committed, at a time
     retry_enrichment_after : timedelta, optional
         The time after which to retry enrichment, if None is passed, defaults to 1 day
+    lease : timedelta, optional
+        How long a batch is reserved for this worker, by default 30 minutes.
+        Several workers can enrich recipes concurrently: each one claims its
+        batches with `claim_recipes`, and the recipes of a worker that stopped
+        are claimed by others once its lease expires.
+    use_vector_index : bool, optional
+        Match ingredient prices and nutrition against in-memory indices instead of
+        querying the database for every batch
+    vector_index_snapshot_dir : str, optional
+        Directory where the in-memory indices are snapshotted between runs
+    fetch_workers : int, optional
+        Number of threads downloading recipe pages. If 1, recipes are fetched
+        one after another.
+    max_requests_per_host : int, optional
+        Maximum number of concurrent requests to the same site
+    staged : bool, optional
+        Run the whole enrichment as one pipeline of overlapping claim, fetch,
+        extract, parse, embed, match and persist stages, see
+        `_enrich_recipes_staged`. The vector indices are refreshed once, before
+        it starts.
+    parse_workers : int, optional
+        Staged mode: number of threads extracting recipes from their pages
+    match_workers : int, optional
+        Staged mode: number of threads estimating ingredient price and nutrition
+    queue_size : int, optional
+        Staged mode: maximum number of recipes waiting between two stages
+    embed_batch_recipes : int, optional
+        Staged mode: maximum number of recipes whose ingredients are embedded
+        together. The encode calls themselves are bounded by the number of
+        ingredients, INGREDIENT_EMBEDDING_BATCH_SIZE.
+    html_cache : HtmlCache, optional
+        Cache of downloaded recipe pages, used instead of re-downloading pages
+        that have not changed
+    parse_store : IngredientParseStore, optional
+        Persistent store of parsed ingredient lines shared between runs
+    parser_pool : IngredientParserPool, optional
+        Process pool parsing ingredient lines. The lines of many recipes are
+        submitted to it at once: a whole batch, or in staged mode every recipe
+        waiting to be parsed.
     """
-    # Query for recipes that need to be enriched
     if retry_enrichment_after is None:
         retry_enrichment_after = timedelta(days=1)
+    if lease is None:
+        lease = timedelta(minutes=30)
+    price_index, nutrition_index = None, None
+    if use_vector_index:
+        price_index = IngredientVectorIndex(
+            IngredientPrice,
+            payload_column="price_100grams",
+            snapshot_dir=vector_index_snapshot_dir,
+        )
+        nutrition_index = IngredientVectorIndex(
+            IngredientNutrition, snapshot_dir=vector_index_snapshot_dir
+        )
+    # Loaded once, or a client of the embedding service if one is configured
+    embedding_model = get_model()
+    fetcher = None
+    if fetch_workers > 1 or staged or html_cache is not None:
+        fetcher = RecipeFetcher(max_per_host=max_requests_per_host, cache=html_cache)
+    if staged:
+        with Session(engine) as session:
+            if use_vector_index:
+                price_index.refresh(session)
+                nutrition_index.refresh(session)
+            _enrich_recipes_staged(
+                session,
+                claimed_recipes(
+                    engine, max_enrichments, batch_size, retry_enrichment_after, lease
+                ),
+                max_enrichments,
+                price_index=price_index,
+                nutrition_index=nutrition_index,
+                fetcher=fetcher,
+                fetch_workers=fetch_workers,
+                parse_workers=parse_workers,
+                match_workers=match_workers,
+                queue_size=queue_size,
+                parse_store=parse_store,
+                parser_pool=parser_pool,
+                embedding_model=embedding_model,
+                embed_batch_recipes=embed_batch_recipes,
+                commit_every=batch_size,
+            )
+        return
     i = 0
     batch_size = batch_size if batch_size < max_enrichments else max_enrichments
     while i < max_enrichments:
+        # Reserve the batch, so that concurrent workers never enrich it too
+        recipe_ids = claim_recipes(engine, batch_size, retry_enrichment_after, lease)
+        if len(recipe_ids) == 0:
+            logger.info("No recipes left to enrich")
+            break
         with Session(engine) as session:
-            now = datetime.now()
-            statement = (
-                select(Recipe)
-                .where(
-                    (
-                        (Recipe.enriched_at == None)  # noqa
-                        & (Recipe.enrichment_failed_at == None)  # noqa
-                    )
-                    | (Recipe.enrichment_failed_at < now - retry_enrichment_after)
-                    | Recipe.instructions
-                    == None  # noqa
-                )
-                .limit(batch_size)
+            if use_vector_index:
+                price_index.refresh(session)
+                nutrition_index.refresh(session)
+            recipes = session.exec(
+                select(Recipe).where(Recipe.id.in_(recipe_ids)).order_by(Recipe.id)
+            ).all()
+            for recipe in recipes:
+                # Released when the batch is committed
+                recipe.enrichment_lease_until = None
+            _enrich_recipes_batch(
+                session,
+                recipes,
+                batch_size,
+                price_index=price_index,
+                nutrition_index=nutrition_index,
+                fetcher=fetcher,
+                fetch_workers=fetch_workers,
+                parse_store=parse_store,
+                parser_pool=parser_pool,
+                embedding_model=embedding_model,
             )
-            recipes = session.exec(statement)
-            _enrich_recipes_batch(session, recipes, batch_size)
             session.commit()
             i += batch_size
 
@@ -173,7 +630,10 @@ def enrich_recipes(
 def update_recipe_db():
     """Update recipe database with new pins from pinterest board"""
 
-    load_dotenv()
+    # Imported here as selenium is only used to sync the board
+    from selenium.common.exceptions import InvalidSessionIdException
+
+    engine = get_engine()
 
     # Get pinterest links
     logger.info("Getting pinterest links")
@@ -182,11 +642,11 @@ def update_recipe_db():
         raise ValueError("PINTEREST_BOARD_NAME environment variable not set")
 
     try:
-        pins = get_pinterest_links(board_name)
-        if len(pins) > 0:
-            new_pins = find_pins_not_in_db(pins, engine)
-            logger.info(f"Found {len(new_pins)} new pins. Inserting into recipe table.")
-            insert_pins_into_db(new_pins, engine)
+        sync_pinterest_board(
+            board_name,
+            engine,
+            page_size=int(os.environ.get("PINTEREST_PAGE_SIZE", 50)),
+        )
     except requests.exceptions.HTTPError as e:
         logger.error("Failed to fetch Pinterest links due to a login issue: %s", e)
     except InvalidSessionIdException as e:
@@ -195,10 +655,56 @@ def update_recipe_db():
     # Enrich recipes
     logger.info("Enriching recipes")
     max_enrichments = int(os.environ.get("MAX_ENRICHMENTS", 150))
+    staged = os.environ.get("ENRICHMENT_STAGED", "false").lower() == "true"
+    parse_store = None
+    if os.environ.get("PERSIST_INGREDIENT_PARSES", "false").lower() == "true":
+        parse_store = IngredientParseStore(engine)
+    html_cache = None
+    if os.environ.get("HTML_CACHE_DIR") is not None:
+        html_cache = HtmlCache(
+            os.environ["HTML_CACHE_DIR"],
+            max_bytes=int(os.environ.get("HTML_CACHE_MAX_MB", 1024)) * 1024**2,
+            cache_only=os.environ.get("HTML_CACHE_ONLY", "false").lower() == "true",
+        )
+    parser_pool = None
+    parse_processes = int(os.environ.get("ENRICHMENT_PARSE_PROCESSES", 0))
+    if parse_processes > 0:
+        parser_pool = IngredientParserPool(processes=parse_processes)
+    use_vector_index = (
+        os.environ.get("USE_INGREDIENT_VECTOR_INDEX", "false").lower() == "true"
+    )
     try:
-        enrich_recipes(engine, max_enrichments=max_enrichments)
+        enrich_recipes(
+            engine,
+            max_enrichments=max_enrichments,
+            use_vector_index=use_vector_index,
+            vector_index_snapshot_dir=os.environ.get(
+                "INGREDIENT_VECTOR_INDEX_SNAPSHOT_DIR"
+            ),
+            fetch_workers=int(os.environ.get("ENRICHMENT_FETCH_WORKERS", 1)),
+            max_requests_per_host=int(
+                os.environ.get("ENRICHMENT_MAX_REQUESTS_PER_HOST", 2)
+            ),
+            batch_size=int(os.environ.get("ENRICHMENT_BATCH_SIZE", 10)),
+            staged=staged,
+            lease=timedelta(
+                minutes=float(os.environ.get("ENRICHMENT_LEASE_MINUTES", 30))
+            ),
+            parse_workers=int(os.environ.get("ENRICHMENT_PARSE_WORKERS", 2)),
+            match_workers=int(os.environ.get("ENRICHMENT_MATCH_WORKERS", 2)),
+            queue_size=int(os.environ.get("ENRICHMENT_QUEUE_SIZE", 32)),
+            embed_batch_recipes=int(
+                os.environ.get("ENRICHMENT_EMBED_BATCH_RECIPES", 8)
+            ),
+            html_cache=html_cache,
+            parse_store=parse_store,
+            parser_pool=parser_pool,
+        )
     except ValueError as e:
         logger.error(e)
+    finally:
+        if parser_pool is not None:
+            parser_pool.close()
 
 
 if __name__ == "__main__":
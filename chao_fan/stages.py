@@ -0,0 +1,180 @@
+"""
+Run a sequence of processing stages concurrently, connected by bounded queues
+"""
+
+import logging
+import queue
+import threading
+from dataclasses import dataclass
+from typing import Any, Callable, Iterable, Iterator, List, Optional
+
+logger = logging.getLogger(__name__)
+
+_DONE = object()
+
+
+@dataclass
+class Stage:
+    """A step of a staged pipeline
+
+    Parameters
+    ----------
+    name : str
+        Name of the stage, used for the worker thread names
+    function : Callable
+        Called on each item, or on a list of items if `batch_size` is set.
+        Returns the item passed to the next stage, or a list of them when batched.
+        Items for which it returns None are dropped.
+    workers : int, optional
+        Number of threads running the stage, by default 1
+    batch_size : int, optional
+        If set, the function receives up to `batch_size` items at once: whatever
+        is waiting in the input queue when a worker becomes free.
+
+    """
+
+    name: str
+    function: Callable[[Any], Any]
+    workers: int = 1
+    batch_size: Optional[int] = None
+
+
+class _StageFailed(Exception):
+    pass
+
+
+def _take_batch(
+    inbox: queue.Queue, batch_size: Optional[int], stop: threading.Event
+) -> List[Any]:
+    """Block for one item, then take whatever else is already waiting"""
+    while True:
+        if stop.is_set():
+            raise _StageFailed()
+        try:
+            items = [inbox.get(timeout=0.1)]
+            break
+        except queue.Empty:
+            continue
+    while batch_size is not None and len(items) < batch_size:
+        if items[-1] is _DONE:
+            break
+        try:
+            items.append(inbox.get_nowait())
+        except queue.Empty:
+            break
+    return items
+
+
+def run_stages(
+    items: Iterable[Any], stages: List[Stage], queue_size: int = 16
+) -> Iterator[Any]:
+    """Push items through the stages and yield the outputs of the last one
+
+    Every stage runs in its own threads, so I/O bound, CPU bound and model
+    inference stages overlap. Queues between stages hold at most `queue_size`
+    items, so a slow stage makes the earlier ones wait instead of buffering
+    the whole input in memory. Outputs are yielded in completion order.
+
+    If a stage raises, the remaining work is abandoned and the exception is
+    raised from the generator.
+
+    """
+    queues = [queue.Queue(maxsize=queue_size) for _ in range(len(stages) + 1)]
+    errors: List[BaseException] = []
+    stop = threading.Event()
+
+    def put(q: queue.Queue, item: Any) -> None:
+        # Time out periodically so that workers notice when the pipeline stops
+        while True:
+            if stop.is_set():
+                raise _StageFailed()
+            try:
+                q.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def feed() -> None:
+        try:
+            for item in items:
+                put(queues[0], item)
+            put(queues[0], _DONE)
+        except _StageFailed:
+            pass
+        except BaseException as e:
+            errors.append(e)
+            stop.set()
+
+    def work(stage: Stage, inbox: queue.Queue, outbox: queue.Queue, done) -> None:
+        try:
+            while True:
+                batch = _take_batch(inbox, stage.batch_size, stop)
+                finished = batch[-1] is _DONE
+                if finished:
+                    batch.pop()
+                    # Let the other workers of this stage see the end too
+                    put(inbox, _DONE)
+                if len(batch) > 0:
+                    if stage.batch_size is None:
+                        outputs = [stage.function(item) for item in batch]
+                    else:
+                        outputs = stage.function(batch)
+                    for output in outputs:
+                        if output is not None:
+                            put(outbox, output)
+                if finished:
+                    break
+        except _StageFailed:
+            pass
+        except BaseException as e:
+            logger.error(f"Stage {stage.name} failed: {e}")
+            errors.append(e)
+            stop.set()
+        finally:
+            done()
+
+    threads = [threading.Thread(target=feed, name="feed", daemon=True)]
+    for i, stage in enumerate(stages):
+        remaining = [stage.workers]
+        lock = threading.Lock()
+
+        def done(outbox=queues[i + 1], remaining=remaining, lock=lock) -> None:
+            # The last worker of a stage closes the next queue
+            with lock:
+                remaining[0] -= 1
+                last = remaining[0] == 0
+            if last and not stop.is_set():
+                try:
+                    put(outbox, _DONE)
+                except _StageFailed:
+                    pass
+
+        for j in range(stage.workers):
+            threads.append(
+                threading.Thread(
+                    target=work,
+                    args=(stage, queues[i], queues[i + 1], done),
+                    name=f"{stage.name}-{j}",
+                    daemon=True,
+                )
+            )
+    for thread in threads:
+        thread.start()
+
+    try:
+        while True:
+            try:
+                output = queues[-1].get(timeout=0.1)
+            except queue.Empty:
+                if stop.is_set():
+                    break
+                continue
+            if output is _DONE:
+                break
+            yield output
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
+    if errors:
+        raise errors[0]
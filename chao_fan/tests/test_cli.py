@@ -0,0 +1,74 @@
+from datetime import datetime, timezone
+
+import pytest
+from sqlmodel import Session, SQLModel, create_engine, select
+
+from chao_fan import cli
+from chao_fan.models import IngredientPrice, Recipe
+
+
+def test_setup_db_adopts_embeddings_when_adding_provenance(mocker, monkeypatch):
+    monkeypatch.delenv("EMBEDDING_MODEL_ID", raising=False)
+    monkeypatch.delenv("EMBEDDING_BACKEND", raising=False)
+    mocker.patch("chao_fan.cli.get_engine")
+    mocker.patch("chao_fan.cli.SQLModel.metadata.create_all")
+    mocker.patch("chao_fan.cli.backfill_canonical_urls")
+    mocker.patch("sqlalchemy.Index.create")
+
+    def add_missing_columns(engine, table):
+        if table.name == "ingredientprice":
+            return ["embedding_model", "embedding_hash"]
+        return []
+
+    mocker.patch("chao_fan.cli.add_missing_columns", side_effect=add_missing_columns)
+    adopt = mocker.patch(
+        "chao_fan.embedding_backfill.adopt_unversioned_embeddings", return_value=3
+    )
+    cli.setup_db()
+    adopt.assert_called_once_with(
+        mocker.ANY, IngredientPrice, "sentence-transformers/all-MiniLM-L6-v2"
+    )
+
+
+@pytest.fixture
+def engine():
+    engine = create_engine("sqlite://")
+    SQLModel.metadata.create_all(engine)
+    with Session(engine) as session:
+        session.add_all(
+            [
+                Recipe(id=1, source_url="https://example.com/soup/?utm_source=x"),
+                Recipe(
+                    id=2,
+                    source_url="https://example.com/soup",
+                    enriched_at=datetime.now(timezone.utc),
+                ),
+                Recipe(id=3, source_url="http://example.com/soup/"),
+                Recipe(id=4, source_url="https://example.com/stew"),
+            ]
+        )
+        session.commit()
+    return engine
+
+
+def test_backfill_canonical_urls_keeps_duplicates(engine):
+    cli.backfill_canonical_urls(engine)
+    with Session(engine) as session:
+        recipes = session.exec(select(Recipe).order_by(Recipe.id)).all()
+        # The enriched recipe gets the canonical url, nothing is deleted
+        assert [recipe.canonical_url for recipe in recipes] == [
+            None,
+            "https://example.com/soup",
+            None,
+            "https://example.com/stew",
+        ]
+        assert [recipe.id for recipe in cli.duplicate_recipes(session)] == [1, 3]
+
+
+@pytest.mark.parametrize("answer,remaining", [("no", 4), ("yes", 2)])
+def test_dedupe_recipes_asks_for_confirmation(engine, mocker, answer, remaining):
+    mocker.patch("chao_fan.cli.get_engine", return_value=engine)
+    mocker.patch("builtins.input", return_value=answer)
+    cli.dedupe_recipes()
+    with Session(engine) as session:
+        assert len(session.exec(select(Recipe)).all()) == remaining
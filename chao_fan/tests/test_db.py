@@ -0,0 +1,33 @@
+import pytest
+
+from chao_fan import db
+
+
+@pytest.fixture(autouse=True)
+def clear_engine():
+    db.get_engine.cache_clear()
+    yield
+    db.get_engine.cache_clear()
+
+
+def test_engine_requires_postgres_url(monkeypatch):
+    monkeypatch.delenv("POSTGRES_URL", raising=False)
+    with pytest.raises(ValueError):
+        db.get_engine()
+
+
+def test_engine_is_created_once(monkeypatch):
+    monkeypatch.setenv("POSTGRES_URL", "postgresql+psycopg2://localhost/chao_fan")
+    engine = db.get_engine()
+    assert db.engine is engine
+    assert engine.url.database == "chao_fan"
+
+
+def test_connections_use_iterative_scans(mocker):
+    dbapi_connection = mocker.MagicMock()
+    db.set_vector_search_parameters(dbapi_connection, None)
+    cursor = dbapi_connection.cursor.return_value.__enter__.return_value
+    cursor.execute.assert_any_call(
+        "SELECT set_config(%s, %s, false)", ("hnsw.iterative_scan", "strict_order")
+    )
+    dbapi_connection.commit.assert_called_once()
@@ -0,0 +1,173 @@
+from sqlalchemy.dialects import postgresql
+
+from chao_fan.embedding_backfill import (
+    adopt_unversioned_embeddings,
+    content_hash,
+    group_descriptions,
+    load_checkpoint,
+    needs_embedding,
+    pending_batches,
+    save_checkpoint,
+    update_embeddings_by_description_statement,
+    update_embeddings_statement,
+    write_embeddings,
+)
+from chao_fan.models import EmbeddingCheckpoint, IngredientPrice, Recipe
+
+
+def test_pending_batches_pages_by_id(mocker):
+    session = mocker.patch("chao_fan.embedding_backfill.Session").return_value
+    session = session.__enter__.return_value
+    session.exec.return_value.all.side_effect = [
+        [(1, "salt"), (5, "flour")],
+        [(9, "sugar")],
+        [],
+    ]
+    batches = list(pending_batches(mocker.Mock(), IngredientPrice, batch_size=2))
+    assert batches == [[(1, "salt"), (5, "flour")], [(9, "sugar")]]
+    # Each query starts after the last id of the previous batch
+    last_ids = [
+        call.args[0].compile().params["id_1"] for call in session.exec.call_args_list
+    ]
+    assert last_ids == [0, 5, 9]
+
+
+def test_update_embeddings_statement_is_set_based():
+    dialect = postgresql.psycopg2.dialect()
+    compiled = update_embeddings_statement(IngredientPrice).compile(dialect=dialect)
+    sql = str(compiled)
+    assert sql.startswith("UPDATE ingredientprice SET embedding_model=%(model_id)s")
+    assert "embedding=new_embeddings.embedding" in sql
+    assert "embedding_hash=new_embeddings.embedding_hash" in sql
+    assert "unnest(%(embeddings)s::VECTOR(384)[])" in sql
+    # Each embedding is bound as one vector literal
+    bind_type = compiled.binds["embeddings"].type.dialect_impl(dialect)
+    process = bind_type.bind_processor(dialect)
+    assert process([[1.0, 2.0], [3.0, 4.0]]) == ["[1.0,2.0]", "[3.0,4.0]"]
+
+
+def test_write_embeddings(mocker):
+    session = mocker.patch("chao_fan.embedding_backfill.Session").return_value
+    session = session.__enter__.return_value
+    write_embeddings(mocker.Mock(), IngredientPrice, [], [], [], "model")
+    session.exec.assert_not_called()
+    write_embeddings(
+        mocker.Mock(), IngredientPrice, [1, 2], [[1.0], [2.0]], ["a", "b"], "model"
+    )
+    session.exec.assert_called_once()
+    assert session.exec.call_args.kwargs["params"] == dict(
+        ids=[1, 2], embeddings=[[1.0], [2.0]], hashes=["a", "b"], model_id="model"
+    )
+    session.commit.assert_called_once()
+
+
+def test_pending_batches_stops_at_deadline(mocker):
+    session = mocker.patch("chao_fan.embedding_backfill.Session").return_value
+    session = session.__enter__.return_value
+    session.exec.return_value.all.return_value = [(1, "salt")]
+    mocker.patch("chao_fan.embedding_backfill.time.monotonic", side_effect=[0, 5, 10])
+    batches = pending_batches(mocker.Mock(), IngredientPrice, 1, deadline=10)
+    assert len(list(batches)) == 2
+
+
+def test_checkpoint_round_trip(mocker):
+    session = mocker.patch("chao_fan.embedding_backfill.Session").return_value
+    session = session.__enter__.return_value
+    session.get.return_value = None
+    assert load_checkpoint(mocker.Mock(), "ingredientprice") == 0
+    session.get.return_value = EmbeddingCheckpoint(name="ingredientprice", last_id=7)
+    assert load_checkpoint(mocker.Mock(), "ingredientprice") == 7
+
+    save_checkpoint(mocker.Mock(), "ingredientprice", 12, rows=100)
+    statement = session.exec.call_args.args[0]
+    sql = str(statement.compile(dialect=postgresql.psycopg2.dialect()))
+    assert "ON CONFLICT (name) DO UPDATE SET last_id" in sql
+    assert statement.compile().params["last_id"] == 12
+    session.commit.assert_called_once()
+
+
+def test_pending_batches_shard(mocker):
+    session = mocker.patch("chao_fan.embedding_backfill.Session").return_value
+    session = session.__enter__.return_value
+    session.exec.return_value.all.return_value = []
+    list(pending_batches(mocker.Mock(), IngredientPrice, 10, shard=(2, 4)))
+    statement = session.exec.call_args.args[0]
+    assert "ingredientprice.id % :id_2 = :param_1" in str(statement.compile())
+    assert statement.compile().params["id_2"] == 4
+
+
+def test_group_descriptions():
+    rows = [(1, "Salt"), (2, "salt "), (3, "Salt"), (4, "flour")]
+    assert group_descriptions(rows) == {"salt": ["Salt", "salt "], "flour": ["flour"]}
+
+
+def test_update_embeddings_by_description_statement():
+    statement = update_embeddings_by_description_statement(
+        IngredientPrice, shard=(1, 3)
+    )
+    sql = str(statement.compile(dialect=postgresql.psycopg2.dialect()))
+    assert "unnest(%(descriptions)s::VARCHAR[])" in sql
+    assert "ingredientprice.description = new_embeddings.description" in sql
+    # Up-to-date embeddings are never overwritten
+    assert "ingredientprice.embedding IS NULL" in sql
+    assert "ingredientprice.embedding_model IS DISTINCT FROM %(model_id)s" in sql
+    assert (
+        "ingredientprice.embedding_hash IS DISTINCT FROM md5(new_embeddings.description)"
+        in sql
+    )
+    assert "ingredientprice.id %" in sql
+
+
+def test_content_hash_matches_postgres_md5():
+    # SELECT md5('Salt, iodized') in Postgres
+    assert content_hash("Salt, iodized") == "f67529cc4264eb77dc1519b4fc5d3794"
+
+
+def test_needs_embedding():
+    assert str(needs_embedding(IngredientPrice)) == "ingredientprice.embedding IS NULL"
+    sql = str(needs_embedding(IngredientPrice, "model").compile())
+    assert "ingredientprice.embedding IS NULL OR" in sql
+    assert "ingredientprice.embedding_model IS DISTINCT FROM :embedding_model_1" in sql
+    assert (
+        "ingredientprice.embedding_hash IS DISTINCT FROM md5(ingredientprice.description)"
+        in sql
+    )
+
+
+def test_pending_batches_stale_rows(mocker):
+    session = mocker.patch("chao_fan.embedding_backfill.Session").return_value
+    session = session.__enter__.return_value
+    session.exec.return_value.all.return_value = []
+    list(pending_batches(mocker.Mock(), IngredientPrice, 10, model_id="model"))
+    statement = session.exec.call_args.args[0]
+    assert "embedding_model IS DISTINCT FROM" in str(statement.compile())
+    assert statement.compile().params["embedding_model_1"] == "model"
+
+
+def test_adopt_unversioned_embeddings(mocker):
+    session = mocker.patch("chao_fan.embedding_backfill.Session").return_value
+    session = session.__enter__.return_value
+    session.exec.return_value.rowcount = 3
+    assert adopt_unversioned_embeddings(mocker.Mock(), IngredientPrice, "model") == 3
+    sql = str(session.exec.call_args.args[0].compile())
+    assert "embedding_hash=md5(ingredientprice.description)" in sql
+    assert "ingredientprice.embedding_model IS NULL" in sql
+
+
+def test_adopt_unversioned_recipe_embeddings(mocker):
+    session = mocker.patch("chao_fan.embedding_backfill.Session").return_value
+    session = session.__enter__.return_value
+    adopt_unversioned_embeddings(mocker.Mock(), Recipe, "model")
+    sql = str(session.exec.call_args.args[0].compile())
+    # Recipes have no description to hash
+    assert sql.startswith("UPDATE recipe SET embedding_model=:embedding_model")
+    assert "embedding_hash" not in sql
+
+
+def test_pending_batches_skips_rows_without_description(mocker):
+    session = mocker.patch("chao_fan.embedding_backfill.Session").return_value
+    session = session.__enter__.return_value
+    session.exec.return_value.all.return_value = []
+    list(pending_batches(mocker.Mock(), IngredientPrice, 10))
+    sql = str(session.exec.call_args.args[0].compile())
+    assert "ingredientprice.description IS NOT NULL" in sql
@@ -0,0 +1,48 @@
+import numpy as np
+
+from chao_fan.embedding_cache import EmbeddingCache, embedding_key
+from chao_fan.integrations.sentence_transformer import generate_embeddings
+
+
+def fake_encode(sentences, **kwargs):
+    return np.array([[float(len(s)), 1.0] for s in sentences])
+
+
+def test_embedding_key_normalizes_text():
+    assert embedding_key("model", "Olive  Oil ") == embedding_key("model", "olive oil")
+    assert embedding_key("model", "salt") != embedding_key("other_model", "salt")
+
+
+def test_memory_lru_eviction():
+    cache = EmbeddingCache("model", memory_size=2)
+    cache.put_many(["a", "b"], [[1.0], [2.0]])
+    cache.get_many(["a"])
+    cache.put_many(["c"], [[3.0]])
+    results = cache.get_many(["a", "b", "c"])
+    assert results[1] is None
+    assert results[0].tolist() == [1.0]
+    assert results[2].tolist() == [3.0]
+
+
+def test_disk_cache_persists_per_model(tmp_path):
+    path = str(tmp_path / "embeddings.sqlite")
+    EmbeddingCache("model", path=path).put_many(["salt"], [[1.0, 2.0]])
+    assert EmbeddingCache("model", path=path).get_many(["Salt"])[0].tolist() == [
+        1.0,
+        2.0,
+    ]
+    assert EmbeddingCache("new_model", path=path).get_many(["salt"]) == [None]
+
+
+def test_generate_embeddings_only_encodes_misses(mocker):
+    model = mocker.Mock()
+    model.encode.side_effect = fake_encode
+    cache = EmbeddingCache("model")
+    cache.put_many(["salt"], [[0.0, 0.0]])
+    embeddings = generate_embeddings(
+        ["salt", "olive oil", "olive oil"], model=model, cache=cache
+    )
+    assert embeddings == [[0.0, 0.0], [9.0, 1.0], [9.0, 1.0]]
+    model.encode.assert_called_once_with(["olive oil"])
+    assert generate_embeddings("olive oil", model=model, cache=cache) == [9.0, 1.0]
+    assert model.encode.call_count == 1
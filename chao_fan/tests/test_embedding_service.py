@@ -0,0 +1,90 @@
+import os
+import stat
+import threading
+
+import numpy as np
+import pytest
+
+from chao_fan.embedding_service import (
+    EmbeddingClient,
+    EmbeddingServer,
+    parse_address,
+)
+
+
+class FakeModel:
+    def __init__(self):
+        self.batches = []
+
+    def encode(self, sentences, **kwargs):
+        self.batches.append(list(sentences))
+        if "fail" in sentences:
+            raise ValueError("cannot encode")
+        return np.array([[len(s), 1.0] for s in sentences])
+
+
+@pytest.fixture
+def server(tmp_path):
+    server = EmbeddingServer(
+        FakeModel(), str(tmp_path / "embeddings.sock"), max_wait=0.2
+    )
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.close()
+
+
+def test_parse_address():
+    assert parse_address("/tmp/embeddings.sock") == "/tmp/embeddings.sock"
+    assert parse_address("localhost:5000") == ("localhost", 5000)
+
+
+def test_tcp_requires_authkey():
+    with pytest.raises(ValueError):
+        EmbeddingServer(FakeModel(), "localhost:0")
+
+
+def test_unix_socket_is_private(tmp_path):
+    address = tmp_path / "service" / "embeddings.sock"
+    server = EmbeddingServer(FakeModel(), str(address))
+    try:
+        assert stat.S_IMODE(os.stat(address.parent).st_mode) == 0o700
+        assert stat.S_IMODE(os.stat(address).st_mode) == 0o600
+    finally:
+        server.close()
+
+
+def test_shared_directories_are_refused(tmp_path):
+    shared = tmp_path / "shared"
+    shared.mkdir(mode=0o777)
+    shared.chmod(0o1777)
+    with pytest.raises(PermissionError):
+        EmbeddingServer(FakeModel(), str(shared / "embeddings.sock"))
+    # Clients would unpickle whatever a socket planted there sends back
+    with pytest.raises(PermissionError):
+        EmbeddingClient(str(shared / "embeddings.sock")).encode(["a"])
+
+
+def test_concurrent_requests_are_batched(server):
+    client = EmbeddingClient(str(server.address))
+    results = {}
+
+    def request(i):
+        results[i] = client.encode(["a" * i, "b"])
+
+    threads = [threading.Thread(target=request, args=(i,)) for i in range(1, 9)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    for i in range(1, 9):
+        np.testing.assert_array_equal(results[i], [[i, 1.0], [1, 1.0]])
+    assert len(server.model.batches) < 8
+    assert client.encode("abc").tolist() == [3.0, 1.0]
+
+
+def test_errors_are_returned_to_the_client(server):
+    client = EmbeddingClient(str(server.address))
+    with pytest.raises(RuntimeError, match="cannot encode"):
+        client.encode(["fail"])
+    assert client.encode(["ok"]).shape == (1, 2)
@@ -0,0 +1,36 @@
+from chao_fan.models import RecipeIngredient
+from chao_fan.pipelines.generate_embedings import (
+    max_run_seconds,
+    rematch_recipe_ingredients,
+    warn_stale_recipe_embeddings,
+)
+
+
+def test_rematch_recipe_ingredients(mocker):
+    session = mocker.patch("chao_fan.pipelines.generate_embedings.Session")
+    session = session.return_value.__enter__.return_value
+    ingredients = [RecipeIngredient(id=1, ingredient_nutrition_id=5)]
+    session.exec.return_value.all.return_value = ingredients
+    match = mocker.patch("chao_fan.integrations.recipe_scrapers.match_ingredients")
+    rematch_recipe_ingredients(mocker.Mock(), [1])
+    # The previous nutrition match is cleared before matching again
+    assert ingredients[0].ingredient_nutrition_id is None
+    match.assert_called_once_with(ingredients, session, link_by_id=True)
+    session.commit.assert_called_once()
+
+
+def test_warn_stale_recipe_embeddings(mocker, caplog):
+    session = mocker.patch("chao_fan.pipelines.generate_embedings.Session")
+    session = session.return_value.__enter__.return_value
+    session.exec.return_value.one.return_value = 2
+    warn_stale_recipe_embeddings(mocker.Mock(), "model")
+    assert "2 recipe embeddings were not produced by model" in caplog.text
+    sql = str(session.exec.call_args.args[0].compile())
+    assert "recipe.embedding_model IS DISTINCT FROM" in sql
+
+
+def test_max_run_seconds_covers_batches_in_flight():
+    # Read, encoded and written one after another: only the current batch
+    assert max_run_seconds(600, 0, 30) == 630
+    # Two batches queued before the encoder and the writer, and one in each
+    assert max_run_seconds(600, 2, 30) == 600 + 6 * 30
@@ -0,0 +1,57 @@
+import pytest
+import requests
+
+from chao_fan.integrations.html_cache import HtmlCache
+from chao_fan.integrations.recipe_fetcher import CacheMiss, RecipeFetcher
+
+
+def test_put_get_by_canonical_url(tmp_path):
+    cache = HtmlCache(str(tmp_path))
+    cache.put("https://a.com/recipe/?utm_source=x", b"<html>", etag='"v1"')
+    page = cache.get("http://A.com/recipe")
+    assert page.content == b"<html>"
+    assert page.etag == '"v1"'
+    assert cache.get("https://a.com/other") is None
+
+
+def test_lru_eviction(tmp_path):
+    cache = HtmlCache(str(tmp_path))
+    pages = {f"https://a.com/{i}": bytes(range(256)) * 4 for i in range(3)}
+    for url, content in pages.items():
+        cache.put(url, content)
+    cache.get("https://a.com/0")
+    cache.max_bytes = cache.size - 1
+    cache.put("https://a.com/0", pages["https://a.com/0"])
+    assert cache.get("https://a.com/1") is None
+    assert cache.get("https://a.com/0") is not None
+    assert cache.get("https://a.com/2") is not None
+
+
+def test_fetch_revalidates_cached_page(tmp_path, mocker):
+    cache = HtmlCache(str(tmp_path))
+    cache.put("https://a.com/recipe", b"cached", etag='"v1"')
+    response = mocker.Mock(status_code=304)
+    get = mocker.patch.object(requests.Session, "get", return_value=response)
+    assert RecipeFetcher(cache=cache).fetch("https://a.com/recipe") == b"cached"
+    assert get.call_args.kwargs["headers"] == {"If-None-Match": '"v1"'}
+
+
+def test_fetch_stores_new_page(tmp_path, mocker):
+    cache = HtmlCache(str(tmp_path))
+    response = mocker.Mock(
+        status_code=200, content=b"new", headers={"Last-Modified": "yesterday"}
+    )
+    mocker.patch.object(requests.Session, "get", return_value=response)
+    assert RecipeFetcher(cache=cache).fetch("https://a.com/recipe") == b"new"
+    assert cache.get("https://a.com/recipe").last_modified == "yesterday"
+
+
+def test_fetch_cache_only(tmp_path, mocker):
+    cache = HtmlCache(str(tmp_path), cache_only=True)
+    cache.put("https://a.com/recipe", b"cached")
+    get = mocker.patch.object(requests.Session, "get")
+    fetcher = RecipeFetcher(cache=cache)
+    assert fetcher.fetch("https://a.com/recipe") == b"cached"
+    with pytest.raises(CacheMiss):
+        fetcher.fetch("https://a.com/other")
+    get.assert_not_called()
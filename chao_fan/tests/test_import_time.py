@@ -0,0 +1,67 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+# Modules that take seconds to import and must only be loaded when used
+HEAVY_MODULES = ["torch", "sentence_transformers", "transformers", "nltk"]
+
+# Entry points of the CLI and of the cron jobs
+ENTRY_POINTS = [
+    "chao_fan.cli",
+    "chao_fan.integrations.recipe_scrapers",
+    "chao_fan.pipelines.generate_embedings",
+    "chao_fan.pipelines.update_recipe_db",
+]
+
+# Dependencies every entry point needs, imported before the timed import so
+# that the budget only covers what chao_fan itself adds (about 0.1s)
+BASELINE_MODULES = [
+    "dotenv",
+    "numpy",
+    "pgvector.sqlalchemy",
+    "requests",
+    "sqlalchemy",
+    "sqlmodel",
+    "tqdm",
+]
+
+IMPORT_TIME_BUDGET_SECONDS = float(
+    os.environ.get("CHAO_FAN_IMPORT_TIME_BUDGET_SECONDS", 0.5)
+)
+
+
+def import_in_subprocess(module: str) -> subprocess.CompletedProcess:
+    baseline = ", ".join(BASELINE_MODULES)
+    code = f"import sys, {baseline}; import {module}; print(','.join(sys.modules))"
+    env = {k: v for k, v in os.environ.items() if k != "POSTGRES_URL"}
+    return subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        capture_output=True,
+        text=True,
+        env=env,
+        check=True,
+    )
+
+
+def cumulative_import_seconds(stderr: str, module: str) -> float:
+    for line in stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        fields = line.split("|")
+        if len(fields) == 3 and fields[2].strip() == module:
+            return int(fields[1]) / 1e6
+    raise ValueError(f"{module} not found in the import times")
+
+
+@pytest.mark.parametrize("module", ENTRY_POINTS)
+def test_entry_point_imports_are_lazy(module):
+    # Also checks that importing does not need a database URL
+    result = import_in_subprocess(module)
+    imported = result.stdout.strip().split(",")
+    assert [m for m in HEAVY_MODULES if m in imported] == []
+    assert "selenium" not in imported
+    seconds = cumulative_import_seconds(result.stderr, module)
+    assert seconds < IMPORT_TIME_BUDGET_SECONDS, (
+        f"Importing {module} took {seconds:.2f}s"
+    )
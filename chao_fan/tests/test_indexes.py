@@ -0,0 +1,76 @@
+import pytest
+
+from chao_fan.indexes import (
+    BINARY,
+    HALFVEC,
+    HNSW,
+    IVFFLAT,
+    VECTOR_TABLES,
+    create_vector_index_sql,
+    nearest_ids_sql,
+    vector_index_name,
+)
+
+
+def test_vector_tables():
+    assert set(VECTOR_TABLES) == {
+        "recipe",
+        "recipeingredient",
+        "ingredientprice",
+        "ingredientnutrition",
+    }
+
+
+def test_create_hnsw_index_sql():
+    sql = create_vector_index_sql(
+        "ingredientnutrition", HNSW, m=24, ef_construction=128
+    )
+    assert sql == (
+        "CREATE INDEX IF NOT EXISTS ingredientnutrition_embedding_hnsw_idx "
+        "ON ingredientnutrition USING hnsw (embedding vector_cosine_ops) "
+        "WITH (m = 24, ef_construction = 128)"
+    )
+
+
+def test_create_ivfflat_index_sql():
+    sql = create_vector_index_sql("ingredientprice", IVFFLAT, lists=50)
+    assert vector_index_name("ingredientprice", IVFFLAT) in sql
+    assert sql.endswith("WITH (lists = 50)")
+
+
+def test_create_index_sql_unknown_method():
+    with pytest.raises(ValueError):
+        create_vector_index_sql("recipe", "flat")
+
+
+def test_create_quantized_index_sql():
+    sql = create_vector_index_sql("ingredientnutrition", HNSW, quantization=HALFVEC)
+    assert sql.startswith(
+        "CREATE INDEX IF NOT EXISTS ingredientnutrition_embedding_halfvec_hnsw_idx "
+        "ON ingredientnutrition USING hnsw "
+        "((embedding::halfvec(384)) halfvec_cosine_ops)"
+    )
+    sql = create_vector_index_sql("ingredientnutrition", IVFFLAT, quantization=BINARY)
+    assert "((binary_quantize(embedding)::bit(384)) bit_hamming_ops)" in sql
+    with pytest.raises(ValueError):
+        create_vector_index_sql("recipe", HNSW, quantization="int4")
+
+
+def test_nearest_ids_sql_reranks_candidates():
+    assert "LIMIT :candidates" not in nearest_ids_sql("ingredientprice")
+    sql = nearest_ids_sql("ingredientprice", BINARY)
+    # The candidates are ordered like the expression index, then reranked exactly
+    assert "ORDER BY (binary_quantize(embedding)::bit(384)) <~>" in sql
+    assert "LIMIT :candidates" in sql
+    assert sql.rstrip().endswith(
+        "ORDER BY embedding <=> CAST(:embedding AS vector)\n        LIMIT :k"
+    )
+
+
+def test_nearest_ids_sql_applies_cutoff_before_candidates():
+    cutoff = "WHERE embedding <=> CAST(:embedding AS vector) > :cutoff"
+    assert cutoff not in nearest_ids_sql("ingredientprice", BINARY)
+    assert cutoff in nearest_ids_sql("ingredientprice", cosine_distance_cutoff=0.6)
+    sql = nearest_ids_sql("ingredientprice", BINARY, cosine_distance_cutoff=0.6)
+    # Recall is measured on the matching query: candidates come from beyond it
+    assert sql.index(cutoff) < sql.index("LIMIT :candidates")
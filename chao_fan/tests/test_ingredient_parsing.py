@@ -0,0 +1,67 @@
+import pytest
+
+from chao_fan.integrations import ingredient_parsing
+from chao_fan.integrations.ingredient_parsing import ParsedLine, parse_lines
+from chao_fan.integrations.recipe_scrapers import parse_ingredients
+
+
+@pytest.fixture
+def parse_line(mocker):
+    ingredient_parsing._memo.clear()
+    yield mocker.patch.object(
+        ingredient_parsing,
+        "parse_line",
+        side_effect=lambda line: ParsedLine(line.split()[-1], 1.0, "tsp"),
+    )
+    ingredient_parsing._memo.clear()
+
+
+def test_parse_lines_memoizes(parse_line):
+    results = parse_lines(["1 tsp  salt", "1 tsp salt", "2 cups flour"])
+    assert [r.description for r in results] == ["salt", "salt", "flour"]
+    assert parse_line.call_count == 2
+    parse_lines(["1 tsp salt "])
+    assert parse_line.call_count == 2
+
+
+def test_parse_lines_uses_store(parse_line, mocker):
+    store = mocker.Mock()
+    store.get_many.return_value = {"1 tsp salt": ParsedLine("salt", 1.0, "tsp")}
+    results = parse_lines(["1 tsp salt", "2 cups flour"], store=store)
+    assert results[0] == ParsedLine("salt", 1.0, "tsp")
+    store.get_many.assert_called_once_with(["1 tsp salt", "2 cups flour"])
+    parse_line.assert_called_once_with("2 cups flour")
+    store.put_many.assert_called_once_with(
+        {"2 cups flour": ParsedLine("flour", 1.0, "tsp")}
+    )
+
+
+def test_parse_ingredients(parse_line):
+    parse_line.side_effect = [ParsedLine("salt", 1.0, "tsp"), ParsedLine(None)]
+    ingredients = parse_ingredients(["1 tsp salt", None, "???"])
+    assert [i.description for i in ingredients] == ["salt", "???"]
+    assert [i.full_description for i in ingredients] == ["1 tsp salt", "???"]
+    assert ingredients[0].unit == "tsp"
+
+
+def test_parse_lines_uses_pool(parse_line, mocker):
+    pool = mocker.Mock()
+    pool.parse.return_value = [ParsedLine("flour", 2.0, "cup")]
+    results = parse_lines(["2 cups flour", "2 cups  flour"], pool=pool)
+    assert results == [ParsedLine("flour", 2.0, "cup")] * 2
+    pool.parse.assert_called_once_with(["2 cups flour"])
+    parse_line.assert_not_called()
+
+
+def test_parser_pool_chunks(parse_line, mocker):
+    pool = ingredient_parsing.IngredientParserPool.__new__(
+        ingredient_parsing.IngredientParserPool
+    )
+    pool.processes, pool.chunk_size = 2, 256
+    pool._executor = mocker.Mock()
+    pool._executor.map.side_effect = map
+    lines = [f"1 tsp spice{i}" for i in range(5)]
+    results = pool.parse(lines)
+    assert [r.description for r in results] == [f"spice{i}" for i in range(5)]
+    chunks = pool._executor.map.call_args.args[1]
+    assert [len(chunk) for chunk in chunks] == [3, 2]
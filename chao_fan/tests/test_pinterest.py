@@ -0,0 +1,53 @@
+from chao_fan.integrations.pinterest import board_pages, get_new_pins
+
+
+def pin_dict(i):
+    return {
+        "id": str(i),
+        "rich_summary": {"url": f"https://example.com/{i}", "site_name": "Example"},
+    }
+
+
+def test_board_pages_is_lazy(mocker):
+    pinterest = mocker.Mock()
+    pinterest.board_feed.side_effect = [[pin_dict(3)], [pin_dict(2)], []]
+    pages = board_pages(pinterest, "board", page_size=1)
+    assert next(pages) == [pin_dict(3)]
+    assert pinterest.board_feed.call_count == 1
+    # The first request starts from the top of the board
+    assert pinterest.board_feed.call_args.kwargs["reset_bookmark"] is True
+    assert list(pages) == [[pin_dict(2)]]
+    assert pinterest.board_feed.call_args.kwargs["reset_bookmark"] is False
+
+
+def test_get_new_pins_stops_at_watermark():
+    pages = iter([[pin_dict(9), pin_dict(8)], [pin_dict(7), pin_dict(6)], None])
+    new_pins, watermark = get_new_pins(pages, lambda urls: set(), last_pin_id="7")
+    assert [pin.id for pin in new_pins] == ["9", "8"]
+    assert watermark == "9"
+    # The page after the watermark is never requested
+    assert next(pages) is None
+
+
+def test_get_new_pins_stops_at_known_page():
+    known = {f"https://example.com/{i}" for i in [6, 7]}
+    pages = iter([[pin_dict(9), pin_dict(8)], [pin_dict(7), pin_dict(6)], None])
+    new_pins, watermark = get_new_pins(
+        pages, lambda urls: known & set(urls), last_pin_id="1"
+    )
+    assert [pin.id for pin in new_pins] == ["9", "8"]
+    assert watermark == "9"
+    assert next(pages) is None
+
+
+def test_get_new_pins_empty_board():
+    new_pins, watermark = get_new_pins(iter([]), lambda urls: set(), last_pin_id="3")
+    assert new_pins == []
+    assert watermark == "3"
+
+
+def test_get_new_pins_skips_known_and_linkless_pins():
+    pages = [[pin_dict(9), {"id": "8", "rich_summary": None}, pin_dict(7)]]
+    known = {"https://example.com/7"}
+    new_pins, _ = get_new_pins(pages, lambda urls: known & set(urls))
+    assert [pin.url for pin in new_pins] == ["https://example.com/9"]
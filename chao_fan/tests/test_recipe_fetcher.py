@@ -0,0 +1,41 @@
+import threading
+import time
+
+import requests
+
+from chao_fan.integrations.recipe_fetcher import RecipeFetcher
+
+
+def test_fetch_many_limits_requests_per_host(mocker):
+    active = {"a.com": 0, "b.com": 0}
+    max_active = {"a.com": 0, "b.com": 0}
+    lock = threading.Lock()
+
+    def get(self, url, **kwargs):
+        host = url.split("/")[2]
+        with lock:
+            active[host] += 1
+            max_active[host] = max(max_active[host], active[host])
+        time.sleep(0.02)
+        with lock:
+            active[host] -= 1
+        response = mocker.Mock()
+        response.content = url.encode()
+        return response
+
+    mocker.patch.object(requests.Session, "get", get)
+    fetcher = RecipeFetcher(max_per_host=2)
+    urls = [f"https://{host}/{i}" for i in range(6) for host in ["a.com", "b.com"]]
+    results = list(fetcher.fetch_many(urls, max_workers=8))
+    assert [url for url, _ in results] == urls
+    assert [page for _, page in results] == [url.encode() for url in urls]
+    assert max_active == {"a.com": 2, "b.com": 2}
+
+
+def test_fetch_many_returns_errors(mocker):
+    mocker.patch.object(
+        requests.Session, "get", side_effect=requests.ConnectionError("down")
+    )
+    fetcher = RecipeFetcher()
+    [(url, page)] = list(fetcher.fetch_many(["https://a.com/recipe"]))
+    assert isinstance(page, requests.ConnectionError)
@@ -1,10 +1,27 @@
+import os
+import uuid
 from unittest.mock import Mock
 
+import numpy as np
+import pytest
+from sqlalchemy import event, text
+from sqlalchemy.dialects import postgresql
+from sqlmodel import create_engine
+
+from chao_fan.db import set_vector_search_parameters
+
+from chao_fan.embedding_backfill import content_hash
+from chao_fan.indexes import create_vector_index
 from chao_fan.integrations.recipe_scrapers import (
+    IngredientPrice,
+    IngredientVectorIndex,
     RecipeIngredient,
     Session,
+    embed_ingredients,
     estimate_ingredient_nutrition,
+    estimate_ingredient_nutritions,
     estimate_ingredient_price,
+    estimate_ingredient_prices,
 )
 
 
@@ -62,3 +79,181 @@ def test_estimate_ingredient_nutrition_below_cutoff(mocker):
     session.exec().all.return_value = []
     result = estimate_ingredient_nutrition(ingredient, session)
     assert result is None
+
+
+def test_embed_ingredients_batches(mocker):
+    ingredients = [RecipeIngredient(description=f"ingredient {i}") for i in range(5)]
+    ingredients.append(RecipeIngredient(description=None))
+    model = mocker.Mock()
+    model.encode.side_effect = lambda sentences, **kwargs: np.array(
+        [[float(s.split()[-1])] for s in sentences]
+    )
+    embed_ingredients(ingredients, model, batch_size=2)
+    assert model.encode.call_count == 3
+    assert [ingredient.embedding for ingredient in ingredients[:5]] == [
+        [float(i)] for i in range(5)
+    ]
+    assert ingredients[0].embedding_model == "sentence-transformers/all-MiniLM-L6-v2"
+    assert ingredients[0].embedding_hash == content_hash("ingredient 0")
+    assert ingredients[5].embedding is None
+    assert ingredients[5].embedding_hash is None
+
+
+def test_estimate_ingredient_prices_bulk(mocker):
+    ingredients = [
+        RecipeIngredient(embedding=[0.1, 0.2, 0.3]),
+        RecipeIngredient(embedding=None),
+        RecipeIngredient(embedding=[0.3, 0.2, 0.1]),
+        RecipeIngredient(embedding=[0.2, 0.2, 0.2]),
+    ]
+    session = mocker.Mock(spec=Session)
+    session.exec().all.return_value = [(0, 1.0)] * 5 + [(2, 2.0)] * 5
+    result = estimate_ingredient_prices(ingredients, session)
+    assert result == [1.0, None, 2.0, None]
+
+
+def test_estimate_ingredient_prices_bulk_no_embeddings(mocker):
+    ingredients = [RecipeIngredient(embedding=None)]
+    session = mocker.Mock(spec=Session)
+    result = estimate_ingredient_prices(ingredients, session)
+    assert result == [None]
+    session.exec.assert_not_called()
+
+
+def test_estimate_ingredient_prices_bulk_binds_vectors(mocker):
+    ingredients = [
+        RecipeIngredient(embedding=[1.0, 2.0]),
+        RecipeIngredient(embedding=None),
+        RecipeIngredient(embedding=[3.0, 4.0]),
+    ]
+    session = mocker.Mock(spec=Session)
+    session.exec().all.return_value = []
+    estimate_ingredient_prices(ingredients, session)
+    statement = session.exec.call_args.args[0]
+    dialect = postgresql.psycopg2.dialect()
+    compiled = statement.compile(dialect=dialect)
+    assert "unnest(%(embeddings)s::VECTOR(384)[])" in str(compiled)
+    # Each embedding is bound as one vector literal, not as nested floats
+    bind = compiled.binds["embeddings"]
+    process = bind.type.dialect_impl(dialect).bind_processor(dialect)
+    assert process(bind.value) == ["[1.0,2.0]", "[3.0,4.0]"]
+    assert compiled.params["idxs"] == [0, 2]
+
+
+def test_estimate_ingredient_nutritions_bulk(mocker):
+    ingredients = [
+        RecipeIngredient(embedding=[0.1, 0.2, 0.3]),
+        RecipeIngredient(embedding=[0.3, 0.2, 0.1]),
+    ]
+    session = mocker.Mock(spec=Session)
+    mock_result = Mock()
+    session.exec().all.return_value = [(1, mock_result)]
+    result = estimate_ingredient_nutritions(ingredients, session)
+    assert result == [None, mock_result]
+
+
+def test_estimate_ingredient_nutritions_quantized(mocker):
+    ingredients = [RecipeIngredient(embedding=[0.1, 0.2, 0.3])]
+    session = mocker.Mock(spec=Session)
+    session.exec().all.return_value = []
+    estimate_ingredient_nutritions(
+        ingredients, session, quantization="binary", candidates=20
+    )
+    statement = session.exec.call_args.args[0]
+    sql = str(statement.compile(dialect=postgresql.psycopg2.dialect()))
+    # Candidates come from the binary representation, then are reranked exactly
+    assert (
+        "ORDER BY CAST(binary_quantize(ingredientnutrition.embedding) AS BIT(384)) <~>"
+        in sql
+    )
+    assert "ORDER BY candidates.embedding <=> queries.embedding" in sql
+    assert 20 in statement.compile().params.values()
+    # The candidates are taken among the rows beyond the cutoff, not filtered after
+    assert (
+        "FROM ingredientnutrition \n"
+        "WHERE (ingredientnutrition.embedding <=> queries.embedding) > "
+        "%(param_1)s ORDER BY CAST(binary_quantize"
+    ) in sql
+
+
+def test_estimate_ingredient_prices_with_index(mocker):
+    index = IngredientVectorIndex(IngredientPrice, payload_column="price_100grams")
+    index.set_arrays(
+        ids=np.array([1, 2]),
+        matrix=np.array([[1.0, 0.0], [0.0, 1.0]]),
+        payload=np.array([5.0, 10.0]),
+    )
+    ingredients = [RecipeIngredient(embedding=[1.0, 0.0]), RecipeIngredient()]
+    session = mocker.Mock(spec=Session)
+    result = estimate_ingredient_prices(
+        ingredients,
+        session,
+        cosine_distance_cutoff=0.5,
+        number_to_average=1,
+        index=index,
+    )
+    assert result == [10.0, None]
+    session.exec.assert_not_called()
+
+
+# A scratch database with pgvector 0.8 to run the matching queries against
+TEST_POSTGRES_URL = os.environ.get("CHAO_FAN_TEST_POSTGRES_URL")
+
+
+@pytest.fixture
+def postgres_engine():
+    if TEST_POSTGRES_URL is None:
+        pytest.skip("CHAO_FAN_TEST_POSTGRES_URL not set")
+    schema = f"test_{uuid.uuid4().hex}"
+    engine = create_engine(
+        TEST_POSTGRES_URL, connect_args={"options": f"-csearch_path={schema},public"}
+    )
+    event.listen(engine, "connect", set_vector_search_parameters)
+    with engine.begin() as conn:
+        conn.execute(text(f"CREATE SCHEMA {schema}"))
+    IngredientPrice.__table__.create(engine)
+    yield engine
+    with engine.begin() as conn:
+        conn.execute(text(f"DROP SCHEMA {schema} CASCADE"))
+    engine.dispose()
+
+
+def _unit(vectors):
+    return vectors / np.linalg.norm(vectors, axis=-1, keepdims=True)
+
+
+@pytest.mark.parametrize("quantization", [None, "halfvec", "binary"])
+def test_indexed_matches_agree_with_exact_search(postgres_engine, quantization):
+    rng = np.random.default_rng(0)
+    dimension = int(IngredientPrice.embedding.type.dim)
+    queries = _unit(rng.normal(size=(10, dimension)))
+    rows = [_unit(rng.normal(size=(1000, dimension)))]
+    for query in queries:
+        # More near duplicates within the cutoff than ef_search and the number of
+        # candidates, then rows just beyond it
+        rows.append(_unit(query + 0.02 * rng.normal(size=(50, dimension))))
+        similarity = rng.uniform(0.25, 0.38, size=(8, 1))
+        noise = _unit(rng.normal(size=(8, dimension)))
+        rows.append(_unit(similarity * query + np.sqrt(1 - similarity**2) * noise))
+    embeddings = np.concatenate(rows)
+    with Session(postgres_engine) as session:
+        session.add_all(
+            IngredientPrice(
+                description=str(i), price_100grams=float(i), embedding=embedding
+            )
+            for i, embedding in enumerate(embeddings.tolist())
+        )
+        session.commit()
+    ingredients = [RecipeIngredient(embedding=query) for query in queries.tolist()]
+    with Session(postgres_engine) as session:
+        exact = estimate_ingredient_prices(ingredients, session)
+    assert None not in exact
+
+    create_vector_index(postgres_engine, "ingredientprice", quantization=quantization)
+    with Session(postgres_engine) as session:
+        session.exec(text("ANALYZE ingredientprice"))
+        session.exec(text("SET LOCAL enable_seqscan = off"))
+        indexed = estimate_ingredient_prices(
+            ingredients, session, quantization=quantization
+        )
+    assert indexed == exact
@@ -0,0 +1,75 @@
+import numpy as np
+import pytest
+
+from chao_fan.embedding_service import EmbeddingClient
+from chao_fan.integrations.sentence_transformer import (
+    MODEL_NAME,
+    OnnxSentenceEncoder,
+    embedding_model_id,
+    get_model,
+)
+
+
+def make_encoder(mocker) -> OnnxSentenceEncoder:
+    encoder = OnnxSentenceEncoder.__new__(OnnxSentenceEncoder)
+    encoder.max_seq_length = 256
+    encoder.input_names = {"input_ids", "attention_mask"}
+
+    def tokenize(sentences, **kwargs):
+        # One token per word, right padded
+        length = max(len(sentence.split()) for sentence in sentences)
+        ids = np.zeros((len(sentences), length), dtype=np.int64)
+        mask = np.zeros_like(ids)
+        for i, sentence in enumerate(sentences):
+            words = sentence.split()
+            ids[i, : len(words)] = [len(word) for word in words]
+            mask[i, : len(words)] = 1
+        return dict(input_ids=ids, attention_mask=mask, token_type_ids=ids * 0)
+
+    def run(_, inputs):
+        assert set(inputs) == encoder.input_names
+        ids = inputs["input_ids"].astype(np.float32)
+        return [np.stack([ids, np.ones_like(ids)], axis=-1)]
+
+    encoder.tokenizer = tokenize
+    encoder.session = mocker.Mock()
+    encoder.session.run.side_effect = run
+    return encoder
+
+
+def test_onnx_encoder_mean_pools_and_normalizes(mocker):
+    encoder = make_encoder(mocker)
+    embeddings = encoder.encode(["salt", "a cup of flour", "ab cd"], batch_size=2)
+    # Mean of the token embeddings, ignoring padding: salt -> [4, 1]
+    expected = np.array([[4.0, 1.0], [2.75, 1.0], [2.0, 1.0]])
+    expected /= np.linalg.norm(expected, axis=1, keepdims=True)
+    np.testing.assert_allclose(embeddings, expected, rtol=1e-6)
+    assert embeddings.dtype == np.float32
+    assert encoder.encode("salt").shape == (2,)
+
+
+def test_get_model_onnx_requires_model_dir(monkeypatch):
+    monkeypatch.delenv("ONNX_MODEL_DIR", raising=False)
+    with pytest.raises(ValueError):
+        get_model(backend="onnx")
+
+
+def test_get_model_uses_embedding_service(monkeypatch):
+    monkeypatch.setenv("EMBEDDING_SERVICE_ADDRESS", "/tmp/embeddings.sock")
+    model = get_model()
+    assert isinstance(model, EmbeddingClient)
+    assert model.address == "/tmp/embeddings.sock"
+
+
+def test_embedding_model_id_depends_on_quantization(monkeypatch):
+    monkeypatch.delenv("EMBEDDING_MODEL_ID", raising=False)
+    monkeypatch.delenv("EMBEDDING_BACKEND", raising=False)
+    monkeypatch.delenv("ONNX_MODEL_FILE", raising=False)
+    assert embedding_model_id() == MODEL_NAME
+    assert embedding_model_id("onnx") == f"{MODEL_NAME}:int8"
+    monkeypatch.setenv("EMBEDDING_BACKEND", "onnx")
+    # The float32 export keeps the embeddings of the PyTorch model
+    monkeypatch.setenv("ONNX_MODEL_FILE", "model.onnx")
+    assert embedding_model_id() == MODEL_NAME
+    monkeypatch.setenv("EMBEDDING_MODEL_ID", "custom")
+    assert embedding_model_id() == "custom"
@@ -0,0 +1,60 @@
+import threading
+import time
+
+import pytest
+
+from chao_fan.stages import Stage, run_stages
+
+
+def test_run_stages():
+    stages = [
+        Stage("double", lambda x: 2 * x, workers=3),
+        Stage("drop_multiples_of_four", lambda x: None if x % 4 == 0 else x),
+        Stage("increment", lambda xs: [x + 1 for x in xs], batch_size=4),
+    ]
+    outputs = list(run_stages(range(100), stages, queue_size=2))
+    assert sorted(outputs) == [2 * x + 1 for x in range(100) if (2 * x) % 4 != 0]
+
+
+def test_run_stages_batches_are_bounded():
+    batch_sizes = []
+
+    def record(xs):
+        batch_sizes.append(len(xs))
+        return xs
+
+    outputs = list(run_stages(range(50), [Stage("record", record, batch_size=8)]))
+    assert sorted(outputs) == list(range(50))
+    assert max(batch_sizes) <= 8
+
+
+def test_run_stages_backpressure():
+    produced = []
+    lock = threading.Lock()
+
+    def items():
+        for i in range(100):
+            with lock:
+                produced.append(i)
+            yield i
+
+    def slow(x):
+        time.sleep(0.001)
+        return x
+
+    outputs = run_stages(items(), [Stage("slow", slow)], queue_size=2)
+    next(outputs)
+    time.sleep(0.05)
+    # Only a few items can be buffered between the generator and the consumer
+    assert len(produced) < 10
+    outputs.close()
+
+
+def test_run_stages_propagates_errors():
+    def fail(x):
+        if x == 5:
+            raise ValueError("bad item")
+        return x
+
+    with pytest.raises(ValueError, match="bad item"):
+        list(run_stages(range(20), [Stage("fail", fail, workers=2)]))
@@ -0,0 +1,194 @@
+import time
+from datetime import timedelta
+
+from sqlalchemy.dialects import postgresql
+
+from chao_fan.integrations import ingredient_parsing
+from chao_fan.integrations.ingredient_parsing import ParsedLine
+from chao_fan.integrations.pinterest import Pin
+from chao_fan.integrations.recipe_scrapers import ScrapedRecipe
+from chao_fan.models import Recipe
+from chao_fan.pipelines.update_recipe_db import (
+    _enrich_recipes_batch,
+    _enrich_recipes_staged,
+    claim_recipes,
+    claimed_recipes,
+    enrich_recipes,
+    find_existing_urls,
+    insert_pins_into_db,
+    insert_pins_statement,
+)
+
+
+def test_insert_pins_statement():
+    pins = [
+        Pin(url="http://Example.com/soup/?utm_source=pinterest", site_name="Example"),
+        Pin(url="https://example.com/soup", site_name="Example"),
+        Pin(url="https://example.com/stew", site_name="Example"),
+    ]
+    statement = insert_pins_statement(pins)
+    compiled = statement.compile(dialect=postgresql.psycopg2.dialect())
+    assert "ON CONFLICT (canonical_url) DO NOTHING RETURNING recipe.id" in str(compiled)
+    # Variants of the same page are inserted once, with the first pin's url
+    canonical_urls = [v for k, v in compiled.params.items() if "canonical_url" in k]
+    assert canonical_urls == [
+        "https://example.com/soup",
+        "https://example.com/stew",
+    ]
+    assert compiled.params["source_url_m0"] == pins[0].url
+
+
+def test_insert_pins_into_db(mocker):
+    engine = mocker.MagicMock()
+    assert insert_pins_into_db([], engine) == 0
+    engine.begin.assert_not_called()
+    conn = engine.begin.return_value.__enter__.return_value
+    conn.execute.return_value.all.return_value = [(1,)]
+    pins = [Pin(url="https://example.com/soup", site_name="Example")] * 2
+    assert insert_pins_into_db(pins, engine) == 1
+    # A single statement for all pins
+    conn.execute.assert_called_once()
+
+
+def test_find_existing_urls_matches_canonical_urls(mocker):
+    engine = mocker.MagicMock()
+    conn = engine.connect.return_value.__enter__.return_value
+    conn.execute.return_value = [("https://example.com/soup",)]
+    urls = ["https://example.com/soup/?fbclid=1", "https://example.com/stew"]
+    assert find_existing_urls(urls, engine) == {urls[0]}
+    params = conn.execute.call_args.args[1]
+    assert sorted(params["canonical_urls"]) == [
+        "https://example.com/soup",
+        "https://example.com/stew",
+    ]
+
+
+def test_claim_recipes(mocker):
+    engine = mocker.MagicMock()
+    conn = engine.begin.return_value.__enter__.return_value
+    conn.execute.return_value.scalars.return_value.all.return_value = [3, 4]
+    ids = claim_recipes(engine, 2, timedelta(days=1), timedelta(minutes=30))
+    assert ids == [3, 4]
+    statement = conn.execute.call_args.args[0]
+    sql = str(statement.compile(dialect=postgresql.psycopg2.dialect()))
+    assert sql.startswith("UPDATE recipe SET enrichment_lease_until=(now() + ")
+    # Matches the partial index of unenriched recipes
+    assert "WHERE recipe.enriched_at IS NULL AND" in sql
+    assert "recipe.enrichment_lease_until < now()" in sql
+    assert sql.endswith("FOR UPDATE SKIP LOCKED) RETURNING recipe.id")
+
+
+def test_enrich_recipes_stops_when_nothing_is_claimed(mocker):
+    mocker.patch("chao_fan.pipelines.update_recipe_db.get_model")
+    claim = mocker.patch(
+        "chao_fan.pipelines.update_recipe_db.claim_recipes", side_effect=[[1], []]
+    )
+    session = mocker.patch("chao_fan.pipelines.update_recipe_db.Session")
+    session = session.return_value.__enter__.return_value
+    batch = mocker.patch("chao_fan.pipelines.update_recipe_db._enrich_recipes_batch")
+    enrich_recipes(mocker.Mock(), max_enrichments=100, batch_size=10)
+    assert claim.call_count == 2
+    batch.assert_called_once()
+    session.commit.assert_called_once()
+
+
+def test_enrich_recipes_staged_batches_embeddings_by_recipe(mocker):
+    run_stages = mocker.patch(
+        "chao_fan.pipelines.update_recipe_db.run_stages", return_value=[]
+    )
+    _enrich_recipes_staged(
+        mocker.Mock(), [], 0, embedding_model=mocker.Mock(), embed_batch_recipes=3
+    )
+    stages = {stage.name: stage for stage in run_stages.call_args.args[1]}
+    assert stages["embed"].batch_size == 3
+
+
+def _parser_pool(mocker):
+    ingredient_parsing._memo.clear()
+    pool = mocker.Mock()
+    pool.parse.side_effect = lambda lines: [
+        ParsedLine(line.split()[-1]) for line in lines
+    ]
+    return pool
+
+
+def _extract_recipe(mocker):
+    return mocker.patch(
+        "chao_fan.pipelines.update_recipe_db.extract_recipe",
+        side_effect=lambda url, html, parse_ingredient_lines: ScrapedRecipe(
+            title=url, ingredient_lines=[f"1 cup {url}-a", f"2 cups {url}-b"]
+        ),
+    )
+
+
+def test_enrich_recipes_batch_parses_the_batch_at_once(mocker):
+    extract_recipe = _extract_recipe(mocker)
+    mocker.patch("chao_fan.pipelines.update_recipe_db.enrich_ingredients")
+    pool = _parser_pool(mocker)
+    recipes = [Recipe(id=i, source_url=f"r{i}") for i in range(3)]
+    _enrich_recipes_batch(
+        mocker.Mock(), recipes, 3, parser_pool=pool, embedding_model=mocker.Mock()
+    )
+    assert extract_recipe.call_count == 3
+    pool.parse.assert_called_once()
+    assert len(pool.parse.call_args.args[0]) == 6
+    assert [i.description for i in recipes[1].recipe_ingredients] == ["r1-a", "r1-b"]
+
+
+def test_enrich_recipes_staged_parses_waiting_recipes_together(mocker):
+    _extract_recipe(mocker)
+    mocker.patch("chao_fan.pipelines.update_recipe_db.embed_ingredients")
+    mocker.patch("chao_fan.pipelines.update_recipe_db.match_ingredients")
+    mocker.patch("chao_fan.pipelines.update_recipe_db.Session")
+    fetcher = mocker.Mock()
+    fetcher.fetch.return_value = "<html>"
+    pool = _parser_pool(mocker)
+    recipes = [Recipe(id=i, source_url=f"r{i}") for i in range(6)]
+    session = mocker.Mock()
+    session.get.side_effect = lambda model, recipe_id: recipes[recipe_id]
+    # Parsing waits for the pool, so the other recipes queue up meanwhile
+    parse = pool.parse.side_effect
+    pool.parse.side_effect = lambda lines: time.sleep(0.2) or parse(lines)
+    _enrich_recipes_staged(
+        session,
+        [(recipe.id, recipe.source_url) for recipe in recipes],
+        6,
+        fetcher=fetcher,
+        parser_pool=pool,
+        embedding_model=mocker.Mock(),
+    )
+    batch_sizes = [len(call.args[0]) for call in pool.parse.call_args_list]
+    assert sum(batch_sizes) == 12
+    assert max(batch_sizes) > 2
+    assert all(len(recipe.recipe_ingredients) == 2 for recipe in recipes)
+
+
+def test_claimed_recipes_claims_as_they_are_consumed(mocker):
+    claim = mocker.patch(
+        "chao_fan.pipelines.update_recipe_db.claim_recipes",
+        side_effect=[[1, 2], [3], []],
+    )
+    session = mocker.patch("chao_fan.pipelines.update_recipe_db.Session")
+    session = session.return_value.__enter__.return_value
+    session.exec.return_value.all.side_effect = [[(1, "a"), (2, "b")], [(3, "c")]]
+    items = claimed_recipes(
+        mocker.Mock(), 10, 2, timedelta(days=1), timedelta(minutes=30)
+    )
+    assert next(items) == (1, "a")
+    assert claim.call_count == 1
+    assert list(items) == [(2, "b"), (3, "c")]
+    assert [call.args[1] for call in claim.call_args_list] == [2, 2, 2]
+
+
+def test_enrich_recipes_staged_runs_one_pipeline(mocker):
+    mocker.patch("chao_fan.pipelines.update_recipe_db.get_model")
+    mocker.patch("chao_fan.pipelines.update_recipe_db.Session")
+    mocker.patch(
+        "chao_fan.pipelines.update_recipe_db.claim_recipes",
+        side_effect=[[1], [2], []],
+    )
+    staged = mocker.patch("chao_fan.pipelines.update_recipe_db._enrich_recipes_staged")
+    enrich_recipes(mocker.Mock(), max_enrichments=100, batch_size=1, staged=True)
+    # Claiming is the source of a single pipeline, not a loop around it
+    staged.assert_called_once()
+    assert staged.call_args.kwargs["commit_every"] == 1
@@ -0,0 +1,12 @@
+from chao_fan.utils import canonicalize_url
+
+
+def test_canonicalize_url():
+    assert (
+        canonicalize_url("http://WWW.Example.com/recipe/?utm_source=pin&b=2&a=1#top")
+        == "https://www.example.com/recipe?a=1&b=2"
+    )
+    assert canonicalize_url("https://example.com") == "https://example.com/"
+    assert canonicalize_url("https://example.com:443/a/?fbclid=1") == (
+        "https://example.com/a"
+    )
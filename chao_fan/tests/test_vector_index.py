@@ -0,0 +1,143 @@
+import json
+import os
+
+import numpy as np
+import pytest
+from sqlalchemy.dialects import postgresql
+
+from chao_fan.models import IngredientPrice
+from chao_fan.vector_index import IngredientVectorIndex
+
+
+def make_index(block_size: int = 2) -> IngredientVectorIndex:
+    index = IngredientVectorIndex(
+        IngredientPrice, payload_column="price_100grams", block_size=block_size
+    )
+    index.set_arrays(
+        ids=np.array([10, 20, 30, 40]),
+        matrix=np.array([[1.0, 0.0], [0.0, 1.0], [1.0, 1.0], [-1.0, 0.0]]),
+        payload=np.array([1.0, 2.0, 3.0, 4.0]),
+        signature=(4, 40),
+    )
+    return index
+
+
+def test_search_matches_brute_force():
+    index = make_index()
+    queries = np.array([[1.0, 0.1], [0.2, 1.0]])
+    positions, distances = index.search(queries, k=4)
+    normalized = index.matrix
+    q = queries / np.linalg.norm(queries, axis=1, keepdims=True)
+    expected = 1.0 - q @ normalized.T
+    np.testing.assert_array_equal(positions, np.argsort(expected, axis=1))
+    np.testing.assert_allclose(distances, np.sort(expected, axis=1), atol=1e-6)
+
+
+def test_search_applies_cutoff_and_pads():
+    index = make_index()
+    # Distances from [1, 0]: 0, 1, ~0.29, 2
+    positions, distances = index.search([[1.0, 0.0]], k=5, cosine_distance_cutoff=0.5)
+    assert positions.tolist() == [[1, 3, -1, -1, -1]]
+    assert np.isinf(distances[0, 2:]).all()
+
+
+def test_refresh_only_reloads_when_table_changes(mocker):
+    index = make_index()
+    session = mocker.Mock()
+    session.exec().one.return_value = (4, 40, None)
+    index.signature = (4, 40, 0)
+    load_table = mocker.patch.object(index, "_load_table")
+    assert index.refresh(session) is False
+    # A row updated in place only changes the checksum
+    session.exec().one.return_value = (4, 40, 123)
+    assert index.refresh(session) is True
+    load_table.assert_called_once()
+
+
+def test_table_signature_covers_contents(mocker):
+    index = make_index()
+    session = mocker.Mock()
+    session.exec().one.return_value = (4, 40, -7)
+    assert index.table_signature(session) == (4, 40, -7)
+    statement = session.exec.call_args.args[0]
+    sql = str(statement.compile(dialect=postgresql.psycopg2.dialect()))
+    assert (
+        "sum(hashtext(concat_ws(%(concat_ws_1)s, ingredientprice.id, "
+        "ingredientprice.embedding_model, ingredientprice.embedding_hash, "
+        "ingredientprice.price_100grams))) FILTER "
+        "(WHERE ingredientprice.embedding IS NOT NULL)"
+    ) in sql
+
+
+def test_snapshot_round_trip(tmp_path):
+    index = make_index()
+    index.snapshot_dir = str(tmp_path)
+    index._save_snapshot()
+    loaded = IngredientVectorIndex(
+        IngredientPrice, payload_column="price_100grams", snapshot_dir=str(tmp_path)
+    )
+    assert not loaded._load_snapshot((5, 50))
+    assert loaded._load_snapshot((4, 40))
+    np.testing.assert_array_equal(loaded.ids, index.ids)
+    np.testing.assert_array_equal(loaded.payload, index.payload)
+    assert isinstance(loaded.matrix, np.memmap)
+
+
+def test_snapshot_replaces_files_atomically(tmp_path):
+    index = make_index()
+    index.snapshot_dir = str(tmp_path)
+    index._save_snapshot()
+    reader = IngredientVectorIndex(
+        IngredientPrice, payload_column="price_100grams", snapshot_dir=str(tmp_path)
+    )
+    assert reader._load_snapshot((4, 40))
+    old_matrix = np.array(reader.matrix)
+    index.set_arrays(
+        index.ids[:2], index.matrix[:2], index.payload[:2], signature=(2, 20)
+    )
+    index._save_snapshot()
+    # The memory-mapped matrix of the previous snapshot is left untouched
+    np.testing.assert_array_equal(reader.matrix, old_matrix)
+    # Only the arrays of the latest version are kept
+    assert len(os.listdir(tmp_path)) == 4
+    assert reader._load_snapshot((2, 20))
+    assert len(reader.matrix) == 2
+
+
+def test_snapshot_arrays_are_versioned(tmp_path):
+    index = make_index()
+    index.snapshot_dir = str(tmp_path)
+    index._save_snapshot()
+    with open(tmp_path / "ingredientprice_meta.json") as f:
+        version = json.load(f)["version"]
+    # The arrays of a concurrent save never replace the ones meta.json refers to
+    ids_path = tmp_path / f"ingredientprice_{version}_ids.npy"
+    assert ids_path.exists()
+    loaded = IngredientVectorIndex(
+        IngredientPrice, payload_column="price_100grams", snapshot_dir=str(tmp_path)
+    )
+    np.save(ids_path, index.ids[:2])
+    assert not loaded._load_snapshot((4, 40))
+    assert loaded.signature is None
+
+
+@pytest.mark.parametrize("damage", ["delete", "truncate"])
+def test_snapshot_falls_back_when_payload_is_unreadable(tmp_path, mocker, damage):
+    index = make_index()
+    index.snapshot_dir = str(tmp_path)
+    index._save_snapshot()
+    (payload_path,) = tmp_path.glob("ingredientprice_*_payload.npy")
+    if damage == "delete":
+        payload_path.unlink()
+    else:
+        payload_path.write_bytes(payload_path.read_bytes()[:20])
+    loaded = IngredientVectorIndex(
+        IngredientPrice, payload_column="price_100grams", snapshot_dir=str(tmp_path)
+    )
+    assert not loaded._load_snapshot((4, 40))
+    session = mocker.Mock()
+    session.exec().one.return_value = (4, 40, None)
+    load_table = mocker.patch.object(loaded, "_load_table")
+    mocker.patch.object(loaded, "_save_snapshot")
+    assert loaded.refresh(session) is True
+    load_table.assert_called_once()
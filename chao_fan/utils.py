@@ -1,6 +1,36 @@
 import signal
 from types import FrameType, TracebackType
 from typing import Any, Optional, Type, Union
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+# Query parameters that only track where a visitor came from
+TRACKING_PARAMETERS = {"fbclid", "gclid", "mc_cid", "mc_eid", "igshid", "_ga"}
+
+
+def canonicalize_url(url: str) -> str:
+    """Canonical form of a URL, shared by every variant of the same page
+
+    Lower cases the host, uses https, drops the port if it is the default one,
+    the fragment, tracking parameters (utm_*, fbclid, ...) and the trailing slash,
+    and sorts the remaining query parameters.
+
+    Examples
+    --------
+    >>> canonicalize_url("http://WWW.Example.com/recipe/?utm_source=pinterest&b=2&a=1")
+    'https://www.example.com/recipe?a=1&b=2'
+
+    """
+    parts = urlsplit(url.strip())
+    host = (parts.hostname or "").lower()
+    if parts.port is not None and parts.port not in (80, 443):
+        host = f"{host}:{parts.port}"
+    path = parts.path.rstrip("/") or "/"
+    query = sorted(
+        (key, value)
+        for key, value in parse_qsl(parts.query, keep_blank_values=True)
+        if not key.lower().startswith("utm_") and key.lower() not in TRACKING_PARAMETERS
+    )
+    return urlunsplit(("https", host, path, urlencode(query), ""))
 
 
 class Timeout:
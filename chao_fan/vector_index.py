@@ -0,0 +1,323 @@
+"""
+In-process vector index over the ingredient reference tables
+"""
+
+import contextlib
+import json
+import logging
+import os
+import tempfile
+import uuid
+from typing import IO, Callable, Optional, Tuple
+
+import numpy as np
+from sqlalchemy import func
+from sqlmodel import Session, select
+
+from chao_fan.models import Ingredient
+
+logger = logging.getLogger(__name__)
+
+
+def _normalize(matrix: np.ndarray) -> np.ndarray:
+    """Scale rows to unit length so dot products are cosine similarities"""
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+class IngredientVectorIndex:
+    """Exact top-k cosine search over an ingredient table held in memory
+
+    Parameters
+    ----------
+    ingredient_model : Ingredient
+        The ingredient table to index (e.g. IngredientPrice)
+    payload_column : str, optional
+        A column loaded alongside the ids (e.g. "price_100grams") so that
+        matches can be used without going back to the database
+    snapshot_dir : str, optional
+        Directory where the matrix is saved after loading. If a snapshot matching
+        the table is found, it is memory-mapped instead of read from the database.
+    block_size : int, optional
+        Number of rows multiplied at once, which bounds peak memory while searching
+
+    Notes
+    -----
+    The index is tagged with a signature of the table: the number of embedded
+    rows, the max id, and a checksum of the embedding provenance and payload of
+    every row, so that rows updated in place (a new price, or an embedding of
+    another model) are noticed too. `refresh` reloads it whenever it changes.
+
+    Examples
+    --------
+    >>> index = IngredientVectorIndex(IngredientPrice, payload_column="price_100grams")
+    >>> index.refresh(session)
+    >>> positions, distances = index.search(embeddings, k=5)
+
+    """
+
+    def __init__(
+        self,
+        ingredient_model: Ingredient,
+        payload_column: Optional[str] = None,
+        snapshot_dir: Optional[str] = None,
+        block_size: int = 65536,
+    ) -> None:
+        self.ingredient_model = ingredient_model
+        self.payload_column = payload_column
+        self.snapshot_dir = snapshot_dir
+        self.block_size = block_size
+        self.signature: Optional[Tuple[int, ...]] = None
+        self.ids = np.empty(0, dtype=np.int64)
+        self.matrix = np.empty((0, 0), dtype=np.float32)
+        self.payload: Optional[np.ndarray] = None
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    @property
+    def table_name(self) -> str:
+        return self.ingredient_model.__tablename__
+
+    def table_signature(self, session: Session) -> Tuple[int, ...]:
+        """Number of embedded rows, max id and checksum of the contents of the table
+
+        The checksum is a sum of hashes of the id, embedding model, embedding
+        hash and payload of each embedded row. A row re-embedded or updated in
+        place changes it, without changing the number of rows or the max id.
+
+        """
+        model = self.ingredient_model
+        row = [model.id, model.embedding_model, model.embedding_hash]
+        if self.payload_column is not None:
+            row.append(getattr(model, self.payload_column))
+        checksum = func.sum(func.hashtext(func.concat_ws(":", *row))).filter(
+            model.embedding != None  # noqa
+        )
+        count, max_id, content = session.exec(
+            select(func.count(model.embedding), func.max(model.id), checksum)
+        ).one()
+        return int(count), int(max_id or 0), int(content or 0)
+
+    def refresh(self, session: Session) -> bool:
+        """Reload the index if the table changed since it was loaded
+
+        Returns
+        -------
+        bool
+            Whether the index was reloaded
+
+        """
+        signature = self.table_signature(session)
+        if signature == self.signature:
+            return False
+        if not self._load_snapshot(signature):
+            self._load_table(session, signature)
+            self._save_snapshot()
+        logger.info(f"Loaded {len(self)} {self.table_name} embeddings into memory")
+        return True
+
+    def set_arrays(
+        self,
+        ids: np.ndarray,
+        matrix: np.ndarray,
+        payload: Optional[np.ndarray] = None,
+        signature: Optional[Tuple[int, ...]] = None,
+    ) -> None:
+        """Replace the contents of the index"""
+        self.ids = np.asarray(ids, dtype=np.int64)
+        self.matrix = np.ascontiguousarray(_normalize(np.asarray(matrix, np.float32)))
+        self.payload = payload
+        self.signature = signature
+
+    def _load_table(self, session: Session, signature: Tuple[int, ...]) -> None:
+        model = self.ingredient_model
+        n_rows = signature[0]
+        columns = [model.id, model.embedding]
+        if self.payload_column is not None:
+            columns.append(getattr(model, self.payload_column))
+        statement = (
+            select(*columns)
+            .where(model.embedding != None)  # noqa
+            .order_by(model.id)
+            .execution_options(yield_per=self.block_size)
+        )
+        ids = np.empty(n_rows, dtype=np.int64)
+        matrix = None
+        payload = np.empty(n_rows, dtype=np.float64) if self.payload_column else None
+        i = 0
+        for row in session.exec(statement):
+            # Rows may have been embedded since the table was counted
+            if i == n_rows:
+                break
+            if matrix is None:
+                matrix = np.empty((n_rows, len(row[1])), dtype=np.float32)
+            ids[i] = row[0]
+            matrix[i] = row[1]
+            if payload is not None:
+                payload[i] = row[2]
+            i += 1
+        if matrix is None:
+            matrix = np.empty((0, 0), dtype=np.float32)
+        self.set_arrays(
+            ids[:i],
+            matrix[:i],
+            payload[:i] if payload is not None else None,
+            signature=signature,
+        )
+
+    def _snapshot_path(self, name: str) -> str:
+        return os.path.join(self.snapshot_dir, f"{self.table_name}_{name}")
+
+    def _replace_snapshot_file(self, name: str, write: Callable[[IO], None]) -> None:
+        """Write a snapshot file to a temporary path, then move it into place
+
+        Other processes may have the previous file memory-mapped: they keep
+        reading it, and never see a partially written file.
+
+        """
+        fd, tmp_path = tempfile.mkstemp(
+            dir=self.snapshot_dir, prefix=f".{self.table_name}_{name}."
+        )
+        try:
+            with os.fdopen(fd, "wb") as f:
+                write(f)
+            os.replace(tmp_path, self._snapshot_path(name))
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def _save_snapshot(self) -> None:
+        """Save the arrays, then point meta.json to them
+
+        Each save writes its arrays under a new version, so the arrays that
+        meta.json refers to are never those of another save. The arrays of
+        previous versions are removed once meta.json is replaced.
+
+        """
+        if self.snapshot_dir is None:
+            return
+        os.makedirs(self.snapshot_dir, exist_ok=True)
+        version = uuid.uuid4().hex
+        arrays = {"matrix.npy": self.matrix, "ids.npy": self.ids}
+        if self.payload is not None:
+            arrays["payload.npy"] = self.payload
+        for name, array in arrays.items():
+            self._replace_snapshot_file(
+                f"{version}_{name}", lambda f: np.save(f, array)
+            )
+        # Written last so an interrupted save is never picked up
+        meta = {
+            "signature": list(self.signature),
+            "version": version,
+            "n_rows": len(self.ids),
+        }
+        self._replace_snapshot_file(
+            "meta.json", lambda f: f.write(json.dumps(meta).encode())
+        )
+        prefix = f"{self.table_name}_"
+        for file_name in os.listdir(self.snapshot_dir):
+            if (
+                file_name.startswith(prefix)
+                and file_name.endswith(".npy")
+                and not file_name.startswith(f"{prefix}{version}_")
+            ):
+                # Processes that memory-mapped it keep reading it
+                with contextlib.suppress(FileNotFoundError):
+                    os.unlink(os.path.join(self.snapshot_dir, file_name))
+
+    def _load_snapshot(self, signature: Tuple[int, ...]) -> bool:
+        """Load the snapshot if its signature matches, returning whether it did
+
+        A missing or unreadable snapshot (e.g. removed by a concurrent save) is
+        not an error: the index is then loaded from the table instead.
+
+        """
+        if self.snapshot_dir is None:
+            return False
+        try:
+            with open(self._snapshot_path("meta.json")) as f:
+                meta = json.load(f)
+            if tuple(meta["signature"]) != signature:
+                return False
+            version = meta["version"]
+            matrix = np.load(
+                self._snapshot_path(f"{version}_matrix.npy"), mmap_mode="r"
+            )
+            ids = np.load(self._snapshot_path(f"{version}_ids.npy"))
+            payload = None
+            if self.payload_column is not None:
+                payload = np.load(self._snapshot_path(f"{version}_payload.npy"))
+        except FileNotFoundError:
+            return False
+        except (OSError, ValueError, EOFError, KeyError) as e:
+            logger.warning(f"Ignoring the unreadable {self.table_name} snapshot: {e}")
+            return False
+        n_rows = meta["n_rows"]
+        if len(matrix) != n_rows or len(ids) != n_rows:
+            return False
+        if payload is not None and len(payload) != n_rows:
+            return False
+        self.matrix, self.ids, self.payload = matrix, ids, payload
+        self.signature = signature
+        return True
+
+    def search(
+        self,
+        embeddings,
+        k: int = 1,
+        cosine_distance_cutoff: float = 0.0,
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Find the k closest rows to each embedding
+
+        Parameters
+        ----------
+        embeddings : array-like
+            The query embeddings, one per row
+        k : int, optional
+            The number of matches per query, by default 1
+        cosine_distance_cutoff : float, optional
+            Only rows with a cosine distance above this value are returned,
+            the same filter as the database lookups
+
+        Returns
+        -------
+        Tuple[np.ndarray, np.ndarray]
+            Row positions and cosine distances, both of shape (n_queries, k) and
+            sorted by distance. Missing matches have position -1 and distance inf.
+
+        """
+        queries = _normalize(np.atleast_2d(np.asarray(embeddings, dtype=np.float32)))
+        n_queries = len(queries)
+        best_distances = np.full((n_queries, 0), np.inf, dtype=np.float32)
+        best_positions = np.empty((n_queries, 0), dtype=np.int64)
+        for start in range(0, len(self.matrix), self.block_size):
+            block = self.matrix[start : start + self.block_size]
+            distances = 1.0 - queries @ block.T
+            distances[distances <= cosine_distance_cutoff] = np.inf
+            positions = np.broadcast_to(
+                np.arange(start, start + len(block)), distances.shape
+            )
+            best_distances = np.concatenate([best_distances, distances], axis=1)
+            best_positions = np.concatenate([best_positions, positions], axis=1)
+            if best_distances.shape[1] > k:
+                top = np.argpartition(best_distances, k - 1, axis=1)[:, :k]
+                best_distances = np.take_along_axis(best_distances, top, axis=1)
+                best_positions = np.take_along_axis(best_positions, top, axis=1)
+
+        order = np.argsort(best_distances, axis=1, kind="stable")
+        best_distances = np.take_along_axis(best_distances, order, axis=1)
+        best_positions = np.take_along_axis(best_positions, order, axis=1)
+        best_positions[np.isinf(best_distances)] = -1
+
+        # Pad when the table has fewer than k rows
+        missing = k - best_distances.shape[1]
+        if missing > 0:
+            best_distances = np.pad(
+                best_distances, ((0, 0), (0, missing)), constant_values=np.inf
+            )
+            best_positions = np.pad(
+                best_positions, ((0, 0), (0, missing)), constant_values=-1
+            )
+        return best_positions, best_distances
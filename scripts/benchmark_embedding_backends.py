@@ -0,0 +1,100 @@
+import logging
+import time
+from argparse import ArgumentParser
+from typing import List
+
+import numpy as np
+from sqlmodel import Session, func, select
+
+from chao_fan import env  # noqa: F401
+from chao_fan.db import engine
+from chao_fan.integrations.sentence_transformer import (
+    ONNX_BACKEND,
+    ONNX_MODEL_FILE,
+    ONNX_QUANTIZED_MODEL_FILE,
+    TORCH_BACKEND,
+    OnnxSentenceEncoder,
+    export_onnx_model,
+    get_model,
+)
+from chao_fan.models import IngredientNutrition
+
+logger = logging.getLogger(__name__)
+
+
+def sample_descriptions(n: int) -> List[str]:
+    """Random ingredient descriptions from the nutrition table"""
+    with Session(engine) as session:
+        descriptions = session.exec(
+            select(IngredientNutrition.description)
+            .where(IngredientNutrition.description != None)  # noqa
+            .order_by(func.random())
+            .limit(n)
+        ).all()
+    return list(descriptions)
+
+
+def benchmark(model, sentences: List[str], batch_size: int) -> np.ndarray:
+    """Encode the sentences, logging the throughput"""
+    model.encode(sentences[:batch_size], batch_size=batch_size)  # Warm up
+    start = time.perf_counter()
+    embeddings = model.encode(sentences, batch_size=batch_size, show_progress_bar=False)
+    elapsed = time.perf_counter() - start
+    logger.info(f"{len(sentences) / elapsed:.0f} sentences/s")
+    return np.asarray(embeddings, dtype=np.float32)
+
+
+def main():
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+    )
+    parser = ArgumentParser(
+        description="Compare the throughput and the embeddings of the PyTorch and ONNX backends"
+    )
+    parser.add_argument(
+        "onnx_model_dir", type=str, help="Directory of the exported ONNX model"
+    )
+    parser.add_argument(
+        "--export",
+        action="store_true",
+        help="Export (and quantize) the model to onnx_model_dir first",
+    )
+    parser.add_argument(
+        "--descriptions_file",
+        type=str,
+        default=None,
+        help="File with one description per line. By default, descriptions are sampled from the nutrition table.",
+    )
+    parser.add_argument("--n", type=int, default=5000)
+    parser.add_argument("--batch_size", type=int, default=64)
+    args = parser.parse_args()
+
+    if args.export:
+        logger.info(f"Exporting the model to {args.onnx_model_dir}")
+        export_onnx_model(args.onnx_model_dir, quantize=True)
+    if args.descriptions_file is not None:
+        with open(args.descriptions_file) as f:
+            sentences = [line.strip() for line in f if line.strip()][: args.n]
+    else:
+        sentences = sample_descriptions(args.n)
+    logger.info(f"Benchmarking on {len(sentences)} descriptions")
+
+    logger.info(f"Backend {TORCH_BACKEND}")
+    reference = benchmark(
+        get_model(device="cpu", backend=TORCH_BACKEND), sentences, args.batch_size
+    )
+    for file_name in [ONNX_MODEL_FILE, ONNX_QUANTIZED_MODEL_FILE]:
+        logger.info(f"Backend {ONNX_BACKEND} ({file_name})")
+        model = OnnxSentenceEncoder(args.onnx_model_dir, file_name=file_name)
+        embeddings = benchmark(model, sentences, args.batch_size)
+        # Both models output unit vectors
+        agreement = (embeddings * reference).sum(axis=1)
+        logger.info(
+            f"Cosine similarity with {TORCH_BACKEND}: mean {agreement.mean():.4f}, "
+            f"1st percentile {np.percentile(agreement, 1):.4f}, min {agreement.min():.4f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -5,11 +5,17 @@ import modal
 import torch
 from dotenv import load_dotenv
 
-from chao_fan.pipelines.generate_embedings import update_embeddings
+from chao_fan.pipelines.generate_embedings import max_run_seconds, update_embeddings
 
 load_dotenv()
-timeout = os.environ.get("INGREDIENT_EMBEDDING_GENERATION_TIMEOUT_SECONDS")
-modal_timeout = int(timeout) + 20
+timeout = os.environ.get("INGREDIENT_EMBEDDING_GENERATION_TIMEOUT_SECONDS", 600)
+queue_depth = os.environ.get("INGREDIENT_EMBEDDING_QUEUE_DEPTH", 2)
+# Worst case to encode and write one batch, the batches in flight when the
+# deadline passes are finished before the function returns
+max_batch_seconds = os.environ.get("INGREDIENT_EMBEDDING_MAX_BATCH_SECONDS", 60)
+modal_timeout = (
+    int(max_run_seconds(int(timeout), int(queue_depth), float(max_batch_seconds))) + 20
+)
 
 stub = modal.Stub("chao-fan-generate-embeddings")
 
@@ -1,27 +1,184 @@
+import io
 import logging
+import multiprocessing
+import os
 import sqlite3
+import time
 from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterable, Iterator, List, Set, Tuple
 
-import pandas as pd
-from sqlmodel import Session
+from sqlalchemy import Engine, delete, func, insert, select, text
 
-from chao_fan.db import engine
-from chao_fan.models import IngredientNutrition
+from chao_fan import env  # noqa: F401
+from chao_fan.db import get_engine
+from chao_fan.models import BulkLoadChunk, IngredientNutrition
 
 logger = logging.getLogger(__name__)
 
+# Columns filled by Postgres or by the embedding pipeline
+SKIPPED_COLUMNS = {"id", "embedding"}
 
-def read_sqlite_table(table_name: str, db: sqlite3.Connection) -> pd.DataFrame:
-    """Read a table from a SQLite database"""
-    return pd.read_sql_query(f"SELECT * FROM {table_name}", db)
 
+def copy_columns(table_name: str, db: sqlite3.Connection) -> List[str]:
+    """Columns of the SQLite table that also exist in IngredientNutrition"""
+    sqlite_columns = [row[1] for row in db.execute(f"PRAGMA table_info({table_name})")]
+    columns = IngredientNutrition.__table__.columns
+    return [c for c in sqlite_columns if c in columns and c not in SKIPPED_COLUMNS]
 
-def rename_columns_grams(s: str) -> str:
-    """Rename columns"""
-    if s in ["fdc_id", "description"]:
-        return s
-    else:
-        return f"{s}_grams"
+
+def rowid_ranges(
+    table_name: str, db: sqlite3.Connection, chunk_size: int
+) -> List[Tuple[int, int]]:
+    """Split the table in [start, end) rowid ranges of about `chunk_size` rows"""
+    first, last = db.execute(
+        f"SELECT MIN(rowid), MAX(rowid) FROM {table_name}"
+    ).fetchone()
+    if first is None:
+        return []
+    return [
+        (start, min(start + chunk_size, last + 1))
+        for start in range(first, last + 1, chunk_size)
+    ]
+
+
+def copy_value(value) -> str:
+    """A value in the COPY text format"""
+    if value is None:
+        return "\\N"
+    return (
+        str(value)
+        .replace("\\", "\\\\")
+        .replace("\t", "\\t")
+        .replace("\n", "\\n")
+        .replace("\r", "\\r")
+    )
+
+
+def copy_lines(rows: Iterable[tuple]) -> Iterator[str]:
+    for row in rows:
+        yield "\t".join(map(copy_value, row)) + "\n"
+
+
+class CopyStream(io.TextIOBase):
+    """Read-only file over COPY text lines, generated as `copy_expert` reads them
+
+    Only about one read's worth of rows is held in memory at a time.
+
+    """
+
+    def __init__(self, lines: Iterable[str]) -> None:
+        self._lines = iter(lines)
+        self._buffer = ""
+
+    def readable(self) -> bool:
+        return True
+
+    def read(self, size: int = -1) -> str:
+        parts = [self._buffer]
+        length = len(self._buffer)
+        while size < 0 or length < size:
+            line = next(self._lines, None)
+            if line is None:
+                break
+            parts.append(line)
+            length += len(line)
+        data = "".join(parts)
+        if size < 0:
+            size = length
+        self._buffer = data[size:]
+        return data[:size]
+
+
+def load_source(sqlite_db: str, table_name: str) -> str:
+    """Name of a load in the BulkLoadChunk table"""
+    return f"{os.path.basename(sqlite_db)}:{table_name}"
+
+
+def loaded_chunks(engine: Engine, source: str) -> Set[Tuple[int, int]]:
+    """The rowid ranges of `source` already copied by a previous run"""
+    with engine.connect() as conn:
+        rows = conn.execute(
+            select(BulkLoadChunk.start_rowid, BulkLoadChunk.end_rowid).where(
+                BulkLoadChunk.source == source
+            )
+        ).all()
+    return {(start, end) for start, end in rows}
+
+
+def copy_chunk(
+    sqlite_db: str, table_name: str, columns: List[str], start: int, end: int
+) -> int:
+    """Copy the rows of a rowid range from SQLite into Postgres
+
+    Runs in a worker process with its own SQLite and Postgres connections. The
+    rows are streamed from the SQLite cursor into COPY, and the chunk is
+    recorded in BulkLoadChunk in the same transaction, so a chunk is either
+    fully loaded and recorded, or not at all.
+
+    """
+    db = sqlite3.connect(sqlite_db)
+    n_rows = 0
+
+    def rows():
+        nonlocal n_rows
+        for row in db.execute(
+            f"SELECT {', '.join(columns)} FROM {table_name} "
+            "WHERE rowid >= ? AND rowid < ?",
+            (start, end),
+        ):
+            n_rows += 1
+            yield row
+
+    try:
+        with get_engine().begin() as conn:
+            with conn.connection.cursor() as cursor:
+                cursor.copy_expert(
+                    f"COPY {IngredientNutrition.__tablename__} ({', '.join(columns)}) "
+                    "FROM STDIN",
+                    CopyStream(copy_lines(rows())),
+                )
+            conn.execute(
+                insert(BulkLoadChunk).values(
+                    source=load_source(sqlite_db, table_name),
+                    start_rowid=start,
+                    end_rowid=end,
+                    rows=n_rows,
+                    loaded_at=func.now(),
+                )
+            )
+    finally:
+        db.close()
+    return n_rows
+
+
+def drop_secondary_indexes(engine: Engine, table_name: str) -> List[str]:
+    """Drop the indexes that do not back a constraint, returning their definitions"""
+    with engine.begin() as conn:
+        indexes = conn.execute(
+            text(
+                """
+                SELECT i.relname, pg_get_indexdef(ix.indexrelid)
+                FROM pg_index ix JOIN pg_class i ON i.oid = ix.indexrelid
+                WHERE ix.indrelid = CAST(:table_name AS regclass)
+                AND NOT EXISTS (
+                    SELECT 1 FROM pg_constraint c WHERE c.conindid = ix.indexrelid
+                )
+                """
+            ),
+            dict(table_name=table_name),
+        ).fetchall()
+        for name, _ in indexes:
+            logger.info(f"Dropping index {name}")
+            conn.execute(text(f'DROP INDEX IF EXISTS "{name}"'))
+    return [definition for _, definition in indexes]
+
+
+def create_indexes(engine: Engine, definitions: List[str]):
+    for definition in definitions:
+        logger.info(f"Rebuilding index: {definition}")
+        with engine.begin() as conn:
+            conn.execute(text(definition))
 
 
 def main():
@@ -43,8 +200,24 @@ def main():
     parser.add_argument(
         "--batch_size",
         type=int,
-        default=10000,
-        help="Number of rows to insert into the database at a time",
+        default=50000,
+        help="Number of rows copied into the database at a time",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=4,
+        help="Number of processes copying batches in parallel",
+    )
+    parser.add_argument(
+        "--restart",
+        action="store_true",
+        help="Forget the chunks copied by a previous run of this load and copy them again",
+    )
+    parser.add_argument(
+        "--drop_indexes",
+        action="store_true",
+        help="Drop the secondary indexes of the nutrition table during the load and rebuild them after",
     )
     args = parser.parse_args()
 
@@ -54,25 +227,57 @@ def main():
     # Count the number of rows in the table
     num_rows = db.execute(f"SELECT COUNT(*) FROM {args.table_name}").fetchone()[0]
     logger.info(f"Number of rows in {args.table_name}: {num_rows}")
-    n_batches = num_rows // args.batch_size + 1
-
-    # Read the ingredient nutrition data in batches and insert into IngredientNutrition table
-    batch = 1
-    for df in pd.read_sql_query(
-        f"SELECT * FROM {args.table_name}", db, chunksize=args.batch_size
-    ):
-        logger.info(f"Processing batch {batch}/{n_batches}")
-
-        # Rename columns
-        # df = df.rename(rename_columns_grams)
-
-        # Connect to Postgres
-        with Session(engine) as session:
-            session.bulk_insert_mappings(
-                IngredientNutrition, df.to_dict(orient="records")
-            )
-            session.commit()
-        batch += 1
+    columns = copy_columns(args.table_name, db)
+    ranges = rowid_ranges(args.table_name, db, args.batch_size)
+    db.close()
+    logger.info(f"Copying columns: {', '.join(columns)}")
+
+    engine = get_engine()
+    BulkLoadChunk.__table__.create(engine, checkfirst=True)
+    source = load_source(args.sqlite_db, args.table_name)
+    if args.restart:
+        with engine.begin() as conn:
+            conn.execute(delete(BulkLoadChunk).where(BulkLoadChunk.source == source))
+    loaded = loaded_chunks(engine, source)
+    if not loaded <= set(ranges):
+        raise ValueError(
+            f"A previous load of {source} used other chunks, rerun it with the same "
+            "--batch_size, or with --restart after emptying the nutrition table"
+        )
+    if len(loaded) > 0:
+        logger.info(f"Resuming: {len(loaded)}/{len(ranges)} chunks already copied")
+    ranges = [rowid_range for rowid_range in ranges if rowid_range not in loaded]
+    index_definitions = []
+    if args.drop_indexes:
+        index_definitions = drop_secondary_indexes(
+            engine, IngredientNutrition.__tablename__
+        )
+
+    # Stream the ingredient nutrition data into the IngredientNutrition table
+    start = time.perf_counter()
+    n_copied = 0
+    context = multiprocessing.get_context("spawn")
+    try:
+        with ProcessPoolExecutor(args.workers, mp_context=context) as executor:
+            futures = [
+                executor.submit(
+                    copy_chunk, args.sqlite_db, args.table_name, columns, first, end
+                )
+                for first, end in ranges
+            ]
+            for batch, future in enumerate(futures, start=1):
+                n_copied += future.result()
+                rate = n_copied / (time.perf_counter() - start)
+                logger.info(
+                    f"Copied batch {batch}/{len(ranges)} ({n_copied} rows, {rate:.0f} rows/s)"
+                )
+    finally:
+        if args.drop_indexes:
+            create_indexes(engine, index_definitions)
+    elapsed = time.perf_counter() - start
+    logger.info(
+        f"Loaded {n_copied} rows in {elapsed:.1f}s ({n_copied / elapsed:.0f} rows/s)"
+    )
 
 
 if __name__ == "__main__":
@@ -1,11 +1,14 @@
 import logging
+from argparse import ArgumentParser
+from typing import Dict, List, Optional, Tuple
 
 import pandas as pd
 import requests
-from sqlalchemy import Engine
-from sqlmodel import Session, select
+from sqlalchemy import Engine, bindparam, inspect, literal_column, text
+from sqlalchemy.dialects.postgresql import insert
 
-from chao_fan.db import engine
+from chao_fan import env  # noqa: F401
+from chao_fan.db import get_engine
 from chao_fan.models import IngredientPrice
 
 logger = logging.getLogger(__name__)
@@ -55,20 +58,113 @@ def reformat_ingredient_price_data(df: pd.DataFrame) -> pd.DataFrame:
     return df
 
 
-def upsert_ingredient_price_data(df: pd.DataFrame, engine: Engine):
-    """Upsert the ingredient price data into the database"""
-    with Session(engine) as session:
-        for index, row in df.iterrows():
-            ingredient = session.exec(
-                select(IngredientPrice).where(
-                    IngredientPrice.description == row["description"]
+def has_unique_descriptions(engine: Engine) -> bool:
+    """Whether the price table has the unique index on description"""
+    indexes = inspect(engine).get_indexes(IngredientPrice.__tablename__)
+    return any(i["unique"] and i["column_names"] == ["description"] for i in indexes)
+
+
+def duplicate_descriptions(engine: Engine) -> List[Tuple[int, str, float]]:
+    """The (id, description, price) of the rows sharing another row's description
+
+    Of the rows with the same description, the one with an embedding (then the
+    oldest) is kept and the others are returned.
+
+    """
+    with engine.connect() as conn:
+        return [
+            tuple(row)
+            for row in conn.execute(
+                text(
+                    f"""
+                    SELECT id, description, price_100grams FROM (
+                        SELECT id, description, price_100grams, row_number() OVER (
+                            PARTITION BY description ORDER BY embedding IS NULL, id
+                        ) AS n
+                        FROM {IngredientPrice.__tablename__}
+                    ) AS ranked
+                    WHERE n > 1
+                    ORDER BY description, id
+                    """
                 )
-            ).first()
-            if ingredient is None:
-                ingredient = IngredientPrice(description=row["description"])
-            ingredient.price_100grams = row["price_100grams"]
-            session.add(ingredient)
-        session.commit()
+            )
+        ]
+
+
+def ensure_unique_descriptions(
+    engine: Engine, duplicate_ids: Optional[List[int]] = None
+) -> int:
+    """Make the description index of an existing price table unique
+
+    Tables created before descriptions were unique may hold duplicates, see
+    `duplicate_descriptions`. Those listed in `duplicate_ids` are deleted
+    first, and the index cannot be created if any other remains.
+
+    Returns
+    -------
+    int
+        The number of rows deleted
+
+    """
+    table_name = IngredientPrice.__tablename__
+    if not inspect(engine).has_table(table_name) or has_unique_descriptions(engine):
+        return 0
+    logger.info("Adding a unique index on the ingredient price descriptions")
+    deleted = 0
+    with engine.begin() as conn:
+        if duplicate_ids:
+            statement = text(f"DELETE FROM {table_name} WHERE id IN :ids")
+            statement = statement.bindparams(bindparam("ids", expanding=True))
+            deleted = conn.execute(statement, dict(ids=duplicate_ids)).rowcount
+            logger.info(f"Deleted {deleted} rows with a duplicate description")
+        for index in inspect(conn).get_indexes(table_name):
+            if index["column_names"] == ["description"]:
+                conn.execute(text(f'DROP INDEX "{index["name"]}"'))
+    for index in IngredientPrice.__table__.indexes:
+        index.create(engine, checkfirst=True)
+    return deleted
+
+
+def upsert_ingredient_prices_statement(rows: List[Dict]):
+    """Insert new descriptions and update the price of existing ones
+
+    Rows whose price did not change are left untouched, and the embeddings of
+    existing descriptions are never overwritten. Each returned row tells
+    whether it was inserted (rather than updated).
+
+    """
+    statement = insert(IngredientPrice).values(rows)
+    return statement.on_conflict_do_update(
+        index_elements=["description"],
+        set_=dict(price_100grams=statement.excluded.price_100grams),
+        where=IngredientPrice.price_100grams.is_distinct_from(
+            statement.excluded.price_100grams
+        ),
+    ).returning(literal_column("xmax = 0").label("inserted"))
+
+
+def upsert_ingredient_price_data(
+    df: pd.DataFrame, engine: Engine, batch_size: int = 1000
+) -> Tuple[int, int]:
+    """Upsert the ingredient price data into the database
+
+    Returns
+    -------
+    Tuple[int, int]
+        The number of inserted and of updated descriptions
+
+    """
+    rows = df[["description", "price_100grams"]].to_dict("records")
+    n_inserted, n_updated = 0, 0
+    with engine.begin() as conn:
+        for start in range(0, len(rows), batch_size):
+            statement = upsert_ingredient_prices_statement(
+                rows[start : start + batch_size]
+            )
+            inserted = conn.execute(statement).scalars().all()
+            n_inserted += sum(inserted)
+            n_updated += len(inserted) - sum(inserted)
+    return n_inserted, n_updated
 
 
 def update_ingredient_price_data():
@@ -77,16 +173,52 @@ def update_ingredient_price_data():
         level=logging.INFO,
         format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
     )
+    parser = ArgumentParser()
+    parser.add_argument(
+        "--delete_duplicates",
+        action="store_true",
+        help="Delete the price rows duplicating another row's description without "
+        "asking, when the table is made unique by description",
+    )
+    args = parser.parse_args()
+    engine = get_engine()
+
+    # The upsert needs unique descriptions, older tables may have duplicates
+    duplicates = []
+    if inspect(engine).has_table(IngredientPrice.__tablename__):
+        if not has_unique_descriptions(engine):
+            duplicates = duplicate_descriptions(engine)
+    if len(duplicates) > 0:
+        logger.warning(
+            f"{len(duplicates)} price rows duplicate the description of another row"
+        )
+        for row_id, description, price in duplicates:
+            print(f"{row_id}\t{description}\t{price}")
+        if not args.delete_duplicates:
+            check = input(
+                f"This will delete the {len(duplicates)} price rows above. Are you sure you want to continue? (yes/no)"
+            )
+            if check != "yes":
+                print("Aborting")
+                return
+    ensure_unique_descriptions(engine, [row_id for row_id, _, _ in duplicates])
+
     # Download ingredient price data
     logger.info("Downloading ingredient price data")
     df = download_ingredient_price_data()
 
     # Reformat data
     df = reformat_ingredient_price_data(df)
+    # A description can only have one price
+    df = df.drop_duplicates(subset="description", keep="last")
 
     # Insert into database
     logger.info(f"Upserting ingredient price data ({len(df)} rows)")
-    upsert_ingredient_price_data(df, engine)
+    n_inserted, n_updated = upsert_ingredient_price_data(df, engine)
+    logger.info(
+        f"Inserted {n_inserted} descriptions, updated the price of {n_updated}, "
+        f"{len(df) - n_inserted - n_updated} unchanged"
+    )
 
 
 if __name__ == "__main__":